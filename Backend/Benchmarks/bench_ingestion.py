@@ -0,0 +1,170 @@
+"""
+Замер скорости разбора выгрузки и обновления БД на синтетических данных.
+Каждый этап выполняется на временной базе SQLite; результаты печатаются и записываются в JSON,
+чтобы сравнивать прогоны разных версий.
+
+Этапы:
+parse - только разбор XML;
+initial - первая загрузка в пустую БД;
+unchanged - повторная загрузка того же файла;
+changed - загрузка ревизии, в которой изменена часть записей;
+shrunk - загрузка выгрузки, из которой пропала часть свидетельств.
+Для загрузок отдельно замеряются запись (xml_parse) и удаление исчезнувших записей.
+
+Пример (из каталога Backend):
+python Benchmarks/bench_ingestion.py --certificates 2000 --output bench_results.json
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(BACKEND_DIR)
+
+import generate_registry  # noqa: E402
+import config  # noqa: E402
+
+
+def peak_rss_mb() -> float:
+    """Пиковый объем резидентной памяти процесса и его дочерних процессов (пул разбора), МБ"""
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(max(own, children) / 1024, 1)
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+class StageTimer:
+    def __init__(self):
+        self.stages = []
+
+    def add(self, name: str, seconds: float, records: int) -> None:
+        stage = {
+            "name": name,
+            "seconds": round(seconds, 3),
+            "records": records,
+            "records_per_second": round(records / seconds) if seconds else None,
+            "peak_rss_mb": peak_rss_mb(),
+        }
+        self.stages.append(stage)
+        print(f"{name:<20} {stage['seconds']:>9.3f} с {records:>9} записей "
+              f"{stage['records_per_second'] or 0:>9} зап/с {stage['peak_rss_mb']:>8} МБ")
+
+
+async def run_benchmark(args, work_dir: str) -> dict:
+    config.DATABASE_URL = f"sqlite+aiosqlite:///{os.path.join(work_dir, 'bench.sqlite3')}"
+    config.SNAPSHOT_ENABLED = args.snapshots
+    config.SNAPSHOT_DIR = os.path.join(work_dir, "snapshots")
+    config.PARSE_WORKERS = args.workers
+    config.REFRESH_MODE = args.refresh_mode
+    # Модули, читающие config при импорте, загружаются после подмены настроек
+    import db_tables as dbt
+    import parser
+
+    files = {
+        "initial": (os.path.join(work_dir, "registry.xml"), args.certificates, 0),
+        "changed": (os.path.join(work_dir, "registry_rev1.xml"), args.certificates, 1),
+        "shrunk": (os.path.join(work_dir, "registry_shrunk.xml"), int(args.certificates * 0.9), 1),
+    }
+    for filename, certificates, revision in files.values():
+        generate_registry.write_registry(filename, certificates, args.supplements, args.programs,
+                                         seed=args.seed, revision=revision)
+    timer = StageTimer()
+
+    start = time.perf_counter()
+    records = 0
+    for univ_models, eduprog_models in parser.iter_parsed_batches(files["initial"][0], workers=args.workers):
+        records += len(univ_models) + len(eduprog_models)
+    timer.add("parse", time.perf_counter() - start, records)
+
+    await dbt.create_tables()
+    summaries = {}
+    for stage, filename in (("initial", files["initial"][0]), ("unchanged", files["initial"][0]),
+                            ("changed", files["changed"][0]), ("shrunk", files["shrunk"][0])):
+        start = time.perf_counter()
+        if args.refresh_mode == "shadow":
+            await dbt.create_shadow_tables()
+            univ_changes, eduprog_changes = await parser.xml_parse(filename=filename, shadow=True)
+            timer.add(f"{stage}.write", time.perf_counter() - start,
+                      len(univ_changes.actual_ids) + len(eduprog_changes.actual_ids))
+            start = time.perf_counter()
+            univ_changes.removed, eduprog_changes.removed = await dbt.swap_shadow_tables()
+            timer.add(f"{stage}.swap", time.perf_counter() - start, univ_changes.removed + eduprog_changes.removed)
+        else:
+            univ_changes, eduprog_changes = await parser.xml_parse(filename=filename)
+            timer.add(f"{stage}.write", time.perf_counter() - start,
+                      len(univ_changes.actual_ids) + len(eduprog_changes.actual_ids))
+            start = time.perf_counter()
+            univ_changes.removed, eduprog_changes.removed = await dbt.delete_missing_registry_records(
+                actual_univs_id=univ_changes.actual_ids,
+                actual_eduprogs_id=eduprog_changes.actual_ids,
+            )
+            timer.add(f"{stage}.delete", time.perf_counter() - start,
+                      univ_changes.removed + eduprog_changes.removed)
+        summaries[stage] = {"universities": univ_changes.summary(),
+                            "educational_programs": eduprog_changes.summary()}
+
+    return {
+        "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "settings": {
+            "certificates": args.certificates,
+            "supplements": args.supplements,
+            "programs": args.programs,
+            "seed": args.seed,
+            "workers": args.workers,
+            "batch_size": config.PARSE_BATCH_SIZE,
+            "refresh_mode": args.refresh_mode,
+            "snapshots": args.snapshots,
+            "xml_size_mb": round(os.path.getsize(files["initial"][0]) / 2 ** 20, 1),
+        },
+        "stages": timer.stages,
+        "changes": summaries,
+    }
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Замер скорости загрузки выгрузки реестра в БД")
+    arg_parser.add_argument("--certificates", type=int, default=1000)
+    arg_parser.add_argument("--supplements", type=int, default=3)
+    arg_parser.add_argument("--programs", type=int, default=20)
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--workers", type=int, default=config.PARSE_WORKERS)
+    arg_parser.add_argument("--refresh-mode", choices=["inplace", "shadow"], default=config.REFRESH_MODE)
+    arg_parser.add_argument("--snapshots", action="store_true", help="Использовать снимки разобранной выгрузки")
+    arg_parser.add_argument("--work-dir", default=None, help="Каталог для выгрузок и БД (по умолчанию временный)")
+    arg_parser.add_argument("--output", default="bench_results.json")
+    args = arg_parser.parse_args()
+
+    if args.work_dir:
+        os.makedirs(args.work_dir, exist_ok=True)
+        results = asyncio.run(run_benchmark(args, os.path.abspath(args.work_dir)))
+    else:
+        with tempfile.TemporaryDirectory() as work_dir:
+            results = asyncio.run(run_benchmark(args, work_dir))
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"Результаты записаны в {os.path.abspath(args.output)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""
+Генератор синтетической выгрузки реестра аккредитации в формате Рособрнадзора.
+При одних и тех же параметрах всегда получается один и тот же файл.
+
+Пример:
+python generate_registry.py --certificates 5000 --supplements 3 --programs 20 --output registry.xml
+"""
+import argparse
+import random
+from xml.sax.saxutils import escape
+
+
+EDU_LEVELS = [
+    "Высшее образование - бакалавриат",
+    "Высшее образование - специалитет",
+    "Высшее образование - магистратура",
+    "Высшее образование - подготовка кадров высшей квалификации",
+    "Среднее профессиональное образование",
+]
+REGIONS = ["г. Москва", "г. Санкт-Петербург", "Новосибирская область", "Свердловская область",
+           "Республика Татарстан", "Краснодарский край", "Томская область", "Приморский край"]
+KINDS = ["университет", "академия", "институт"]
+
+
+def element(tag: str, value) -> str:
+    if value is None or value == "":
+        return f"<{tag}/>"
+    return f"<{tag}>{escape(str(value))}</{tag}>"
+
+
+def edu_org(org_id: str, number: int, revision: int, is_branch: bool = False, head_id: str = "",
+            college: bool = False) -> str:
+    kind = KINDS[number % len(KINDS)]
+    if college:
+        full_name = f"Государственное бюджетное профессиональное образовательное учреждение Колледж №{number}"
+        type_name = "Профессиональная образовательная организация"
+    else:
+        full_name = (f"Федеральное государственное бюджетное образовательное учреждение высшего образования "
+                     f"«Государственный {kind} №{number}»")
+        type_name = "Образовательная организация высшего образования"
+    if is_branch:
+        full_name = f"Филиал {full_name}"
+    # Каждая ревизия меняет телефон у каждой десятой организации
+    phone = f"+7 (495) {number:03d}-{(revision if number % 10 == 0 else 0):02d}-00"
+    return "".join([
+        "<ActualEducationOrganization>",
+        element("Id", org_id),
+        element("FullName", full_name),
+        element("ShortName", f"{'Ф' if is_branch else ''}Г{kind[0].upper()}{number}"),
+        element("HeadEduOrgId", head_id),
+        element("IsBranch", int(is_branch)),
+        element("PostAddress", f"{100000 + number}, {REGIONS[number % len(REGIONS)]}, ул. Ленина, д. {number % 200}"),
+        element("Phone", phone),
+        element("Fax", ""),
+        element("Email", f"info{number}@example.ru"),
+        element("WebSite", f"https://univ{number}.example.ru"),
+        element("OGRN", 1020000000000 + number),
+        element("INN", 7700000000 + number),
+        element("KPP", 770001001),
+        element("HeadPost", "Ректор"),
+        element("HeadName", f"Иванов Иван Иванович {number}"),
+        element("FormName", "Федеральное государственное бюджетное учреждение"),
+        element("KindName", kind.capitalize()),
+        element("TypeName", type_name),
+        element("RegionName", REGIONS[number % len(REGIONS)]),
+        element("FederalDistrictName", "Центральный федеральный округ"),
+        "</ActualEducationOrganization>",
+    ])
+
+
+def educational_program(prog_id: str, rng: random.Random, number: int, revision: int) -> str:
+    level = EDU_LEVELS[rng.randrange(len(EDU_LEVELS))]
+    ugs = rng.randrange(1, 58)
+    code = f"{ugs:02d}.0{rng.randrange(3, 7)}.{rng.randrange(1, 20):02d}"
+    # Каждая ревизия меняет название у каждой двадцатой программы
+    name = f"Направление подготовки {code}" + (f" (ред. {revision})" if number % 20 == 0 and revision else "")
+    return "".join([
+        "<EducationalProgram>",
+        element("Id", prog_id),
+        element("TypeName", "Основная образовательная программа"),
+        element("EduLevelName", level),
+        element("ProgrammName", name),
+        element("ProgrammCode", code),
+        element("UGSName", f"Укрупненная группа {ugs:02d}"),
+        element("UGSCode", f"{ugs:02d}.00.00"),
+        element("EduNormativePeriod", rng.choice(["4 г.", "5 л.", "2 г."])),
+        element("Qualification", rng.choice(["Бакалавр", "Специалист", "Магистр"])),
+        element("IsAccredited", rng.choice(["", "0"])),
+        element("IsCanceled", "0"),
+        element("IsSuspended", "0"),
+        "</EducationalProgram>",
+    ])
+
+
+def write_registry(output: str, certificates: int, supplements: int, programs: int,
+                   seed: int = 0, revision: int = 0) -> None:
+    """
+    Записывает выгрузку.
+    certificates: число свидетельств; supplements: приложений на свидетельство; programs: ОП на приложение.
+    revision: номер ревизии - при том же seed меняет часть полей, остальные записи совпадают.
+    """
+    with open(output, "w", encoding="utf-8") as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n<OpenData><Certificates>')
+        for cert_number in range(certificates):
+            rng = random.Random(f"{seed}-{cert_number}")
+            head_id = f"org-{seed}-{cert_number}"
+            college = rng.random() < 0.05
+            status = "Действующее" if rng.random() < 0.9 else "Приостановлено"
+            end_date = "" if rng.random() < 0.95 else "2001-01-01"
+            f.write("<Certificate>")
+            f.write(element("Id", f"cert-{seed}-{cert_number}"))
+            f.write(element("StatusName", status))
+            f.write(element("EndDate", end_date))
+            f.write(edu_org(head_id, cert_number, revision, college=college))
+            f.write("<Supplements>")
+            for suppl_number in range(supplements):
+                # Первое приложение - головная организация, остальные - филиалы
+                is_branch = suppl_number > 0
+                org_id = f"{head_id}-{suppl_number}" if is_branch else head_id
+                f.write("<Supplement>")
+                f.write(element("StatusName", "Действующее" if rng.random() < 0.95 else "Недействующее"))
+                f.write(edu_org(org_id, cert_number, revision, is_branch=is_branch,
+                                head_id=head_id if is_branch else "", college=college))
+                f.write("<EducationalPrograms>")
+                for prog_number in range(programs):
+                    prog_id = f"prog-{seed}-{cert_number}-{suppl_number}-{prog_number}"
+                    f.write(educational_program(prog_id, rng, prog_number, revision))
+                f.write("</EducationalPrograms></Supplement>")
+            f.write("</Supplements></Certificate>\n")
+        f.write("</Certificates></OpenData>\n")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Генерирует синтетическую выгрузку реестра аккредитации")
+    arg_parser.add_argument("--certificates", type=int, default=1000)
+    arg_parser.add_argument("--supplements", type=int, default=3)
+    arg_parser.add_argument("--programs", type=int, default=20)
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--revision", type=int, default=0)
+    arg_parser.add_argument("--output", default="registry.xml")
+    args = arg_parser.parse_args()
+    write_registry(args.output, args.certificates, args.supplements, args.programs, args.seed, args.revision)
+    print(f"Выгрузка записана в {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Проверка скачивания архива на локальном сервере, который подменяет портал Рособрнадзора.
+Сервер поддерживает Range и условные запросы и обрывает соединение на середине первых ответов.
+Запуск из каталога Backend: python Tests/download_resume.py
+"""
+import asyncio
+import base64
+import hashlib
+import io
+import os
+import sys
+import tempfile
+import zipfile
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import downloader  # noqa: E402
+
+PORT = 8765
+URL = f"http://localhost:{PORT}/opendata/"
+
+
+def make_archive() -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as zip_file:
+        zip_file.writestr("data.xml", os.urandom(5 * 1024 * 1024))
+    return buffer.getvalue()
+
+
+def make_app(data: bytes, drops: int, send_digest: bool = True, corrupt: int = 0,
+             send_etag: bool = True) -> web.Application:
+    state = {"drops": drops, "corrupt": corrupt, "requests": []}
+    digest = base64.b64encode(hashlib.sha256(data).digest()).decode()
+    etag = f'"{hashlib.sha256(data).hexdigest()[:16]}"'
+
+    async def handler(request: web.Request) -> web.StreamResponse:
+        state["requests"].append(request.headers.get("Range") or request.headers.get("If-None-Match"))
+        if send_etag and request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304)
+        body = data
+        if state["corrupt"]:
+            state["corrupt"] -= 1
+            body = data[:100] + b"\0" * 10 + data[110:]
+        start = 0
+        if "Range" in request.headers and request.headers.get("If-Range") in (None, etag):
+            start = int(request.headers["Range"].removeprefix("bytes=").rstrip("-"))
+            if start >= len(body):
+                return web.Response(status=416, headers={"Content-Range": f"bytes */{len(body)}"})
+            response = web.StreamResponse(status=206, headers={
+                "Content-Range": f"bytes {start}-{len(body) - 1}/{len(body)}"})
+        else:
+            response = web.StreamResponse(status=200)
+        if send_etag:
+            response.headers["ETag"] = etag
+        if send_digest:
+            response.headers["Repr-Digest"] = f"sha-256=:{digest}:"
+        response.content_length = len(body) - start
+        await response.prepare(request)
+        if state["drops"]:
+            state["drops"] -= 1
+            await response.write(body[start:start + (len(body) - start) // 2])
+            request.transport.close()
+            return response
+        await response.write(body[start:])
+        return response
+
+    app = web.Application()
+    app.router.add_get("/opendata/", handler)
+    app["state"] = state
+    return app
+
+
+async def run_case(title: str, data: bytes, previous: dict | None = None, **app_kwargs) -> dict | None:
+    print(title)
+    app = make_app(data, **app_kwargs)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "localhost", PORT).start()
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            archive_path = os.path.join(tmp_dir, "data.zip")
+            result = await downloader.download_archive(URL, archive_path, previous)
+            print("  запросы (Range/If-None-Match):", app["state"]["requests"])
+            if result is None:
+                print("  архив не изменился")
+                return None
+            with open(archive_path, "rb") as f:
+                print("  совпадает:", f.read() == data)
+            print("  временные файлы удалены:", os.listdir(tmp_dir) == ["data.zip"])
+            return result[1]
+    finally:
+        await runner.cleanup()
+
+
+async def main():
+    downloader.DOWNLOAD_RETRY_DELAY = 0
+    data = make_archive()
+    state = await run_case("TEST 1 Скачивание без обрывов - OK", data, drops=0)
+    await run_case("TEST 2 Два обрыва, продолжение по Range - OK", data, drops=2)
+    await run_case("TEST 3 Обрыв без заголовка Digest, проверка размера и zip - OK", data, drops=1,
+                   send_digest=False)
+    await run_case("TEST 4 Поврежденный архив скачивается заново - OK", data, drops=0, corrupt=1)
+    await run_case("TEST 5 Архив не изменился, ответ 304 - OK", data, previous=state, drops=0)
+    await run_case("TEST 6 Сервер без ETag, архив совпал по sha256 - OK", data, previous=state, drops=0,
+                   send_etag=False)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -6,8 +6,10 @@ import pydantic
 from typing import Any
 
 from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
 
-from database import asyncDBSession
+from database import session_scope, transaction
 import db_tables as dbt
 
 
@@ -57,31 +59,35 @@ def verify_password(password_hash, password) -> bool:
         return False
 
 
-async def verify_session(session_data: str) -> SessionData | None:
-    """Возвращает объект User, id сессии и сессионный токен, если сессия действительна, иначе None"""
+async def verify_session(session_data: str, db_session: AsyncSession = None) -> SessionData | None:
+    """
+    Возвращает объект User, id сессии и сессионный токен, если сессия действительна, иначе None.
+    Объект User отсоединен от db_session: он остается доступен и после отката изменений в той же сессии.
+    """
     if not session_data:
         return None
     session_id, session_token = session_data.split("&")
-    async with asyncDBSession() as db_session:
-        stmt = select(dbt.Session).where(dbt.Session.id == session_id)
+    async with session_scope(db_session) as db_session:
+        stmt = select(dbt.Session).where(dbt.Session.id == session_id).options(joinedload(dbt.Session.user))
         result = await db_session.execute(stmt)
         session = result.scalars().first()
-        if not session or session.is_active == 0:
+        if not session or session.is_active == 0 or session.user is None:
             return None
         if not verify_password(session.token_hash, session_token):
             return None
         current_time = int(time.time())
         if current_time > session.expiration_time:
-            session.is_active = 0
-            db_session.commit()
+            async with transaction(db_session):
+                session.is_active = 0
             return None
-        user = await dbt.User.get_by_id(session.user_id)
+        user = session.user
+        db_session.expunge(user)
         return SessionData(user=user, session_id=session_id, session_token=session_token)
 
 
-async def verify_reset_token(user_id: str, token: str) -> None:
+async def verify_reset_token(user_id: str, token: str, db_session: AsyncSession = None) -> None:
     """Верифицирует данные, необходимые для предоставления завершения регистрации пользователю"""
-    user = await dbt.User.get_by_id(id=user_id)
+    user = await dbt.User.get_by_id(id=user_id, db_session=db_session)
     if not user or not verify_password(user.password_hash, token):
         raise WrongDataError
     expiration_time = int(token.split("-")[1])
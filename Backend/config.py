@@ -5,13 +5,51 @@ PORT = 8000
 PREFIX = "http"
 DATABASE_URL = "sqlite+aiosqlite:///../Database/database4.sqlite3"
 DEFAULT_PAGE_SIZE = 40
-DATAFILENAME = None
+LIST_COUNT_CACHE_SIZE = 1000  # Сколько наборов фильтров списков хранят число записей (для числа страниц)
+LIST_COUNT_CACHE_TTL = 60  # Сколько секунд хранить число записей списка; изменения других экземпляров видны не позже
+PARSE_BATCH_SIZE = 5000  # Число записей в пачке, которую парсер передает в БД
+REGISTRY_LOOKUP_CHUNK = 500  # Сколько id передавать в одном IN (...) при чтении сохраненных хешей записей реестра
+PARSE_WORKERS = os.cpu_count() or 1  # Число процессов для разбора выгрузки (1 - разбор в одном потоке)
+REFRESH_MODE = "inplace"  # "inplace" - обновление рабочих таблиц, "shadow" - сборка теневых таблиц и их подмена
+PARSE_CHUNK_SIZE = 200  # Число свидетельств, которое передается одному процессу за раз
+DATA_DIR = "../Downloads/"
+DATAFILENAME = None  # Путь к выгрузке; если не задан, берется последняя выгрузка из DATA_DIR
+PARSE_FROM_ARCHIVE = True  # Разбирать XML прямо из скачанного zip-архива, не распаковывая его на диск
+PIPELINED_INGESTION = True  # Разбирать архив и писать в БД по мере скачивания, а не после него
+# (если по ETag и Last-Modified не видно, что архив изменился, он все же сначала скачивается и сверяется по sha256)
+PIPELINE_BUFFER_SIZE = 16 * 1024 * 1024  # Сколько скачанных байт может ждать разбора
+PIPELINE_QUEUE_SIZE = 2  # Сколько разобранных пачек может ждать записи в БД
+WORKER_PROGRESS_INTERVAL = 1  # Как часто процесс обновления данных сообщает серверу о ходе запуска, секунды
+WORKER_STOP_TIMEOUT = 30  # Сколько ждать завершения процесса обновления данных при остановке сервера, секунды
+SCHEDULER_LEASE_TTL = 60  # На сколько секунд экземпляр сервера становится ведущим для периодического обновления
+SCHEDULER_LEASE_RENEW_INTERVAL = 15  # Как часто ведущий продлевает аренду, а остальные проверяют, свободна ли она
+REFRESH_LOCK_TTL = 120  # Через сколько секунд без продления блокировка обновления данных считается брошенной
+REFRESH_LOCK_RENEW_INTERVAL = 5  # Как часто экземпляр, выполняющий обновление, продлевает блокировку и пишет ход
+# выполнения, а остальные читают его и передают отмену
+EVENTS_QUEUE_SIZE = 100  # Сколько событий может ждать отправки одному подписчику; старые отбрасываются
+EVENTS_HEARTBEAT_INTERVAL = 15  # Как часто отправлять подписчикам пустой комментарий, чтобы соединение не закрылось
+SNAPSHOT_ENABLED = True  # Сохранять разобранную выгрузку и не разбирать повторно тот же файл
+SNAPSHOT_DIR = "../Downloads/snapshots/"
 DB_ECHO = False
+DB_READ_POOL_SIZE = 8  # Сколько соединений с БД одновременно обслуживают чтение; остальные запросы ждут свободного
+DB_POOL_TIMEOUT = 30  # Сколько секунд ждать свободного соединения (для записи оно одно на процесс)
+SQLITE_JOURNAL_MODE = "WAL"  # WAL: чтение не ждет записи (в том числе обновления данных из реестра) и наоборот
+SQLITE_SYNCHRONOUS = "NORMAL"  # В режиме WAL сбой питания может отменить последние транзакции, но не повредит БД
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024  # Сколько байт файла БД читать через отображение в память (0 - не использовать)
+SQLITE_CACHE_SIZE = -32 * 1024  # Кеш страниц каждого соединения: больше 0 - в страницах, меньше 0 - в КиБ
+SQLITE_BUSY_TIMEOUT = 30  # Сколько секунд ждать, пока другой процесс (обновление данных) освободит БД для записи
 FRONT_CATALOG_NAME = "Frontend"
 RESOURCES_RELATIVE_CATALOG = f"../{FRONT_CATALOG_NAME}/"
 DISABLE_FOREIGN_KEY_CONSTRAINT = True
 TEMPLATES_CACHE_ENABLED = True
 
-for filename in os.listdir("../Downloads/"):
-      if filename.lower().endswith(".xml"):
-        DATAFILENAME = f"../Downloads/{filename}"
+
+def find_data_file() -> str | None:
+    """Возвращает DATAFILENAME или самый свежий XML-файл или zip-архив выгрузки в DATA_DIR"""
+    if DATAFILENAME:
+        return DATAFILENAME
+    if not os.path.isdir(DATA_DIR):
+        return None
+    candidates = [os.path.join(DATA_DIR, filename) for filename in os.listdir(DATA_DIR)
+                  if filename.lower().endswith((".xml", ".zip"))]
+    return max(candidates, key=os.path.getmtime, default=None)
@@ -2,6 +2,7 @@ from typing import Annotated, Any
 from pydantic import BaseModel, BeforeValidator, field_validator, model_validator
 from typing import Type
 import re
+import hashlib
 from exceptions import NotUnivError
 
 
@@ -24,6 +25,11 @@ def base2model(base, model_class: Type[BaseModel], **kwargs):
     return model_class.model_validate(dictionary)
 
 
+def fingerprint(model: BaseModel) -> str:
+    """Возвращает хеш содержимого полей модели (используется для поиска изменившихся записей реестра)"""
+    return hashlib.blake2b(model.model_dump_json().encode(), digest_size=16).hexdigest()
+
+
 class UserProfileData(BaseModel):
     """Данные для личного профиля пользователя"""
     username: str
@@ -239,3 +245,21 @@ class EduProg(BaseModel):
 class EduProgForView(EduProg):
     """Данные об образовательной программе для клиента"""
     university_full_name: str
+
+
+class RegistryChanges(BaseModel):
+    """Изменения одной таблицы при обновлении данных из реестра"""
+    actual_ids: set[str] = set()
+    inserted_ids: set[str] = set()
+    changed_ids: set[str] = set()
+    removed: int = 0
+
+    def summary(self) -> dict[str, int]:
+        """Число добавленных, измененных, неизменных и удаленных записей"""
+        changed_ids = self.changed_ids - self.inserted_ids
+        return {
+            "inserted": len(self.inserted_ids),
+            "changed": len(changed_ids),
+            "unchanged": len(self.actual_ids - self.inserted_ids - changed_ids),
+            "removed": self.removed,
+        }
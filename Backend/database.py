@@ -1,17 +1,103 @@
+"""
+Engines and sessions of the SQLite database.
+Writes go through engine, which has a single connection per process: writers of the process wait for it
+in the pool instead of contending for the file lock. Reads go through read_engine, a bounded pool of connections
+that only read (PRAGMA query_only). In WAL mode readers see the last committed data and never wait for
+the writer, including the registry refresh running in the worker process.
+Sessions route their statements themselves (RoutingSession), so handlers and db_tables do not choose an engine.
+"""
+from contextlib import asynccontextmanager
+from functools import partial
+from typing import AsyncIterator
 import sqlalchemy
-from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
+from sqlalchemy.orm import Session
 import config
 
 
-engine = create_async_engine(config.DATABASE_URL, echo=config.DB_ECHO)
-asyncDBSession = async_sessionmaker(engine, expire_on_commit=False)
+_connect_args = {"timeout": config.SQLITE_BUSY_TIMEOUT}
+engine = create_async_engine(config.DATABASE_URL, echo=config.DB_ECHO, connect_args=_connect_args,
+                             pool_size=1, max_overflow=0, pool_timeout=config.DB_POOL_TIMEOUT)
+read_engine = create_async_engine(config.DATABASE_URL, echo=config.DB_ECHO, connect_args=_connect_args,
+                                  pool_size=config.DB_READ_POOL_SIZE, max_overflow=0,
+                                  pool_timeout=config.DB_POOL_TIMEOUT)
 
+_WRITING = "writing"
 
-@sqlalchemy.event.listens_for(engine.sync_engine, "connect")
-def _set_sqlite_pragma(dbapi_connection, connection_record):
-    if config.DISABLE_FOREIGN_KEY_CONSTRAINT:
+
+class RoutingSession(Session):
+    """
+    Sends SELECT statements to read_engine and everything else (flushes, INSERT/UPDATE/DELETE, DDL, text SQL)
+    to engine. Once a transaction has written, the rest of it goes to engine too, so it reads its own changes
+    and its temporary tables. A session bound explicitly (bind=connection) always uses that bind.
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self.bind is not None:
+            return super().get_bind(mapper, clause=clause, **kwargs)
+        if (not self.info.get(_WRITING) and not self._flushing
+                and isinstance(clause, (sqlalchemy.Select, sqlalchemy.CompoundSelect))):
+            return read_engine.sync_engine
+        self.info[_WRITING] = True
+        return engine.sync_engine
+
+
+@sqlalchemy.event.listens_for(RoutingSession, "after_transaction_end")
+def _end_writing(session: Session, session_transaction) -> None:
+    if session_transaction.parent is None:
+        session.info.pop(_WRITING, None)
+
+
+asyncDBSession = async_sessionmaker(sync_session_class=RoutingSession, expire_on_commit=False)
+
+
+async def get_db_session() -> AsyncIterator[AsyncSession]:
+    """
+    FastAPI dependency: one session per request, shared by the handler and its dependencies
+    (FastAPI resolves a dependency once per request) and passed on to the db_tables methods
+    """
+    async with asyncDBSession() as db_session:
+        yield db_session
+
+
+@asynccontextmanager
+async def session_scope(db_session: AsyncSession = None) -> AsyncIterator[AsyncSession]:
+    """Yields db_session, or a new session that is closed on exit if db_session is None"""
+    if db_session is not None:
+        yield db_session
         return
+    async with asyncDBSession() as db_session:
+        yield db_session
+
+
+@asynccontextmanager
+async def transaction(db_session: AsyncSession) -> AsyncIterator[AsyncSession]:
+    """
+    Unit of work: commits the changes made in the block, or rolls them back on error.
+    Unlike db_session.begin(), works in a session that has already begun a transaction,
+    e.g. in the request session after reading from it.
+    """
+    try:
+        yield db_session
+    except BaseException:
+        await db_session.rollback()
+        raise
+    await db_session.commit()
+
+
+def _set_sqlite_pragma(dbapi_connection, connection_record, read_only: bool):
     cursor = dbapi_connection.cursor()
-    cursor.execute("PRAGMA foreign_keys=ON;")
+    cursor.execute(f"PRAGMA journal_mode={config.SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous={config.SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA mmap_size={int(config.SQLITE_MMAP_SIZE)}")
+    cursor.execute(f"PRAGMA cache_size={int(config.SQLITE_CACHE_SIZE)}")
+    if read_only:
+        cursor.execute("PRAGMA query_only=ON")
+    if not config.DISABLE_FOREIGN_KEY_CONSTRAINT:
+        cursor.execute("PRAGMA foreign_keys=ON;")
+        print("PRAGMA foreign_keys=ON;")
     cursor.close()
-    print("PRAGMA foreign_keys=ON;")
+
+
+sqlalchemy.event.listen(engine.sync_engine, "connect", partial(_set_sqlite_pragma, read_only=False))
+sqlalchemy.event.listen(read_engine.sync_engine, "connect", partial(_set_sqlite_pragma, read_only=True))
@@ -1,20 +1,28 @@
 import asyncio
-from sqlalchemy.ext.asyncio import AsyncAttrs, AsyncConnection
+from contextlib import asynccontextmanager
+import sqlalchemy
+from sqlalchemy.ext.asyncio import AsyncAttrs, AsyncConnection, AsyncSession
 from sqlalchemy.orm import DeclarativeBase, selectinload
 from sqlalchemy.orm import relationship
 from sqlalchemy import ForeignKey, update
-from sqlalchemy import Column, Integer, String
-from sqlalchemy.dialects.sqlite import TEXT
+from sqlalchemy import Column, Integer, String, Index
+from sqlalchemy.dialects.sqlite import TEXT, insert as sqlite_insert
 from sqlalchemy import event
-from sqlalchemy import select
+from sqlalchemy import select, text, or_
+from sqlalchemy.schema import CreateTable
 import uuid
 import datetime
 import time
 import pytz
 from typing import Optional
 import auth
-from database import engine, asyncDBSession
+import config
+from database import engine, asyncDBSession, session_scope, transaction
 import data_models as dm
+import metrics
+import migrations
+import fulltext
+import pagination
 from exceptions import *
 
 
@@ -24,17 +32,252 @@ def provide_uuid() -> str:
 
 
 async def create_tables():
-    """Creates all declared tables"""
+    """Creates all declared tables and brings an existing database file up to date (see migrations)"""
     async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(migrations.migrate, Base.metadata)
     await refresh_tip_tables()
     print("Таблицы созданы")
 
 
+async def upsert_registry_batch(univ_models: list[dm.University], eduprog_models: list[dm.EduProg],
+                                univ_changes: dm.RegistryChanges, eduprog_changes: dm.RegistryChanges,
+                                shadow: bool = False) -> None:
+    """
+    Writes a batch of registry records in one transaction.
+    Only new records and records whose registry data has changed are written.
+    :param shadow: True if the records are written to the shadow tables being built (see create_shadow_tables).
+    """
+    if not shadow:
+        async with asyncDBSession() as db_session:
+            async with db_session.begin():
+                await University.bulk_upsert(db_session, univ_models, univ_changes)
+                await EduProg.bulk_upsert(db_session, eduprog_models, eduprog_changes)
+        return
+    # Foreign keys of the shadow tables point at the live universities table until the swap
+    async with _foreign_keys_off_connection() as conn:
+        async with asyncDBSession(bind=conn) as db_session:
+            async with db_session.begin():
+                await University.bulk_upsert(db_session, univ_models, univ_changes, target=shadow_table(University))
+                await EduProg.bulk_upsert(db_session, eduprog_models, eduprog_changes, target=shadow_table(EduProg))
+
+
+@asynccontextmanager
+async def _foreign_keys_off_connection():
+    """Yields a connection with foreign key enforcement turned off, restores the setting afterwards"""
+    async with engine.connect() as conn:
+        await conn.exec_driver_sql("PRAGMA foreign_keys=OFF")
+        await conn.commit()
+        try:
+            yield conn
+        finally:
+            if not config.DISABLE_FOREIGN_KEY_CONSTRAINT:
+                await conn.exec_driver_sql("PRAGMA foreign_keys=ON")
+                await conn.commit()
+
+
+async def delete_missing_registry_records(actual_univs_id: set[str],
+                                          actual_eduprogs_id: set[str]) -> tuple[int, int]:
+    """
+    Removes registry records that are absent from the current import with a few bulk statements.
+    Ids of the import are staged in temporary tables, custom records are kept.
+    As in University.delete, branches and educational programs of a removed university are removed with it.
+    :return: the number of removed universities and educational programs.
+    """
+    async with asyncDBSession() as db_session:
+        async with db_session.begin():
+            for table_name, ids in (("import_univ_ids", actual_univs_id), ("import_eduprog_ids", actual_eduprogs_id)):
+                await db_session.execute(text(f"CREATE TEMP TABLE IF NOT EXISTS {table_name} (id TEXT PRIMARY KEY)"))
+                await db_session.execute(text(f"DELETE FROM {table_name}"))
+                if ids:
+                    await db_session.execute(text(f"INSERT INTO {table_name} (id) VALUES (:id)"),
+                                             [{"id": id} for id in ids])
+            await db_session.execute(text("CREATE TEMP TABLE IF NOT EXISTS stale_univ_ids (id TEXT PRIMARY KEY)"))
+            await db_session.execute(text("DELETE FROM stale_univ_ids"))
+            await db_session.execute(text(
+                "INSERT INTO stale_univ_ids (id) SELECT id FROM universities "
+                "WHERE custom = 0 AND id NOT IN (SELECT id FROM import_univ_ids)"
+            ))
+            await db_session.execute(text(
+                "INSERT OR IGNORE INTO stale_univ_ids (id) SELECT id FROM universities "
+                "WHERE head_edu_org_id IN (SELECT id FROM stale_univ_ids)"
+            ))
+            cascade_result = await db_session.execute(text(
+                "DELETE FROM educational_programs WHERE university_id IN (SELECT id FROM stale_univ_ids)"
+            ))
+            univs_result = await db_session.execute(text(
+                "DELETE FROM universities WHERE id IN (SELECT id FROM stale_univ_ids)"
+            ))
+            eduprogs_result = await db_session.execute(text(
+                "DELETE FROM educational_programs "
+                "WHERE custom = 0 AND id NOT IN (SELECT id FROM import_eduprog_ids)"
+            ))
+            for table_name in ("import_univ_ids", "import_eduprog_ids", "stale_univ_ids"):
+                await db_session.execute(text(f"DROP TABLE {table_name}"))
+    return univs_result.rowcount, cascade_result.rowcount + eduprogs_result.rowcount
+
+
+async def _write_changed_rows(db_session: AsyncSession, table: sqlalchemy.Table, rows: list[dict],
+                             changes: dm.RegistryChanges, target: sqlalchemy.Table = None) -> None:
+    """
+    Compares registry_hash of the rows with the stored one and upserts only new and changed rows.
+    Custom records with the same id are left as is.
+    :param target: shadow table; if given, all rows are written to it, the changes are still counted against table.
+    """
+    rows = list({row["id"]: row for row in rows}.values())
+    inserted_rows = []
+    changed_rows = []
+    with metrics.stage("update"):
+        stored = {}
+        for i in range(0, len(rows), config.REGISTRY_LOOKUP_CHUNK):
+            ids = [row["id"] for row in rows[i:i + config.REGISTRY_LOOKUP_CHUNK]]
+            result = await db_session.execute(select(table.c.id, table.c.registry_hash, table.c.custom)
+                                              .where(table.c.id.in_(ids)))
+            stored.update({id: (registry_hash, custom) for id, registry_hash, custom in result})
+        for row in rows:
+            changes.actual_ids.add(row["id"])
+            if row["id"] not in stored:
+                changes.inserted_ids.add(row["id"])
+                inserted_rows.append(row)
+            elif not stored[row["id"]][1] and stored[row["id"]][0] != row["registry_hash"]:
+                changes.changed_ids.add(row["id"])
+                changed_rows.append(row)
+    if target is not None:
+        table, inserted_rows, changed_rows = target, rows, []
+    if inserted_rows:
+        with metrics.stage("insert") as stage_metrics:
+            stage_metrics.records += len(inserted_rows)
+            await db_session.execute(_registry_upsert_stmt(table, inserted_rows), inserted_rows)
+    if changed_rows:
+        with metrics.stage("update") as stage_metrics:
+            stage_metrics.records += len(changed_rows)
+            await db_session.execute(_registry_upsert_stmt(table, changed_rows), changed_rows)
+
+
+def _registry_upsert_stmt(table: sqlalchemy.Table, rows: list[dict]):
+    """
+    INSERT ... ON CONFLICT DO UPDATE for registry rows.
+    Custom records are never overwritten, the deleted flag set by the user is kept.
+    """
+    stmt = sqlite_insert(table)
+    return stmt.on_conflict_do_update(
+        index_elements=[table.c.id],
+        set_={name: stmt.excluded[name] for name in rows[0] if name not in ("id", "custom", "deleted")},
+        where=table.c.custom == 0,
+    )
+
+
+def shadow_table(model) -> sqlalchemy.Table:
+    """Returns the shadow copy of the model table, used to build a new version of the registry data"""
+    name = model.__tablename__ + SHADOW_SUFFIX
+    if name not in _shadow_metadata.tables:
+        model.__table__.to_metadata(_shadow_metadata, name=name)
+    return _shadow_metadata.tables[name]
+
+
+async def create_shadow_tables() -> None:
+    """
+    Creates empty shadow tables for universities and educational programs
+    and copies custom records into them; swap_shadow_tables copies them again to catch edits made during the build.
+    """
+    async with asyncDBSession() as db_session:
+        async with db_session.begin():
+            for model in (University, EduProg):
+                table = model.__table__
+                shadow_name = shadow_table(model).name
+                columns = ", ".join(column.name for column in table.columns)
+                create_stmt = str(CreateTable(table).compile(dialect=engine.dialect)).strip()
+                await db_session.execute(text(f"DROP TABLE IF EXISTS {shadow_name}"))
+                await db_session.execute(text(create_stmt.replace(f"CREATE TABLE {table.name} (",
+                                                                  f"CREATE TABLE {shadow_name} (", 1)))
+                await db_session.execute(text(f"INSERT INTO {shadow_name} ({columns}) "
+                                              f"SELECT {columns} FROM {table.name} WHERE custom = 1"))
+
+
+async def swap_shadow_tables() -> tuple[int, int]:
+    """
+    Carries custom records and the deleted flags over to the shadow tables and replaces the live tables with them
+    in one transaction, so readers see either the old or the new data set
+    and user edits made while the shadow tables were built are not lost.
+    As in University.delete, branches and educational programs of a removed university are removed with it.
+    The name search index (fulltext) is rebuilt for the new universities table in the same transaction.
+    :return: the number of removed universities and educational programs.
+    """
+    univ_shadow = shadow_table(University).name
+    eduprog_shadow = shadow_table(EduProg).name
+    async with _foreign_keys_off_connection() as conn:
+        # Without legacy_alter_table SQLite would rewrite the foreign keys of the new tables
+        # to point at the renamed old ones
+        await conn.exec_driver_sql("PRAGMA legacy_alter_table=ON")
+        try:
+            await conn.exec_driver_sql("BEGIN IMMEDIATE")
+            for model, shadow in ((University, univ_shadow), (EduProg, eduprog_shadow)):
+                live = model.__tablename__
+                columns = ", ".join(column.name for column in model.__table__.columns)
+                await conn.execute(text(f"DELETE FROM {shadow} WHERE custom = 1"))
+                await conn.execute(text(f"INSERT INTO {shadow} ({columns}) "
+                                        f"SELECT {columns} FROM {live} WHERE custom = 1"))
+                await conn.execute(text(
+                    f"UPDATE {shadow} SET deleted = 1 "
+                    f"WHERE custom = 0 AND id IN (SELECT id FROM {live} WHERE deleted = 1)"
+                ))
+            await conn.execute(text("CREATE TEMP TABLE IF NOT EXISTS stale_univ_ids (id TEXT PRIMARY KEY)"))
+            await conn.execute(text("DELETE FROM stale_univ_ids"))
+            await conn.execute(text(
+                f"INSERT INTO stale_univ_ids (id) SELECT id FROM universities "
+                f"WHERE id NOT IN (SELECT id FROM {univ_shadow})"
+            ))
+            await conn.execute(text(
+                f"INSERT OR IGNORE INTO stale_univ_ids (id) SELECT id FROM {univ_shadow} "
+                f"WHERE head_edu_org_id IN (SELECT id FROM stale_univ_ids)"
+            ))
+            await conn.execute(text(f"DELETE FROM {univ_shadow} WHERE id IN (SELECT id FROM stale_univ_ids)"))
+            await conn.execute(text(
+                f"DELETE FROM {eduprog_shadow} WHERE university_id IN (SELECT id FROM stale_univ_ids)"
+            ))
+            await conn.execute(text("DROP TABLE stale_univ_ids"))
+            removed_univs_count = await conn.scalar(text(
+                f"SELECT count(*) FROM universities WHERE id NOT IN (SELECT id FROM {univ_shadow})"
+            ))
+            removed_eduprogs_count = await conn.scalar(text(
+                f"SELECT count(*) FROM educational_programs WHERE id NOT IN (SELECT id FROM {eduprog_shadow})"
+            ))
+            for model, shadow in ((University, univ_shadow), (EduProg, eduprog_shadow)):
+                live = model.__tablename__
+                await conn.execute(text(f"ALTER TABLE {live} RENAME TO {live}_old"))
+                await conn.execute(text(f"ALTER TABLE {shadow} RENAME TO {live}"))
+                await conn.execute(text(f"DROP TABLE {live}_old"))
+                for index in model.__table__.indexes:
+                    await conn.run_sync(index.create)
+            await conn.run_sync(fulltext.create_triggers)
+            await conn.run_sync(fulltext.rebuild)
+            await conn.commit()
+        except Exception:
+            await conn.rollback()
+            raise
+        finally:
+            await conn.exec_driver_sql("PRAGMA legacy_alter_table=OFF")
+    return removed_univs_count, removed_eduprogs_count
+
+
 async def refresh_tip_tables():
     await Region.refresh()
     await Ugs.refresh()
     await ProgCode.refresh()
+    pagination.CountCache.invalidate()
+
+
+def invalidate_data_caches() -> None:
+    """
+    Drops cached filter lists and list counts of this process,
+    e.g. after the data was updated by another process
+    """
+    for table in (Region, Ugs, ProgCode):
+        InMemoryCache.invalidate(table.__tablename__)
+    pagination.CountCache.invalidate()
+
+
+SHADOW_SUFFIX = "_shadow"
+_shadow_metadata = sqlalchemy.MetaData()
 
 
 class Base(AsyncAttrs, DeclarativeBase):
@@ -57,25 +300,25 @@ class User(Base):
     sessions = relationship("Session", back_populates="user", cascade="all")
 
     @classmethod
-    async def get_by_id(cls, id: str) -> Optional["User"]:
+    async def get_by_id(cls, id: str, db_session: AsyncSession = None) -> Optional["User"]:
         """Returns a user record by its id"""
-        async with asyncDBSession() as db_session:
+        async with session_scope(db_session) as db_session:
             result = await db_session.execute(select(User).where(User.id == id))
             user = result.scalars().first()
             return user
 
     @classmethod
-    async def get_by_username(cls, username: str) -> Optional["User"]:
+    async def get_by_username(cls, username: str, db_session: AsyncSession = None) -> Optional["User"]:
         """Returns a record of a user who has completed registration, by their username"""
-        async with asyncDBSession() as db_session:
+        async with session_scope(db_session) as db_session:
             result = await db_session.execute(select(User).where(User.username == username,
                                                                  User.incomplete_registration == 0))
             user = result.scalars().first()
             return user
 
     @classmethod
-    async def add(cls, **data) -> "User":
-        async with asyncDBSession() as db_session:
+    async def add(cls, db_session: AsyncSession = None, **data) -> "User":
+        async with session_scope(db_session) as db_session:
             try:
                 user = User(**data)
                 db_session.add(user)
@@ -88,8 +331,9 @@ class User(Base):
                 raise e
 
     @classmethod
-    async def update_personal_data(cls, id: str, personal_data: dm.UserOwnData) -> None:
-        async with asyncDBSession() as db_session:
+    async def update_personal_data(cls, id: str, personal_data: dm.UserOwnData,
+                                   db_session: AsyncSession = None) -> None:
+        async with session_scope(db_session) as db_session:
             try:
                 update_stmt = update(User).where(User.id == id).values({
                     User.username: personal_data.username,
@@ -109,9 +353,9 @@ class User(Base):
                 raise e
 
     @classmethod
-    async def update_password_hash(cls, id: str, password_hash: str) -> None:
-        async with asyncDBSession() as db_session:
-            async with db_session.begin():
+    async def update_password_hash(cls, id: str, password_hash: str, db_session: AsyncSession = None) -> None:
+        async with session_scope(db_session) as db_session:
+            async with transaction(db_session):
                 update_stmt = update(User).where(User.id == id).values({
                     User.password_hash: password_hash,
                     User.incomplete_registration: 0,
@@ -121,9 +365,9 @@ class User(Base):
                     raise RecordNotFoundError()
 
     @classmethod
-    async def update_access_level(cls, username: str, access_level: int) -> None:
-        async with asyncDBSession() as db_session:
-            async with db_session.begin():
+    async def update_access_level(cls, username: str, access_level: int, db_session: AsyncSession = None) -> None:
+        async with session_scope(db_session) as db_session:
+            async with transaction(db_session):
                 update_stmt = update(User).where(User.username == username).values({
                     User.access_level: access_level,
                 })
@@ -132,9 +376,9 @@ class User(Base):
                     raise RecordNotFoundError()
 
     @classmethod
-    async def delete_user(cls, id_or_username: str = None, by_id: bool = True):
-        async with asyncDBSession() as db_session:
-            async with db_session.begin():
+    async def delete_user(cls, id_or_username: str = None, by_id: bool = True, db_session: AsyncSession = None):
+        async with session_scope(db_session) as db_session:
+            async with transaction(db_session):
                 stmt = select(User).where(User.id == id_or_username if by_id else User.username == id_or_username)
                 result = await db_session.execute(stmt)
                 user = result.scalars().first()
@@ -154,20 +398,21 @@ class Session(Base):
     user = relationship("User", back_populates="sessions")
 
     @classmethod
-    async def add(cls, token_hash: str, user_id: str) -> str:
+    async def add(cls, token_hash: str, user_id: str, db_session: AsyncSession = None) -> str:
         """Returns the id of the added session"""
-        async with asyncDBSession() as db_session:
-            async with db_session.begin():
+        async with session_scope(db_session) as db_session:
+            async with transaction(db_session):
                 user_session = Session(token_hash=token_hash, user_id=user_id)
                 db_session.add(user_session)
                 await db_session.flush()
                 return str(user_session.id)
 
     @classmethod
-    async def end(cls, user_id: str, include_id: str = None, exclude_id: str = None) -> int:
+    async def end(cls, user_id: str, include_id: str = None, exclude_id: str = None,
+                  db_session: AsyncSession = None) -> int:
         """Returns the number of ended sessions"""
-        async with asyncDBSession() as db_session:
-            async with db_session.begin():
+        async with session_scope(db_session) as db_session:
+            async with transaction(db_session):
                 update_stmt = update(Session).where(
                     Session.user_id == user_id,
                     not include_id or Session.id == include_id,
@@ -178,6 +423,168 @@ class Session(Base):
                 return result.rowcount
 
 
+class SchedulerLease(Base):
+    """
+    The single row that coordinates periodic data updates between server instances.
+    The instance holding an unexpired lease is the leader and the only one running the schedule.
+    Schedule settings and the time of the last update are shared by all instances.
+    """
+
+    __tablename__ = "scheduler_lease"
+    LEASE_ID = 1
+    id = Column(Integer, primary_key=True)
+    owner_id = Column(TEXT)
+    owner_name = Column(TEXT)
+    expiration_time = Column(Integer, default=0)
+    enabled = Column(Integer, default=0)
+    interval_seconds = Column(Integer, default=12 * 60 * 60)
+    last_update = Column(TEXT)
+
+    @classmethod
+    async def get(cls) -> "SchedulerLease":
+        """Returns the lease row, creating it on first use"""
+        async with asyncDBSession() as db_session:
+            async with db_session.begin():
+                await db_session.execute(
+                    sqlite_insert(SchedulerLease).values(id=cls.LEASE_ID).on_conflict_do_nothing())
+                result = await db_session.execute(select(SchedulerLease).where(SchedulerLease.id == cls.LEASE_ID))
+                return result.scalars().first()
+
+    @classmethod
+    async def try_acquire(cls, owner_id: str, owner_name: str, ttl: int) -> bool:
+        """Takes or renews the lease for ttl seconds. Returns False if another instance holds an unexpired lease"""
+        now = int(time.time())
+        await cls.get()
+        async with asyncDBSession() as db_session:
+            async with db_session.begin():
+                update_stmt = update(SchedulerLease).where(
+                    SchedulerLease.id == cls.LEASE_ID,
+                    or_(SchedulerLease.owner_id == owner_id, SchedulerLease.expiration_time < now),
+                ).values({
+                    SchedulerLease.owner_id: owner_id,
+                    SchedulerLease.owner_name: owner_name,
+                    SchedulerLease.expiration_time: now + ttl,
+                })
+                result = await db_session.execute(update_stmt)
+                return bool(result.rowcount)
+
+    @classmethod
+    async def release(cls, owner_id: str) -> None:
+        """Gives up the lease so that another instance can take it over without waiting for expiration"""
+        async with asyncDBSession() as db_session:
+            async with db_session.begin():
+                await db_session.execute(update(SchedulerLease).where(
+                    SchedulerLease.id == cls.LEASE_ID,
+                    SchedulerLease.owner_id == owner_id,
+                ).values({SchedulerLease.expiration_time: 0}))
+
+    @classmethod
+    async def set_schedule(cls, enabled: bool, interval_seconds: int = None) -> None:
+        await cls.get()
+        values = {SchedulerLease.enabled: int(enabled)}
+        if interval_seconds is not None:
+            values[SchedulerLease.interval_seconds] = interval_seconds
+        async with asyncDBSession() as db_session:
+            async with db_session.begin():
+                await db_session.execute(update(SchedulerLease).where(SchedulerLease.id == cls.LEASE_ID).values(values))
+
+    @classmethod
+    async def set_last_update(cls, last_update: str) -> None:
+        await cls.get()
+        async with asyncDBSession() as db_session:
+            async with db_session.begin():
+                await db_session.execute(update(SchedulerLease).where(SchedulerLease.id == cls.LEASE_ID).values({
+                    SchedulerLease.last_update: last_update,
+                }))
+
+
+class RefreshJobLock(Base):
+    """
+    The single row that lets only one data update run at a time across server instances.
+    The instance holding an unexpired lock runs the update and keeps its progress in the row,
+    other instances show that progress and pass cancellation requests through the row.
+    After the update the row keeps its result until the next update takes the lock.
+    """
+
+    __tablename__ = "refresh_job_lock"
+    LOCK_ID = 1
+    id = Column(Integer, primary_key=True)
+    job_id = Column(TEXT)
+    owner_id = Column(TEXT)
+    owner_name = Column(TEXT)
+    expiration_time = Column(Integer, default=0)
+    cancel_requested = Column(Integer, default=0)
+    run = Column(sqlalchemy.JSON)
+
+    def is_held(self) -> bool:
+        return self.expiration_time >= time.time()
+
+    @classmethod
+    async def get(cls) -> Optional["RefreshJobLock"]:
+        """Returns the lock row, None if no update has taken it yet"""
+        async with asyncDBSession() as db_session:
+            result = await db_session.execute(select(RefreshJobLock).where(RefreshJobLock.id == cls.LOCK_ID))
+            return result.scalars().first()
+
+    @classmethod
+    async def try_acquire(cls, job_id: str, owner_id: str, owner_name: str, run: dict, ttl: int) -> bool:
+        """Takes the lock for the update job_id for ttl seconds. Returns False if another update holds it"""
+        now = int(time.time())
+        async with asyncDBSession() as db_session:
+            async with db_session.begin():
+                await db_session.execute(
+                    sqlite_insert(RefreshJobLock).values(id=cls.LOCK_ID).on_conflict_do_nothing())
+                update_stmt = update(RefreshJobLock).where(
+                    RefreshJobLock.id == cls.LOCK_ID,
+                    RefreshJobLock.expiration_time < now,
+                ).values({
+                    RefreshJobLock.job_id: job_id,
+                    RefreshJobLock.owner_id: owner_id,
+                    RefreshJobLock.owner_name: owner_name,
+                    RefreshJobLock.expiration_time: now + ttl,
+                    RefreshJobLock.cancel_requested: 0,
+                    RefreshJobLock.run: run,
+                })
+                result = await db_session.execute(update_stmt)
+                return bool(result.rowcount)
+
+    @classmethod
+    async def renew(cls, job_id: str, run: dict, ttl: int) -> bool:
+        """Extends the lock of the update job_id and stores its progress. Returns True if cancellation is requested"""
+        async with asyncDBSession() as db_session:
+            async with db_session.begin():
+                result = await db_session.execute(update(RefreshJobLock).where(
+                    RefreshJobLock.id == cls.LOCK_ID,
+                    RefreshJobLock.job_id == job_id,
+                ).values({
+                    RefreshJobLock.expiration_time: int(time.time()) + ttl,
+                    RefreshJobLock.run: run,
+                }).returning(RefreshJobLock.cancel_requested))
+                return bool(result.scalar())
+
+    @classmethod
+    async def release(cls, job_id: str, run: dict) -> None:
+        """Stores the result of the update job_id and frees the lock for the next update"""
+        async with asyncDBSession() as db_session:
+            async with db_session.begin():
+                await db_session.execute(update(RefreshJobLock).where(
+                    RefreshJobLock.id == cls.LOCK_ID,
+                    RefreshJobLock.job_id == job_id,
+                ).values({RefreshJobLock.expiration_time: 0, RefreshJobLock.run: run}))
+
+    @classmethod
+    async def request_cancel(cls, job_id: str) -> bool:
+        """Asks the instance running the update job_id to cancel it. Returns False if the update is not running"""
+        async with asyncDBSession() as db_session:
+            async with db_session.begin():
+                result = await db_session.execute(update(RefreshJobLock).where(
+                    RefreshJobLock.id == cls.LOCK_ID,
+                    RefreshJobLock.job_id == job_id,
+                    RefreshJobLock.expiration_time >= int(time.time()),
+                ).values({RefreshJobLock.cancel_requested: 1}))
+                return bool(result.rowcount)
+
+
 class University(Base):
     """
     Universities with state accreditation.
@@ -187,6 +594,16 @@ class University(Base):
     """
 
     __tablename__ = "universities"
+    # Filters and sort orders of the /universities page; short_name is always the secondary sort key
+    # and id the tiebreaker (see pagination). The name search uses the full-text index (see fulltext)
+    __table_args__ = (
+        Index("ix_universities_deleted_short_name", "deleted", "short_name", "id"),
+        Index("ix_universities_deleted_full_name", "deleted", "full_name", "short_name", "id"),
+        Index("ix_universities_deleted_region_name", "deleted", "region_name", "short_name", "id"),
+        Index("ix_universities_deleted_kind_name", "deleted", "kind_name", "short_name", "id"),
+        Index("ix_universities_deleted_is_branch", "deleted", "is_branch", "short_name", "id"),
+        Index("ix_universities_head_edu_org_id", "head_edu_org_id"),
+    )
     id = Column(String, primary_key=True)
     full_name = Column(TEXT)
     short_name = Column(TEXT)
@@ -212,12 +629,12 @@ class University(Base):
     head_edu_org = relationship("University", back_populates="branches", remote_side=[id])
     branches = relationship("University", back_populates="head_edu_org", cascade="all")
     eduprogs = relationship("EduProg", back_populates="university", cascade="all")
-    name_search = Column(TEXT)
+    registry_hash = Column(TEXT, default=None)
 
     @classmethod
-    async def get_by_id(cls, id: str) -> Optional["University"]:
+    async def get_by_id(cls, id: str, db_session: AsyncSession = None) -> Optional["University"]:
         """Returns None, even if the record exists but is marked as deleted"""
-        async with asyncDBSession() as db_session:
+        async with session_scope(db_session) as db_session:
             result = await db_session.execute(select(University).where(University.id == id))
             univ = result.scalars().first()
             if univ and univ.deleted:
@@ -225,11 +642,11 @@ class University(Base):
             return univ
 
     @classmethod
-    async def add(cls, data: dm.University, custom: bool) -> "University":
+    async def add(cls, data: dm.University, custom: bool, db_session: AsyncSession = None) -> "University":
         """
         :param custom: True if the data is not from the registry.
         """
-        async with asyncDBSession() as db_session:
+        async with session_scope(db_session) as db_session:
             try:
                 univ = University(**data.model_dump(), custom=custom)
                 if univ.id and custom:
@@ -238,6 +655,7 @@ class University(Base):
                     univ.id = provide_uuid()
                 db_session.add(univ)
                 await db_session.commit()
+                pagination.CountCache.invalidate()
                 return univ
             except Exception as e:
                 await db_session.rollback()
@@ -246,24 +664,26 @@ class University(Base):
                 raise e
 
     @classmethod
-    async def update(cls, data: dm.University) -> "University":
-        async with asyncDBSession() as db_session:
-            async with db_session.begin():
+    async def update(cls, data: dm.University, db_session: AsyncSession = None) -> "University":
+        async with session_scope(db_session) as db_session:
+            async with transaction(db_session):
                 result = await db_session.execute(select(University).where(University.id == data.id))
                 univ = result.scalars().first()
                 if not univ:
                     raise RecordNotFoundError
                 for column, value in data.model_dump().items():
                     setattr(univ, column, value)
-                return univ
+                univ.registry_hash = None
+        pagination.CountCache.invalidate()
+        return univ
 
     @classmethod
-    async def delete(cls, id: str, from_parser: bool) -> None:
+    async def delete(cls, id: str, from_parser: bool, db_session: AsyncSession = None) -> None:
         """
         :param from_parser: True if the university is no already in the registry.
         """
-        async with asyncDBSession() as db_session:
-            async with db_session.begin():
+        async with session_scope(db_session) as db_session:
+            async with transaction(db_session):
                 stmt = select(University).where(University.id == id) \
                     .options(selectinload(University.branches), selectinload(University.eduprogs))
                 result = await db_session.execute(stmt)
@@ -278,18 +698,50 @@ class University(Base):
                         branch.deleted = 1
                     for eduprog in univ.eduprogs:
                         eduprog.deleted = 1
+        pagination.CountCache.invalidate()
+
+    @classmethod
+    async def bulk_upsert(cls, db_session: AsyncSession, data: list[dm.University],
+                          changes: dm.RegistryChanges, target: sqlalchemy.Table = None) -> None:
+        """
+        Inserts or updates registry records with a single executemany, bypassing ORM events.
+        Records that do not belong to higher education are skipped, unchanged records are not rewritten.
+        :param changes: collects ids of the actual, inserted and changed records.
+        :param target: shadow table to write all records to instead of the live table.
+        """
+        rows = []
+        for univ in data:
+            try:
+                check_university(univ.full_name, univ.type_name)
+            except NotUnivError:
+                continue
+            row = univ.model_dump()
+            row["head_edu_org_id"] = row["head_edu_org_id"] or None
+            row["custom"] = 0
+            row["registry_hash"] = dm.fingerprint(univ)
+            rows.append(row)
+        await _write_changed_rows(db_session, University.__table__, rows, changes, target)
+
+
+@event.listens_for(University.__table__, "after_create")
+def university_after_create_listener(target, connection, **kw):
+    fulltext.create_index(connection)
+
+
+def check_university(full_name: str, type_name: str) -> None:
+    """Raises NotUnivError if the organization is not related to higher education"""
+    if ("общеобр" in full_name.lower()
+            or "колледж" in full_name.lower()
+            or not ("высшего" in full_name.lower() or "высшего" in type_name.lower())):
+        raise NotUnivError
 
 
 @event.listens_for(University, 'before_insert')
 @event.listens_for(University, 'before_update')
 def university_before_listener(mapper, connection: AsyncConnection, target):
-    target.name_search = target.full_name.lower() + " " + target.short_name.lower()
     if target.head_edu_org_id == "":
         target.head_edu_org_id = None
-    if ("общеобр" in target.full_name.lower()
-            or "колледж" in target.full_name.lower()
-            or not ("высшего" in target.full_name.lower() or "высшего" in target.type_name.lower())):
-        raise NotUnivError
+    check_university(target.full_name, target.type_name)
 
 
 class EduProg(Base):
@@ -301,6 +753,14 @@ class EduProg(Base):
     """
 
     __tablename__ = "educational_programs"
+    # Filters of the /eduprograms page; programm_code is the default and the secondary sort key,
+    # id is the tiebreaker (see pagination)
+    __table_args__ = (
+        Index("ix_educational_programs_deleted_programm_code", "deleted", "programm_code", "id"),
+        Index("ix_educational_programs_deleted_ugs_code", "deleted", "ugs_code", "programm_code", "id"),
+        Index("ix_educational_programs_deleted_edu_level_name", "deleted", "edu_level_name", "programm_code", "id"),
+        Index("ix_educational_programs_university_id", "university_id", "deleted", "programm_code", "id"),
+    )
     id = Column(String, primary_key=True)
     type_name = Column(TEXT)
     edu_level_name = Column(TEXT)
@@ -317,11 +777,12 @@ class EduProg(Base):
     deleted = Column(Integer, default=0)
     university_id = Column(String, ForeignKey("universities.id", ondelete="CASCADE"))
     university = relationship("University", back_populates="eduprogs")
+    registry_hash = Column(TEXT, default=None)
 
     @classmethod
-    async def get_by_id(cls, id: str) -> Optional["EduProg"]:
+    async def get_by_id(cls, id: str, db_session: AsyncSession = None) -> Optional["EduProg"]:
         """Returns None, even if the record exists but is marked as deleted"""
-        async with asyncDBSession() as db_session:
+        async with session_scope(db_session) as db_session:
             result = await db_session.execute(select(EduProg).where(EduProg.id == id))
             eduprog = result.scalars().first()
             if eduprog and eduprog.deleted:
@@ -329,11 +790,11 @@ class EduProg(Base):
             return eduprog
 
     @classmethod
-    async def add(cls, data: dm.EduProg, custom: bool):
+    async def add(cls, data: dm.EduProg, custom: bool, db_session: AsyncSession = None):
         """
         :param custom: True if the data is not from the registry.
         """
-        async with asyncDBSession() as db_session:
+        async with session_scope(db_session) as db_session:
             try:
                 eduprog = EduProg(**data.model_dump(), custom=custom)
                 if eduprog.id and custom:
@@ -342,6 +803,7 @@ class EduProg(Base):
                     eduprog.id = provide_uuid()
                 db_session.add(eduprog)
                 await db_session.commit()
+                pagination.CountCache.invalidate()
                 return eduprog
             except Exception as e:
                 await db_session.rollback()
@@ -350,24 +812,26 @@ class EduProg(Base):
                 raise e
 
     @classmethod
-    async def update(cls, data: dm.EduProg) -> "EduProg":
-        async with asyncDBSession() as db_session:
-            async with db_session.begin():
+    async def update(cls, data: dm.EduProg, db_session: AsyncSession = None) -> "EduProg":
+        async with session_scope(db_session) as db_session:
+            async with transaction(db_session):
                 result = await db_session.execute(select(EduProg).where(EduProg.id == data.id))
                 eduprog = result.scalars().first()
                 if not eduprog:
                     raise RecordNotFoundError
                 for column, value in data.model_dump().items():
                     setattr(eduprog, column, value)
-                return eduprog
+                eduprog.registry_hash = None
+        pagination.CountCache.invalidate()
+        return eduprog
 
     @classmethod
-    async def delete(cls, id: str, from_parser: bool) -> None:
+    async def delete(cls, id: str, from_parser: bool, db_session: AsyncSession = None) -> None:
         """
         :param from_parser: True if the educational program is no already in the registry.
         """
-        async with asyncDBSession() as db_session:
-            async with db_session.begin():
+        async with session_scope(db_session) as db_session:
+            async with transaction(db_session):
                 result = await db_session.execute(select(EduProg).where(EduProg.id == id))
                 eduprog = result.scalars().first()
                 if not eduprog or eduprog.custom and from_parser:
@@ -376,13 +840,40 @@ class EduProg(Base):
                     await db_session.delete(eduprog)
                 elif not eduprog.custom and not from_parser:
                     eduprog.deleted = 1
+        pagination.CountCache.invalidate()
+
+    @classmethod
+    async def bulk_upsert(cls, db_session: AsyncSession, data: list[dm.EduProg],
+                          changes: dm.RegistryChanges, target: sqlalchemy.Table = None) -> None:
+        """
+        Inserts or updates registry records with a single executemany, bypassing ORM events.
+        Records that do not belong to higher education are skipped, unchanged records are not rewritten.
+        :param changes: collects ids of the actual, inserted and changed records.
+        :param target: shadow table to write all records to instead of the live table.
+        """
+        rows = []
+        for eduprog in data:
+            try:
+                check_eduprog(eduprog.edu_level_name)
+            except NotUnivError:
+                continue
+            row = eduprog.model_dump()
+            row["custom"] = 0
+            row["registry_hash"] = dm.fingerprint(eduprog)
+            rows.append(row)
+        await _write_changed_rows(db_session, EduProg.__table__, rows, changes, target)
+
+
+def check_eduprog(edu_level_name: str) -> None:
+    """Raises NotUnivError if the educational program is not related to higher education"""
+    if not ("ВО" in edu_level_name or "высшее" in edu_level_name.lower()):
+        raise NotUnivError
 
 
 @event.listens_for(EduProg, 'before_insert')
 @event.listens_for(EduProg, 'before_update')
 def eduprog_before_listener(mapper, connection: AsyncConnection, target):
-    if not ("ВО" in target.edu_level_name or "высшее" in target.edu_level_name.lower()):
-        raise NotUnivError
+    check_eduprog(target.edu_level_name)
 
 
 class InMemoryCache:
@@ -411,8 +902,8 @@ class InMemoryCache:
     @classmethod
     def invalidate(cls, tablename, ident=None):
         if not ident:
-            for key in InMemoryCache._cache.keys():
-                if key.starttswith(tablename):
+            for key in list(InMemoryCache._cache.keys()):
+                if key.startswith(f"{tablename}:"):
                     del InMemoryCache._cache[key]
             return
         try:
@@ -425,13 +916,13 @@ class ItemTable(Base):
     __abstract__ = True
 
     @classmethod
-    async def _get_list(cls, column, self_column_name):
+    async def _get_list(cls, column, self_column_name, db_session: AsyncSession = None):
         """Возвращает отсортированный список"""
         print("get_list")
         lst = InMemoryCache.get_from_cache(cls.__tablename__, 0)
         if lst:
             return lst
-        async with asyncDBSession() as db_session:
+        async with session_scope(db_session) as db_session:
             result = await db_session.execute(select(cls).order_by(column))
             InMemoryCache.set_to_cache(cls.__tablename__, 0,
                                        [getattr(elem, self_column_name) for elem in result.scalars()])
@@ -459,8 +950,8 @@ class Region(ItemTable):
     name = Column(TEXT, primary_key=True)
 
     @classmethod
-    async def get_list(cls):
-        return await super()._get_list(cls.name, self_column_name="name")
+    async def get_list(cls, db_session: AsyncSession = None):
+        return await super()._get_list(cls.name, self_column_name="name", db_session=db_session)
 
     @classmethod
     async def refresh(cls):
@@ -473,8 +964,8 @@ class Ugs(ItemTable):
     code = Column(TEXT, primary_key=True)
 
     @classmethod
-    async def get_list(cls):
-        return await super()._get_list(cls.code, self_column_name="code")
+    async def get_list(cls, db_session: AsyncSession = None):
+        return await super()._get_list(cls.code, self_column_name="code", db_session=db_session)
 
     @classmethod
     async def refresh(cls):
@@ -487,8 +978,8 @@ class ProgCode(ItemTable):
     code = Column(TEXT, primary_key=True)
 
     @classmethod
-    async def get_list(cls):
-        return await super()._get_list(cls.code, self_column_name="code")
+    async def get_list(cls, db_session: AsyncSession = None):
+        return await super()._get_list(cls.code, self_column_name="code", db_session=db_session)
 
     @classmethod
     async def refresh(cls):
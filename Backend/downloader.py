@@ -1,44 +1,293 @@
 import asyncio
 import aiohttp
 import aiofiles
+import base64
+import hashlib
+import json
+import re
 import zipfile
 import os
+import config
+import metrics
 
 
 # Константы для загрузки данных
 DOWNLOAD_URL = "https://islod.obrnadzor.gov.ru/accredreestr/opendata/"
 DOWNLOAD_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + "/Downloads"
 EXTRACT_DIR = DOWNLOAD_DIR
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # Размер куска, которым архив пишется на диск
+DOWNLOAD_ATTEMPTS = 5  # Число попыток скачивания; каждая следующая продолжает недокачанный файл
+DOWNLOAD_RETRY_DELAY = 10  # Пауза перед повторной попыткой, секунды (растет с номером попытки)
+DOWNLOAD_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=60, sock_read=120)
+# Сведения о последнем загруженном в БД архиве: ETag, Last-Modified и sha256
+DOWNLOAD_STATE_FILE = DOWNLOAD_DIR + "/download_state.json"
 
+CONTENT_RANGE_PATTERN = re.compile(r"bytes (?:(\d+)-\d+|\*)/(\d+|\*)")
+DIGEST_ALGORITHMS = {"sha-256": "sha256", "sha-512": "sha512", "md5": "md5"}
 
-async def download_archive():
-    """Скачивает архив с портала Рособрнадзора"""
+
+class DownloadVerificationError(Exception):
+    """Скачанный архив не совпал по размеру или контрольной сумме с ответом сервера"""
+
+
+class ArchiveStreamError(Exception):
+    """Архив пришлось бы скачивать заново, а его начало уже передано на разбор"""
+
+
+def _parse_digest_headers(headers) -> tuple[str, str] | None:
+    """
+    Возвращает (алгоритм hashlib, hex-значение) из заголовков Repr-Digest, Digest или Content-MD5.
+    Значения в этих заголовках закодированы в base64.
+    """
+    for header in ("Repr-Digest", "Digest"):
+        for item in headers.get(header, "").split(","):
+            name, _, value = item.strip().partition("=")
+            algorithm = DIGEST_ALGORITHMS.get(name.lower())
+            if algorithm and value:
+                return algorithm, base64.b64decode(value.strip(":")).hex()
+    if "Content-MD5" in headers:
+        return "md5", base64.b64decode(headers["Content-MD5"]).hex()
+    return None
+
+
+def _load_json_state(state_path: str) -> dict:
+    """Возвращает сохраненные сведения о файле: ETag, Last-Modified, размер и хеш"""
+    try:
+        with open(state_path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_json_state(state_path: str, state: dict) -> None:
+    with open(state_path, "w") as f:
+        json.dump(state, f)
+
+
+def load_download_state() -> dict:
+    """Возвращает сведения о последнем архиве, который был загружен в БД"""
+    return _load_json_state(DOWNLOAD_STATE_FILE)
+
+
+def save_download_state(state: dict) -> None:
+    """Запоминает архив как загруженный в БД; вызывается после успешного обновления БД"""
+    _save_json_state(DOWNLOAD_STATE_FILE, state)
+
+
+def _remove_files(*paths: str) -> None:
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _file_hexdigest(path: str, algorithm: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, algorithm).hexdigest()
+
+
+def _verify_archive(part_path: str, state: dict) -> None:
+    """
+    Проверяет скачанный файл: размер - по Content-Length/Content-Range, контрольную сумму - по заголовкам
+    Digest, если сервер их прислал; иначе - что это zip-архив (CRC файлов проверяются при распаковке).
+    """
+    size = os.path.getsize(part_path)
+    if state.get("size") is not None and size != state["size"]:
+        raise DownloadVerificationError(f"Размер архива {size} байт, ожидалось {state['size']}")
+    if state.get("digest"):
+        algorithm, expected = state["digest"]
+        actual = _file_hexdigest(part_path, algorithm)
+        if actual != expected:
+            raise DownloadVerificationError(f"Контрольная сумма {algorithm} архива {actual}, ожидалось {expected}")
+    elif not zipfile.is_zipfile(part_path):
+        raise DownloadVerificationError("Скачанный файл не является zip-архивом")
+
+
+def _known_changed(state: dict, previous: dict) -> bool:
+    """
+    True, если по ETag или Last-Modified видно, что архив отличается от предыдущего, или предыдущего нет.
+    Иначе совпадение архивов станет известно только по sha256 после скачивания.
+    """
+    if not previous.get("sha256"):
+        return True
+    return any(state.get(key) and state[key] != previous.get(key) for key in ("etag", "last_modified"))
+
+
+async def _download_attempt(session: aiohttp.ClientSession, url: str, part_path: str, state_path: str,
+                            previous: dict, sink, stage_metrics: metrics.StageMetrics) -> dict | None:
+    """
+    Одна попытка скачивания: если есть недокачанный файл, запрашивает только недостающую часть (Range),
+    иначе - весь архив, если он изменился с предыдущей загрузки (If-None-Match, If-Modified-Since).
+    Возвращает сведения об архиве для проверки или None, если сервер ответил, что архив не изменился.
+    """
+    state = _load_json_state(state_path)
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) and state else 0
+    headers = {}
+    if not offset:
+        if previous.get("etag"):
+            headers["If-None-Match"] = previous["etag"]
+        if previous.get("last_modified"):
+            headers["If-Modified-Since"] = previous["last_modified"]
+    else:
+        headers["Range"] = f"bytes={offset}-"
+        # Если файл на сервере сменился, сервер вернет его целиком, а не продолжение старого
+        validator = state.get("etag") or state.get("last_modified")
+        if validator:
+            headers["If-Range"] = validator
+
+    async with session.get(url, headers=headers) as response:
+        if response.status == 304 and not offset:
+            return None
+        if response.status == 416 and offset:
+            match = CONTENT_RANGE_PATTERN.fullmatch(response.headers.get("Content-Range", ""))
+            if match and match.group(2) == str(offset):
+                print("Архив уже скачан полностью")
+                return state
+            _remove_files(part_path, state_path)
+            raise aiohttp.ClientPayloadError("Сервер отклонил запрос продолжения, архив будет скачан заново")
+        if response.status == 206 and offset:
+            match = CONTENT_RANGE_PATTERN.fullmatch(response.headers.get("Content-Range", ""))
+            if not match or match.group(1) != str(offset):
+                _remove_files(part_path, state_path)
+                raise aiohttp.ClientPayloadError("Сервер вернул не тот диапазон, архив будет скачан заново")
+            if match.group(2) != "*":
+                state["size"] = int(match.group(2))
+            mode = "ab"
+            print(f"Продолжение скачивания с {offset} байт")
+        elif response.status == 200:
+            state = {
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "size": response.content_length,
+                "digest": _parse_digest_headers(response.headers),
+            }
+            _save_json_state(state_path, state)
+            mode = "wb"
+        else:
+            raise Exception(f"Ошибка загрузки: {response.status}")
+
+        if sink is not None and not _known_changed(state, previous):
+            # Архив может совпасть с предыдущим: он передается на разбор только после проверки sha256
+            sink = None
+        if sink is not None:
+            if sink.written != (offset if mode == "ab" else 0):
+                raise ArchiveStreamError("Сервер начал передачу архива заново, а его начало уже передано на разбор")
+            sink.total_size = state.get("size")
+        async with aiofiles.open(part_path, mode) as f:
+            async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                metrics.check_cancelled()
+                await f.write(chunk)
+                stage_metrics.bytes += len(chunk)
+                if sink is not None:
+                    await sink.write(chunk)
+    return state
+
+
+async def _replay_part(part_path: str, state_path: str, previous: dict, sink) -> None:
+    """Передает в sink уже скачанное начало архива, которое продолжит запрос Range"""
+    state = _load_json_state(state_path)
+    if not (os.path.exists(part_path) and state and _known_changed(state, previous)):
+        return
+    async with aiofiles.open(part_path, "rb") as f:
+        while chunk := await f.read(DOWNLOAD_CHUNK_SIZE):
+            await sink.write(chunk)
+
+
+async def _retry_pause(seconds: float) -> None:
+    """Пауза перед повторной попыткой; отмена запуска (metrics.check_cancelled) прерывает ее в течение секунды"""
+    deadline = asyncio.get_running_loop().time() + seconds
+    while (remaining := deadline - asyncio.get_running_loop().time()) > 0:
+        metrics.check_cancelled()
+        await asyncio.sleep(min(1, remaining))
+    metrics.check_cancelled()
+
+
+async def download_archive(url: str = DOWNLOAD_URL, archive_path: str | None = None,
+                           previous: dict | None = None, sink=None) -> tuple[str, dict] | None:
+    """
+    Скачивает архив с портала Рособрнадзора кусками прямо на диск.
+    Недокачанный архив хранится рядом с расширением .part, при обрыве соединения следующая попытка
+    продолжает его запросом Range. Готовый архив проверяется по размеру и контрольной сумме
+    и только после этого переименовывается в archive_path.
+    previous - сведения о предыдущем архиве (load_download_state): по ним запрос делается условным.
+    Возвращает путь к архиву и его сведения (ETag, Last-Modified, sha256) или None, если архив не изменился -
+    по ответу 304 или по совпадению sha256.
+    sink - объект с async write(data) и счетчиком written (zipstream.StreamPipe): в него по мере скачивания
+    передаются байты архива, чтобы разбирать его, не дожидаясь конца загрузки. Если сервер не дает продолжить
+    загрузку с места обрыва, возникает ArchiveStreamError. Архив, который по ETag и Last-Modified может совпадать
+    с предыдущим, в sink не передается: его нужно сначала скачать и сравнить по sha256.
+    """
+    archive_path = archive_path or DOWNLOAD_DIR + "/data.zip"
+    part_path = archive_path + ".part"
+    state_path = part_path + ".json"
+    previous = previous or {}
 
     print("Скачивание архива...")
-    async with aiohttp.ClientSession() as session:
-        async with session.get(DOWNLOAD_URL) as response:
-            if response.status == 200:
-                archive_path = DOWNLOAD_DIR + "/data.zip"
-                async with aiofiles.open(archive_path, "wb") as f:
-                    await f.write(await response.read())
-                return archive_path
-            else:
-                raise Exception(f"Ошибка загрузки: {response.status}")
+    with metrics.stage("download") as stage_metrics:
+        if sink is not None:
+            await _replay_part(part_path, state_path, previous, sink)
+        async with aiohttp.ClientSession(timeout=DOWNLOAD_TIMEOUT) as session:
+            for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+                metrics.check_cancelled()
+                try:
+                    state = await _download_attempt(session, url, part_path, state_path, previous, sink,
+                                                    stage_metrics)
+                    if state is None:
+                        print("Архив на портале не изменился")
+                        return None
+                    await asyncio.to_thread(_verify_archive, part_path, state)
+                    break
+                except (aiohttp.ClientError, asyncio.TimeoutError, DownloadVerificationError) as e:
+                    if isinstance(e, DownloadVerificationError):
+                        _remove_files(part_path, state_path)
+                    if attempt == DOWNLOAD_ATTEMPTS:
+                        raise
+                    stage_metrics.retries += 1
+                    print(f"Ошибка скачивания (попытка {attempt} из {DOWNLOAD_ATTEMPTS}): {e!r}")
+                    await _retry_pause(DOWNLOAD_RETRY_DELAY * attempt)
+        state["sha256"] = await asyncio.to_thread(_file_hexdigest, part_path, "sha256")
+        os.replace(part_path, archive_path)
+        _remove_files(state_path)
+        if state["sha256"] == previous.get("sha256"):
+            print("Скачанный архив совпадает с предыдущим")
+            return None
+        return archive_path, state
 
 
-async def extract_archive(archive_path):
-    """Распаковывает архив"""
+async def extract_archive(archive_path) -> str:
+    """Распаковывает архив, возвращает путь к XML-файлу выгрузки"""
 
     def sync_extract_archive():
         with zipfile.ZipFile(archive_path, "r") as zip_ref:
             zip_ref.extractall(EXTRACT_DIR)
+            xml_members = [info for info in zip_ref.infolist() if info.filename.lower().endswith(".xml")]
+            if not xml_members:
+                raise FileNotFoundError(f"В архиве {archive_path} нет XML-файла")
+            data_member = max(xml_members, key=lambda info: info.file_size)
+            return os.path.join(EXTRACT_DIR, data_member.filename), sum(info.file_size for info in zip_ref.infolist())
 
     print("Распаковка архива...")
-    await asyncio.to_thread(sync_extract_archive)
+    with metrics.stage("extract") as stage_metrics:
+        data_filename, size = await asyncio.to_thread(sync_extract_archive)
+        stage_metrics.bytes += size
+    return data_filename
 
 
-async def download_and_extract():
-    """Скачивает и распаковывает архив"""
-    archive_path = await download_archive()
-    await extract_archive(archive_path)
-    print("Скачивание и распаковка завершены")
+async def download_and_extract(force: bool = False) -> dict | None:
+    """
+    Скачивает архив, если он изменился с последнего обновления БД, и распаковывает его,
+    если не включен config.PARSE_FROM_ARCHIVE (тогда парсер читает XML прямо из архива).
+    Возвращает сведения о новом архиве, где data_filename - файл для parser.update_DB;
+    после обновления БД они передаются в save_download_state.
+    Возвращает None, если архив не изменился. force - скачать архив без условного запроса.
+    """
+    result = await download_archive(previous=None if force else load_download_state())
+    if result is None:
+        return None
+    archive_path, state = result
+    if config.PARSE_FROM_ARCHIVE:
+        state["data_filename"] = archive_path
+        print("Скачивание завершено")
+    else:
+        state["data_filename"] = await extract_archive(archive_path)
+        print("Скачивание и распаковка завершены")
+    return state
@@ -0,0 +1,70 @@
+import asyncio
+import json
+from contextlib import contextmanager
+import config
+from jobs import RefreshJobManager
+from schedule import Scheduler
+
+
+class EventBroadcaster:
+    """
+    Рассылка событий обновления данных подписчикам (потокам server-sent events админ-панели).
+    События приходят от менеджера запусков и планировщика через их callbacks, поэтому подписчики
+    не опрашивают ни сервер, ни БД: сколько бы ни было подписчиков, событие формируется один раз.
+    Типы событий:
+    progress - текущие счетчики запуска (metrics.IngestionRun), stage - запуск перешел к новому этапу,
+    finished - итог запуска (в том числе с ошибкой или отмененного), schedule - изменилось состояние расписания.
+    """
+
+    def __init__(self, jobs: RefreshJobManager, scheduler: Scheduler):
+        self.schedule_status = None
+        self._subscribers = set()
+        self._stages = {}
+        jobs.progress_callbacks.append(self._on_progress)
+        jobs.finished_callbacks.append(self._on_finished)
+        scheduler.status_callbacks.append(self._on_schedule)
+
+    @staticmethod
+    def format(event_type: str, data) -> str:
+        """Возвращает событие в формате text/event-stream"""
+        return f"event: {event_type}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+    def publish(self, event_type: str, data) -> None:
+        self._put(self.format(event_type, data))
+
+    def close(self) -> None:
+        """Завершает потоки всех подписчиков: они получат None вместо события"""
+        self._put(None)
+
+    def _put(self, message: str | None) -> None:
+        for queue in self._subscribers:
+            if queue.full():
+                # Подписчик не успевает читать: последние счетчики важнее старых
+                queue.get_nowait()
+            queue.put_nowait(message)
+
+    @contextmanager
+    def subscribe(self):
+        """Очередь событий для одного подписчика; подписка отменяется при выходе из блока with"""
+        queue = asyncio.Queue(config.EVENTS_QUEUE_SIZE)
+        self._subscribers.add(queue)
+        try:
+            yield queue
+        finally:
+            self._subscribers.discard(queue)
+
+    async def _on_progress(self, run: dict) -> None:
+        seen = self._stages.setdefault(run["id"], set())
+        for name in run["stages"]:
+            if name not in seen:
+                seen.add(name)
+                self.publish("stage", {"run_id": run["id"], "stage": name})
+        self.publish("progress", run)
+
+    async def _on_finished(self, run: dict) -> None:
+        self._stages.pop(run["id"], None)
+        self.publish("finished", run)
+
+    async def _on_schedule(self, status: dict) -> None:
+        self.schedule_status = status
+        self.publish("schedule", status)
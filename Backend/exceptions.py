@@ -16,3 +16,8 @@ class UniqueConstraintFailedError(Exception):
 class SelfCreatedIDError(Exception):
     """Attempt to insert a record into a table with a non-empty id field"""
     pass
+
+
+class RefreshCancelledError(Exception):
+    """The data update was cancelled at the request of the user"""
+    pass
@@ -0,0 +1,98 @@
+"""
+Full-text search over university names (SQLite FTS5).
+The universities_fts table holds the full and short name of every row of universities under the same rowid.
+Triggers on universities keep it in sync with editor and registry writes; after the shadow tables are swapped
+(db_tables.swap_shadow_tables) the triggers are created again and the index is rebuilt.
+The unicode61 tokenizer splits words and folds case of Cyrillic as well as Latin letters, but keeps ё apart from е,
+so ё is folded to е both in the indexed names and in the search query.
+"""
+import re
+import sqlalchemy
+from sqlalchemy import text
+
+
+TABLE_NAME = "universities_fts"
+CONTENT_TABLE_NAME = "universities"
+TOKENIZER = "unicode61 remove_diacritics 2"
+
+search_table = sqlalchemy.table(TABLE_NAME, sqlalchemy.column("rowid"), sqlalchemy.column("rank"))
+
+
+def fold(value: str) -> str:
+    return value.replace("ё", "е").replace("Ё", "Е")
+
+
+def _fold_sql(row: str) -> str:
+    """SQL expression with the indexed text of a universities row (new or old in a trigger)"""
+    return (f"replace(replace(coalesce({row}.full_name, '') || ' ' || coalesce({row}.short_name, ''), "
+            f"'ё', 'е'), 'Ё', 'Е')")
+
+
+def match_query(search: str) -> str | None:
+    """
+    Returns an FTS5 query that matches names containing all words of search as word prefixes,
+    or None if search has no words.
+    """
+    words = re.findall(r"\w+", fold(search))
+    return " ".join(f'"{word}"*' for word in words) or None
+
+
+def search_matches(search: str) -> sqlalchemy.Subquery | None:
+    """
+    Returns the rowid and rank (relevance, smaller is better) of universities matching search,
+    or None if search has no words.
+    """
+    query = match_query(search)
+    if query is None:
+        return None
+    # LIMIT keeps SQLite from flattening the subquery into the join: otherwise it may scan universities
+    # by the deleted index and evaluate MATCH for every row instead of reading the matches once
+    return sqlalchemy.select(search_table.c.rowid, search_table.c.rank) \
+        .where(text(f"{TABLE_NAME} MATCH :match_query").bindparams(match_query=query)) \
+        .limit(-1) \
+        .subquery("search_matches")
+
+
+def join_matches(stmt, matches: sqlalchemy.Subquery):
+    """Restricts a select from universities to the rows of search_matches"""
+    return stmt.join(matches, matches.c.rowid == sqlalchemy.literal_column(f"{CONTENT_TABLE_NAME}.rowid"))
+
+
+def create_triggers(sync_conn) -> None:
+    """Creates the triggers that copy name changes of universities to the search index"""
+    sync_conn.execute(text(
+        f"CREATE TRIGGER IF NOT EXISTS {TABLE_NAME}_insert AFTER INSERT ON {CONTENT_TABLE_NAME} BEGIN "
+        f"INSERT INTO {TABLE_NAME} (rowid, name) VALUES (new.rowid, {_fold_sql('new')}); "
+        f"END"
+    ))
+    sync_conn.execute(text(
+        f"CREATE TRIGGER IF NOT EXISTS {TABLE_NAME}_delete AFTER DELETE ON {CONTENT_TABLE_NAME} BEGIN "
+        f"DELETE FROM {TABLE_NAME} WHERE rowid = old.rowid; "
+        f"END"
+    ))
+    sync_conn.execute(text(
+        f"CREATE TRIGGER IF NOT EXISTS {TABLE_NAME}_update AFTER UPDATE OF full_name, short_name "
+        f"ON {CONTENT_TABLE_NAME} BEGIN "
+        f"DELETE FROM {TABLE_NAME} WHERE rowid = old.rowid; "
+        f"INSERT INTO {TABLE_NAME} (rowid, name) VALUES (new.rowid, {_fold_sql('new')}); "
+        f"END"
+    ))
+
+
+def rebuild(sync_conn) -> None:
+    """Fills the search index from scratch"""
+    sync_conn.execute(text(f"DELETE FROM {TABLE_NAME}"))
+    sync_conn.execute(text(
+        f"INSERT INTO {TABLE_NAME} (rowid, name) "
+        f"SELECT rowid, {_fold_sql(CONTENT_TABLE_NAME)} FROM {CONTENT_TABLE_NAME}"
+    ))
+    sync_conn.execute(text(f"INSERT INTO {TABLE_NAME} ({TABLE_NAME}) VALUES ('optimize')"))
+
+
+def create_index(sync_conn) -> None:
+    """Creates and fills the search index with its triggers"""
+    sync_conn.execute(text(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {TABLE_NAME} USING fts5(name, tokenize='{TOKENIZER}')"
+    ))
+    create_triggers(sync_conn)
+    rebuild(sync_conn)
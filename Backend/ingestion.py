@@ -0,0 +1,75 @@
+import asyncio
+import config
+import downloader
+import parser
+import zipstream
+
+
+async def refresh_registry(force: bool = False) -> dict | None:
+    """
+    Полный цикл обновления данных из реестра: скачивание архива, разбор выгрузки и запись в БД.
+    При config.PIPELINED_INGESTION этапы идут одновременно, иначе - друг за другом.
+    Возвращает сводку изменений или None, если архив на портале не изменился.
+    force - обновить БД, даже если архив не изменился.
+    """
+    if config.PIPELINED_INGESTION:
+        return await _refresh_pipelined(force)
+    download_state = await downloader.download_and_extract(force)
+    if download_state is None:
+        return None
+    changes = await parser.update_DB(download_state["data_filename"])
+    downloader.save_download_state(download_state)
+    return changes
+
+
+async def _download_into(pipe: zipstream.StreamPipe, previous: dict | None):
+    """Скачивает архив, передавая байты в канал, и закрывает канал с результатом скачивания"""
+    try:
+        result = await downloader.download_archive(previous=previous, sink=pipe)
+    except BaseException as e:
+        pipe.finish(e if isinstance(e, Exception) else zipstream.PipeClosedError("Скачивание отменено"))
+        raise
+    pipe.finish()
+    return result
+
+
+async def _refresh_pipelined(force: bool) -> dict | None:
+    """
+    Скачивание, распаковка, разбор и запись в БД одновременно. Этапы связаны ограниченными очередями:
+    байты архива - zipstream.StreamPipe (config.PIPELINE_BUFFER_SIZE), разобранные пачки - очередь
+    в parser.xml_parse (config.PIPELINE_QUEUE_SIZE), поэтому быстрый этап ждет медленный, а не копит данные.
+    Разбор начинается с первыми байтами ответа; если сервер ответил, что архив не изменился, разбор не запускается.
+    Если по ETag и Last-Modified не видно, что архив изменился (например, сервер их не присылает), архив сначала
+    скачивается целиком и сравнивается с предыдущим по sha256, а разбирается как файл - с использованием снимка.
+    Ошибка скачивания, размера, контрольной суммы или CRC останавливает обновление до удаления исчезнувших записей
+    (в режиме config.REFRESH_MODE == "shadow" - до подмены таблиц, то есть рабочие таблицы не меняются).
+    """
+    pipe = zipstream.StreamPipe(config.PIPELINE_BUFFER_SIZE)
+    download_task = asyncio.create_task(_download_into(pipe, None if force else downloader.load_download_state()))
+    data_task = asyncio.create_task(pipe.wait_for_data())
+    try:
+        await asyncio.wait({download_task, data_task}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        data_task.cancel()
+    if not pipe.has_data():
+        result = await download_task
+        if result is None:
+            return None
+        archive_path, download_state = result
+        changes = await parser.update_DB(archive_path)
+    else:
+        try:
+            changes = await parser.update_DB(zipstream.ZipStreamReader(parser.ProgressReader(pipe)))
+        except BaseException:
+            pipe.close()
+            download_task.cancel()
+            await asyncio.gather(download_task, return_exceptions=True)
+            raise
+        result = await download_task
+        if result is None:
+            # ETag или Last-Modified сменились, а содержимое архива - нет: БД обновлена теми же данными
+            return changes
+        archive_path, download_state = result
+    download_state["data_filename"] = archive_path
+    downloader.save_download_state(download_state)
+    return changes
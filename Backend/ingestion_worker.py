@@ -0,0 +1,212 @@
+import asyncio
+import multiprocessing
+import uuid
+from datetime import datetime
+import config
+import db_tables as dbt
+import ingestion
+import metrics
+from exceptions import RefreshCancelledError
+
+
+class IngestionWorker:
+    """
+    Отдельный процесс, в котором выполняется обновление данных из реестра,
+    чтобы разбор и запись в БД не занимали GIL и цикл событий веб-сервера.
+    Сервер передает процессу команды (refresh, cancel, stop) и получает события:
+    progress - текущие счетчики запуска, finished - итог запуска (metrics.IngestionRun).
+    Команды refresh выполняются по очереди. Если процесс завершился, он запускается заново при следующей команде.
+    progress_callbacks и finished_callbacks - корутины, которые вызываются с текущими счетчиками
+    и с итогом каждого запуска.
+    """
+
+    def __init__(self):
+        self.process = None
+        self.connection = None
+        self.current_run = None
+        self.progress_callbacks = []
+        self.finished_callbacks = []
+        self._jobs = {}
+        self._reader_task = None
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+    def start(self) -> None:
+        """Запускает процесс-обработчик"""
+        if self.is_alive():
+            return
+        context = multiprocessing.get_context("spawn")
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=worker_main, args=(child_connection,), name="ingestion-worker",
+                                       daemon=True)
+        self.process.start()
+        child_connection.close()
+        self._reader_task = asyncio.create_task(self._read_events(self.connection))
+        print(f"Процесс обновления данных запущен (pid {self.process.pid})")
+
+    async def _read_events(self, connection) -> None:
+        try:
+            while True:
+                event = await asyncio.to_thread(connection.recv)
+                if event["type"] == "progress":
+                    self.current_run = event["run"]
+                    await self._run_callbacks(self.progress_callbacks, event["run"])
+                elif event["type"] == "finished":
+                    self.current_run = None
+                    await self._on_finished(event["run"])
+                    future = self._jobs.pop(event["job_id"], None)
+                    if future is not None and not future.done():
+                        future.set_result(event["run"])
+        except (EOFError, OSError):
+            pass
+        if connection is not self.connection:
+            return
+        # Процесс завершился: ожидающие запуски уже не закончатся
+        if self.current_run is not None:
+            run = {**self.current_run, "status": "error", "error": "Процесс обновления данных завершился",
+                   "finished_at": datetime.now().isoformat(timespec="seconds")}
+            self.current_run = None
+            await self._on_finished(run)
+        for future in self._jobs.values():
+            if not future.done():
+                future.set_exception(RuntimeError("Процесс обновления данных завершился"))
+        self._jobs.clear()
+
+    async def _on_finished(self, run: dict) -> None:
+        # Процесс-обработчик изменил данные (при ошибке или отмене обновления - возможно, частично),
+        # кеши сервера устарели
+        dbt.invalidate_data_caches()
+        await self._run_callbacks(self.finished_callbacks, run)
+
+    @staticmethod
+    async def _run_callbacks(callbacks: list, run: dict) -> None:
+        for callback in callbacks:
+            try:
+                await callback(run)
+            except Exception as e:
+                print(f"Ошибка при обработке события обновления данных: {e}")
+
+    def _send(self, command: dict) -> None:
+        self.connection.send(command)
+
+    def submit(self, trigger: str, force: bool = False, job_id: str | None = None) -> str:
+        """Ставит обновление данных в очередь процесса-обработчика, не дожидаясь его окончания; возвращает id запуска"""
+        self.start()
+        job_id = job_id or str(uuid.uuid4())
+        self._send({"type": "refresh", "job_id": job_id, "trigger": trigger, "force": force})
+        return job_id
+
+    async def refresh(self, trigger: str, force: bool = False, job_id: str | None = None) -> dict:
+        """
+        Выполняет обновление данных в процессе-обработчике и возвращает итог запуска (metrics.IngestionRun.model_dump).
+        Отмена ожидания отменяет и сам запуск.
+        """
+        future = asyncio.get_running_loop().create_future()
+        job_id = self.submit(trigger, force, job_id)
+        self._jobs[job_id] = future
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            self.cancel(job_id)
+            raise
+
+    def cancel(self, job_id: str | None = None) -> None:
+        """
+        Отменяет запуск job_id (по умолчанию - выполняющийся сейчас).
+        Выполняющийся запуск останавливается между пачками данных, ожидающий в очереди - не начинается.
+        """
+        if self.is_alive():
+            self._send({"type": "cancel", "job_id": job_id})
+
+    async def stop(self) -> None:
+        """Останавливает процесс-обработчик, прерывая выполняющийся запуск"""
+        if not self.is_alive():
+            return
+        self._send({"type": "stop"})
+        await asyncio.to_thread(self.process.join, config.WORKER_STOP_TIMEOUT)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.connection.close()
+        print("Процесс обновления данных остановлен")
+
+
+def worker_main(connection) -> None:
+    """Точка входа процесса-обработчика"""
+    asyncio.run(_serve(connection))
+
+
+async def _serve(connection) -> None:
+    await dbt.create_tables()
+    queue = asyncio.Queue()
+    jobs = {}
+    cancelled = set()
+    runner = asyncio.create_task(_run_jobs(connection, queue, jobs, cancelled))
+    try:
+        while True:
+            try:
+                command = await asyncio.to_thread(connection.recv)
+            except (EOFError, OSError):
+                break
+            if command["type"] == "refresh":
+                await queue.put(command)
+            elif command["type"] == "cancel":
+                job_id = command["job_id"]
+                if job_id is None or job_id in jobs:
+                    if jobs:
+                        metrics.request_cancel()
+                else:
+                    cancelled.add(job_id)  # Запуск еще ждет в очереди
+            elif command["type"] == "stop":
+                break
+    finally:
+        runner.cancel()
+        await asyncio.gather(runner, return_exceptions=True)
+
+
+async def _run_jobs(connection, queue: asyncio.Queue, jobs: dict, cancelled: set) -> None:
+    """Выполняет запуски по очереди и сообщает серверу об их ходе и итогах"""
+    while True:
+        command = await queue.get()
+        job_id = command["job_id"]
+        if job_id in cancelled:
+            cancelled.discard(job_id)
+            run = metrics.IngestionRun(id=job_id, trigger=command["trigger"], status="cancelled",
+                                       started_at=datetime.now().isoformat(timespec="seconds"))
+        else:
+            task = asyncio.create_task(_run_refresh(job_id, command["trigger"], command["force"]))
+            jobs[job_id] = task
+            reporter = asyncio.create_task(_report_progress(connection))
+            try:
+                run = await asyncio.shield(task)
+            except asyncio.CancelledError:
+                # Остановка процесса: запуск прерывается и попадает в историю как отмененный
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                raise
+            finally:
+                reporter.cancel()
+                del jobs[job_id]
+        connection.send({"type": "finished", "job_id": job_id, "run": run.model_dump()})
+
+
+async def _report_progress(connection) -> None:
+    while True:
+        run = metrics.current_run()
+        if run is not None:
+            connection.send({"type": "progress", "run": run.model_dump()})
+        await asyncio.sleep(config.WORKER_PROGRESS_INTERVAL)
+
+
+async def _run_refresh(job_id: str, trigger: str, force: bool) -> metrics.IngestionRun:
+    """Выполняет обновление данных и записывает его в историю запусков"""
+    metrics.start_run(trigger, run_id=job_id)
+    try:
+        changes = await ingestion.refresh_registry(force)
+    except (asyncio.CancelledError, RefreshCancelledError):
+        print("Обновление данных отменено")
+        return metrics.finish_run(status="cancelled")
+    except Exception as e:
+        print(f"Ошибка при обновлении данных: {e}")
+        return metrics.finish_run(status="error", error=str(e))
+    return metrics.finish_run(status="unchanged" if changes is None else "success", changes=changes)
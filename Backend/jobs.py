@@ -0,0 +1,185 @@
+import asyncio
+import os
+import socket
+import uuid
+from datetime import datetime
+import config
+import db_tables as dbt
+import metrics
+from ingestion_worker import IngestionWorker
+
+
+class RefreshJobManager:
+    """
+    Запуски обновления данных из реестра. Одновременно выполняется не больше одного запуска на все экземпляры
+    сервера: запуск держит блокировку в таблице refresh_job_lock и, пока выполняется, продлевает ее и пишет туда
+    свой ход. Запрос, пришедший во время выполнения - в этот или в другой экземпляр, - присоединяется к текущему
+    запуску, а не ставит новый; отмена передается через ту же таблицу экземпляру, который выполняет запуск.
+    Запуски выполняются в процессе-обработчике (IngestionWorker), их итоги сохраняются в истории (metrics).
+    progress_callbacks и finished_callbacks - корутины, которые вызываются с ходом и итогом запусков,
+    в том числе выполняющихся в других экземплярах (их ход приходит раз в config.REFRESH_LOCK_RENEW_INTERVAL).
+    """
+
+    def __init__(self, worker: IngestionWorker):
+        self.worker = worker
+        self.worker.progress_callbacks.append(self._on_progress)
+        self.worker.finished_callbacks.append(self._on_finished)
+        self.instance_id = str(uuid.uuid4())
+        self.instance_name = f"{socket.gethostname()}:{os.getpid()}"
+        self.progress_callbacks = []
+        self.finished_callbacks = []
+        self._task = None
+        self._job = None
+        self._remote_job = None
+        self._watch_task = None
+
+    def run_watcher(self) -> None:
+        """Запускает продление блокировки своих запусков и слежение за запусками других экземпляров"""
+        if self._watch_task is None:
+            self._watch_task = asyncio.create_task(self._watch())
+
+    def shutdown(self) -> None:
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+            self._watch_task = None
+
+    def is_active(self) -> bool:
+        """True, если запуск выполняется в этом экземпляре"""
+        return self._task is not None and not self._task.done()
+
+    def _local_job(self) -> dict:
+        run = self.worker.current_run
+        if run is not None and run["id"] == self._job["id"]:
+            return run
+        return self._job
+
+    async def current_job(self) -> dict | None:
+        """
+        Возвращает выполняющийся запуск с ходом выполнения (progress, records, stages) или None.
+        Ход запуска другого экземпляра - на момент последнего продления им блокировки.
+        """
+        if self.is_active():
+            return self._local_job()
+        lock = await dbt.RefreshJobLock.get()
+        return lock.run if lock and lock.is_held() else None
+
+    async def submit(self, trigger: str, force: bool = False) -> tuple[dict, bool]:
+        """
+        Запускает обновление данных, не дожидаясь его окончания.
+        Возвращает запуск и признак того, что запрос присоединился к уже выполняющемуся запуску.
+        """
+        if self.is_active():
+            return self._local_job(), True
+        job = metrics.IngestionRun(id=str(uuid.uuid4()), trigger=trigger, status="queued",
+                                   started_at=datetime.now().isoformat(timespec="seconds")).model_dump()
+        if not await dbt.RefreshJobLock.try_acquire(job["id"], self.instance_id, self.instance_name, job,
+                                                    config.REFRESH_LOCK_TTL):
+            if self.is_active():
+                return self._local_job(), True
+            lock = await dbt.RefreshJobLock.get()
+            return lock.run, True
+        self._job = job
+        self._task = asyncio.create_task(self._run(trigger, force))
+        self._task.add_done_callback(self._log_failure)
+        return job, False
+
+    async def run(self, trigger: str, force: bool = False) -> dict:
+        """Запускает обновление данных или присоединяется к выполняющемуся и возвращает итог запуска"""
+        job, _ = await self.submit(trigger, force)
+        if self.is_active() and self._job["id"] == job["id"]:
+            # Отмена ожидающего не отменяет запуск: к нему могли присоединиться другие
+            return await asyncio.shield(self._task)
+        return await self._wait_remote(job)
+
+    async def cancel(self) -> bool:
+        """Просит выполняющийся запуск остановиться между пачками данных; возвращает False, если запуска нет"""
+        if self.is_active():
+            self.worker.cancel(self._job["id"])
+            return True
+        lock = await dbt.RefreshJobLock.get()
+        if not lock or not lock.is_held():
+            return False
+        return await dbt.RefreshJobLock.request_cancel(lock.job_id)
+
+    @staticmethod
+    def history() -> list[dict]:
+        """Возвращает завершенные запуски, от новых к старым"""
+        return metrics.load_history()[::-1]
+
+    async def _run(self, trigger: str, force: bool) -> dict:
+        """Выполняет запуск в процессе-обработчике и освобождает блокировку с его итогом"""
+        job_id = self._job["id"]
+        run = {**self._job, "status": "cancelled", "finished_at": datetime.now().isoformat(timespec="seconds")}
+        try:
+            run = await self.worker.refresh(trigger, force, job_id=job_id)
+            return run
+        except Exception as e:
+            run = {**run, "status": "error", "error": str(e)}
+            raise
+        finally:
+            try:
+                await dbt.RefreshJobLock.release(job_id, run)
+            except Exception as e:
+                print(f"Не удалось освободить блокировку обновления данных: {e}")
+
+    async def _wait_remote(self, job: dict) -> dict:
+        """Ждет окончания запуска другого экземпляра и возвращает его итог"""
+        while True:
+            await asyncio.sleep(config.REFRESH_LOCK_RENEW_INTERVAL)
+            lock = await dbt.RefreshJobLock.get()
+            if lock.job_id == job["id"] and lock.is_held():
+                continue
+            return self._remote_result(lock, job)
+
+    @staticmethod
+    def _remote_result(lock: dbt.RefreshJobLock | None, job: dict) -> dict:
+        """Итог запуска другого экземпляра; если тот перестал продлевать блокировку, запуск считается ошибочным"""
+        if lock and lock.job_id == job["id"] and lock.run.get("finished_at"):
+            return lock.run
+        return {**job, "status": "error", "error": "Экземпляр сервера, выполнявший обновление, перестал отвечать",
+                "finished_at": datetime.now().isoformat(timespec="seconds")}
+
+    async def _watch(self) -> None:
+        while True:
+            try:
+                if self.is_active():
+                    if await dbt.RefreshJobLock.renew(self._job["id"], self._local_job(), config.REFRESH_LOCK_TTL):
+                        self.worker.cancel(self._job["id"])
+                else:
+                    await self._follow(await dbt.RefreshJobLock.get())
+            except Exception as e:
+                # БД может быть занята записью выгрузки: блокировка продлится при следующей попытке
+                print(f"Не удалось обновить блокировку обновления данных: {e}")
+            await asyncio.sleep(config.REFRESH_LOCK_RENEW_INTERVAL)
+
+    async def _follow(self, lock: dbt.RefreshJobLock | None) -> None:
+        """Передает подписчикам ход и итог запуска, который выполняет другой экземпляр"""
+        remote_job = lock.run if lock and lock.is_held() and lock.owner_id != self.instance_id else None
+        previous = self._remote_job
+        if previous is not None and (remote_job is None or remote_job["id"] != previous["id"]):
+            self._remote_job = None
+            # Другой экземпляр изменил данные: кеши этого экземпляра устарели
+            dbt.invalidate_data_caches()
+            await self._run_callbacks(self.finished_callbacks, self._remote_result(lock, previous))
+        if remote_job is not None and remote_job != previous:
+            self._remote_job = remote_job
+            await self._run_callbacks(self.progress_callbacks, remote_job)
+
+    async def _on_progress(self, run: dict) -> None:
+        await self._run_callbacks(self.progress_callbacks, run)
+
+    async def _on_finished(self, run: dict) -> None:
+        await self._run_callbacks(self.finished_callbacks, run)
+
+    @staticmethod
+    async def _run_callbacks(callbacks: list, run: dict) -> None:
+        for callback in callbacks:
+            try:
+                await callback(run)
+            except Exception as e:
+                print(f"Ошибка при обработке события обновления данных: {e}")
+
+    @staticmethod
+    def _log_failure(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Ошибка при обновлении данных: {task.exception()}")
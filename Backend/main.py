@@ -1,10 +1,11 @@
 import asyncio
 import uvicorn
-from sqlalchemy import select, desc, and_, or_, func
+from sqlalchemy import select, and_, or_, func
 from sqlalchemy.orm import selectinload
-from database import asyncDBSession
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import get_db_session
 from fastapi import FastAPI, HTTPException, Query, status, Cookie, Body, Depends
-from fastapi.responses import HTMLResponse, FileResponse, JSONResponse
+from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, StreamingResponse
 from fastapi.exceptions import RequestValidationError
 from mako.lookup import TemplateLookup
 import json
@@ -16,6 +17,12 @@ import db_tables as dbt
 import data_models as dm
 import config
 import schedule
+from ingestion_worker import IngestionWorker
+from jobs import RefreshJobManager
+from events import EventBroadcaster
+import metrics
+import fulltext
+import pagination
 import exceptions as expt
 
 app = FastAPI()
@@ -39,31 +46,52 @@ async def validation_exception_handler(request, exc):
     raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=details)
 
 
-async def verify_session(session_data: str, min_access_level: int = dm.GUEST_ACCESS) -> auth.SessionData | None:
+async def get_session_model(session_data: Optional[str] = Cookie(None),
+                            db_session: AsyncSession = Depends(get_db_session)) -> auth.SessionData | None:
     """
-    :param session_data: Session data from cookie.
+    Dependency: the session model of the request (fields user, session id and session token),
+    None if the session is invalid. FastAPI resolves it once per request.
+    """
+    return await auth.verify_session(session_data, db_session)
+
+
+def check_access(session_model: auth.SessionData | None, min_access_level: int = dm.GUEST_ACCESS) -> None:
+    """
+    :param session_model: The session model of the request (get_session_model).
     :param min_access_level: Minimum access level for successful verification.
-    :return: The session model with the fields user, session id, and session token. None if the session is invalid.
     """
-    session_model = await auth.verify_session(session_data)
     if min_access_level > dm.GUEST_ACCESS and not session_model:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)
     if session_model and session_model.user.access_level < min_access_level:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN)
-    return session_model
+
+
+def view_columns(table, model_class) -> list:
+    """Columns of table that are fields of model_class: a list page selects only what it shows"""
+    return [getattr(table, name) for name in model_class.model_fields if hasattr(table, name)]
+
+
+async def fetch_list_page(db_session, stmt, keys: list, reverse: int, scope: str, page: int, page_size: int,
+                          after: str, before: str) -> tuple[list, str | None, str | None]:
+    """pagination.fetch_page with an invalid cursor reported to the client"""
+    try:
+        return await pagination.fetch_page(db_session, stmt, keys, bool(reverse), scope, page, page_size,
+                                           after, before)
+    except pagination.InvalidCursorError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="Ссылка на страницу устарела или повреждена, откройте список заново")
 
 
 @app.get("/", response_class=HTMLResponse)
-async def get_home(session_data: Optional[str] = Cookie(None)):
+async def get_home(session_model: auth.SessionData | None = Depends(get_session_model)):
     """Returns start page"""
-    session_model = await auth.verify_session(session_data)
     template = lookup.get_template(f"{config.FRONT_CATALOG_NAME}/home.html")
     html_content = template.render(auth_username=get_username_from_session_model(session_model))
     return HTMLResponse(content=html_content)
 
 
 @app.get("/eduprograms", response_class=HTMLResponse)
-async def get_eduprograms(session_data: Optional[str] = Cookie(None),
+async def get_eduprograms(session_model: auth.SessionData | None = Depends(get_session_model),
                     page: int = Query(default=1, ge=1),
                     page_size: int = Query(default=config.DEFAULT_PAGE_SIZE, ge=1),
                     ugs: str = Query(default=""),
@@ -71,72 +99,72 @@ async def get_eduprograms(session_data: Optional[str] = Cookie(None),
                     edu_level_name: str = Query(default=""),
                     sort: str = Query(default="programm_code"),
                     reverse: int = Query(default=0, ge=0, le=1),
-                    univ_id: str = Query(default="")):
-    """Returns a page with a table of educational programs"""
-    offset = (page - 1) * page_size
+                    univ_id: str = Query(default=""),
+                    after: str = Query(default="", description="Cursor: the page after it (see pagination)"),
+                    before: str = Query(default="", description="Cursor: the page before it"),
+                    db_session: AsyncSession = Depends(get_db_session)):
+    """
+    Returns a page with a table of educational programs.
+    The page is addressed by a cursor (after, before) or by its number; page is only shown with a cursor.
+    """
     if sort == "university.full_name":
-        order = dbt.University.full_name if not reverse else desc(dbt.University.full_name)
+        sort_column = dbt.University.full_name
     else:
-        order = getattr(dbt.EduProg, sort) if not reverse else getattr(dbt.EduProg, sort).desc()
-    ugs_list = await dbt.Ugs.get_list()
-    prog_code_list = await dbt.ProgCode.get_list()
-    async with asyncDBSession() as db_session:
-        stmt_count = select(func.count()).select_from(dbt.EduProg).where(and_(
-            dbt.EduProg.deleted == 0,
-            or_(not ugs, dbt.EduProg.ugs_code == ugs),
-            or_(not prog_code, dbt.EduProg.programm_code == prog_code),
-            or_(not univ_id, dbt.EduProg.university_id == univ_id),
-            or_(not edu_level_name, dbt.EduProg.edu_level_name == edu_level_name),
-        ))
-        all_eduprogs_count = await db_session.scalar(stmt_count)
-        stmt = select(dbt.EduProg).where(and_(
-            dbt.EduProg.deleted == 0,
-            or_(not ugs, dbt.EduProg.ugs_code == ugs),
-            or_(not prog_code, dbt.EduProg.programm_code == prog_code),
-            or_(not univ_id, dbt.EduProg.university_id == univ_id),
-            or_(not edu_level_name, dbt.EduProg.edu_level_name == edu_level_name),
-        )).options(selectinload(dbt.EduProg.university)) \
-            .join(dbt.University)\
-            .order_by(order, dbt.EduProg.programm_code) \
-            .offset(offset) \
-            .limit(page_size)
-        on_page_eduprogs_result = await db_session.execute(stmt)
-        eduprogs_json = json.dumps([
-            dm.base2model(
-                base=eduprog,
-                model_class=dm.EduProgForView,
-                university_full_name=eduprog.university.full_name,
-            ).model_dump() for eduprog in on_page_eduprogs_result.scalars()
-        ])
-        template = lookup.get_template(f"{config.FRONT_CATALOG_NAME}/eduprograms.html")
-        session_model = await auth.verify_session(session_data)
-        html_content = template.render(ugsList=ugs_list,
-                                       ugsFilter=ugs,
-                                       progCodeList=prog_code_list,
-                                       progCodeFilter=prog_code,
-                                       eduLevelFilter=edu_level_name,
-                                       eduprogs_json=eduprogs_json,
-                                       univ_id=univ_id,
-                                       sortColumn=sort,
-                                       reverse=reverse,
-                                       currentPage=page,
-                                       itemsPerPage=page_size,
-                                       maxPage=max(1, ceil(all_eduprogs_count / page_size)),
-                                       auth_username=get_username_from_session_model(session_model),
-                                       can_edit=session_model and session_model.user.access_level >= dm.EDITOR_ACCESS)
-        return HTMLResponse(content=html_content)
+        sort_column = getattr(dbt.EduProg, sort)
+    keys = pagination.sort_keys(sort_column, dbt.EduProg.programm_code, dbt.EduProg.id)
+    ugs_list = await dbt.Ugs.get_list(db_session=db_session)
+    prog_code_list = await dbt.ProgCode.get_list(db_session=db_session)
+    stmt_count = select(func.count()).select_from(dbt.EduProg).where(and_(
+        dbt.EduProg.deleted == 0,
+        or_(not ugs, dbt.EduProg.ugs_code == ugs),
+        or_(not prog_code, dbt.EduProg.programm_code == prog_code),
+        or_(not univ_id, dbt.EduProg.university_id == univ_id),
+        or_(not edu_level_name, dbt.EduProg.edu_level_name == edu_level_name),
+    ))
+    all_eduprogs_count = await pagination.count_rows(
+        db_session, stmt_count, ("eduprograms", ugs, prog_code, univ_id, edu_level_name))
+    stmt = select(*view_columns(dbt.EduProg, dm.EduProgForView),
+                  dbt.University.full_name.label("university_full_name")).where(and_(
+        dbt.EduProg.deleted == 0,
+        or_(not ugs, dbt.EduProg.ugs_code == ugs),
+        or_(not prog_code, dbt.EduProg.programm_code == prog_code),
+        or_(not univ_id, dbt.EduProg.university_id == univ_id),
+        or_(not edu_level_name, dbt.EduProg.edu_level_name == edu_level_name),
+    )).join_from(dbt.EduProg, dbt.University)
+    on_page_eduprogs, next_cursor, previous_cursor = await fetch_list_page(
+        db_session, stmt, keys, reverse, f"{sort}:{reverse}", page, page_size, after, before)
+    eduprogs_json = json.dumps(on_page_eduprogs)
+    template = lookup.get_template(f"{config.FRONT_CATALOG_NAME}/eduprograms.html")
+    html_content = template.render(ugsList=ugs_list,
+                                   ugsFilter=ugs,
+                                   progCodeList=prog_code_list,
+                                   progCodeFilter=prog_code,
+                                   eduLevelFilter=edu_level_name,
+                                   eduprogs_json=eduprogs_json,
+                                   univ_id=univ_id,
+                                   sortColumn=sort,
+                                   reverse=reverse,
+                                   currentPage=page,
+                                   itemsPerPage=page_size,
+                                   maxPage=max(1, ceil(all_eduprogs_count / page_size)),
+                                   nextCursor=next_cursor or "",
+                                   previousCursor=previous_cursor or "",
+                                   auth_username=get_username_from_session_model(session_model),
+                                   can_edit=session_model and session_model.user.access_level >= dm.EDITOR_ACCESS)
+    return HTMLResponse(content=html_content)
 
 
 @app.get("/eduprograms/edit/{id}", response_class=HTMLResponse)
-async def get_edit_eduprogram(session_data: Optional[str] = Cookie(None),
-                        id: str = None):
+async def get_edit_eduprogram(session_model: auth.SessionData | None = Depends(get_session_model),
+                        id: str = None,
+                        db_session: AsyncSession = Depends(get_db_session)):
     """Returns a page for editing an educational program under the given id in the DB"""
-    eduprog = await dbt.EduProg.get_by_id(id)
+    eduprog = await dbt.EduProg.get_by_id(id, db_session=db_session)
     if not eduprog:
         raise HTTPException(status_code=404)
     template = lookup.get_template(f"{config.FRONT_CATALOG_NAME}/eduprog_edit.html")
-    session_model = await verify_session(session_data=session_data, min_access_level=dm.EDITOR_ACCESS)
-    university = await dbt.University.get_by_id(eduprog.university_id)
+    check_access(session_model, dm.EDITOR_ACCESS)
+    university = await dbt.University.get_by_id(eduprog.university_id, db_session=db_session)
     html_content = template.render(eduprog=dm.base2model(eduprog, dm.EduProg).model_dump(),
                                    university_id=university.id,
                                    university_full_name=university.full_name,
@@ -146,14 +174,15 @@ async def get_edit_eduprogram(session_data: Optional[str] = Cookie(None),
 
 
 @app.get("/eduprograms/new/{univ_id}", response_class=HTMLResponse)
-async def get_edit_eduprogram(session_data: Optional[str] = Cookie(None),
-                        univ_id: str = None):
+async def get_edit_eduprogram(session_model: auth.SessionData | None = Depends(get_session_model),
+                        univ_id: str = None,
+                        db_session: AsyncSession = Depends(get_db_session)):
     """Returns a page for adding an educational program for a specific university to the database"""
-    university = await dbt.University.get_by_id(univ_id)
+    university = await dbt.University.get_by_id(univ_id, db_session=db_session)
     if not university:
         raise HTTPException(status_code=404)
     template = lookup.get_template(f"{config.FRONT_CATALOG_NAME}/eduprog_edit.html")
-    session_model = await verify_session(session_data=session_data, min_access_level=dm.EDITOR_ACCESS)
+    check_access(session_model, dm.EDITOR_ACCESS)
     html_content = template.render(eduprog="null",
                                    university_id=university.id,
                                    university_full_name=university.full_name,
@@ -165,18 +194,19 @@ async def get_edit_eduprogram(session_data: Optional[str] = Cookie(None),
 @app.post("/{mode}/eduprogram", response_class=JSONResponse)
 async def post_edit_eduprogram(data: dm.EduProg,
                          mode: Literal["new", "edit"],
-                         session_data: Optional[str] = Cookie(None)):
+                         session_model: auth.SessionData | None = Depends(get_session_model),
+                         db_session: AsyncSession = Depends(get_db_session)):
     """
     Updates or adds an educational program to the database.
     If the new record is successfully created, it returns its id in the JSON field.
     """
-    await verify_session(session_data=session_data, min_access_level=dm.EDITOR_ACCESS)
+    check_access(session_model, dm.EDITOR_ACCESS)
     try:
         if mode == "new":
-            eduprog = await dbt.EduProg.add(data, custom=True)
+            eduprog = await dbt.EduProg.add(data, custom=True, db_session=db_session)
             return JSONResponse({"detail": "Successfully", "id": eduprog.id})
         elif mode == "edit":
-            await dbt.EduProg.update(data)
+            await dbt.EduProg.update(data, db_session=db_session)
             return JSONResponse({"detail": "Successfully"})
     except expt.RecordNotFoundError:
         raise HTTPException(status_code=404, detail="Образовательная программа не найдена")
@@ -192,11 +222,12 @@ async def post_edit_eduprogram(data: dm.EduProg,
 
 @app.delete("/delete/eduprogram/{id}", response_class=JSONResponse)
 async def delete_eduprogram(id: str,
-                      session_data: Optional[str] = Cookie(None)):
+                      session_model: auth.SessionData | None = Depends(get_session_model),
+                      db_session: AsyncSession = Depends(get_db_session)):
     """Removes the educational program with the given id from the database"""
-    await verify_session(session_data=session_data, min_access_level=dm.EDITOR_ACCESS)
+    check_access(session_model, dm.EDITOR_ACCESS)
     try:
-        await dbt.EduProg.delete(id, from_parser=False)
+        await dbt.EduProg.delete(id, from_parser=False, db_session=db_session)
         return JSONResponse(content={"detail": "Successfully"}, status_code=status.HTTP_200_OK)
     except expt.RecordNotFoundError:
         return JSONResponse(content={"detail": "ОП не найдена"}, status_code=status.HTTP_204_NO_CONTENT)
@@ -207,56 +238,67 @@ async def delete_eduprogram(id: str,
 
 
 @app.get("/universities", response_class=HTMLResponse)
-async def get_univ_list(session_data: Optional[str] = Cookie(None),
+async def get_univ_list(session_model: auth.SessionData | None = Depends(get_session_model),
                   page: int = Query(default=1, ge=1),
                   page_size: int = Query(default=config.DEFAULT_PAGE_SIZE, ge=1),
                   region: str = Query(default="", description="Filter for the region field"),
-                  search: str = Query(default="", description="A line, all words of which must be present"
-                                                              "in the full or short name of the university"),
-                  sort: str = Query(default="short_name", description="Field name to sort by"),
-                  reverse: int = Query(default=0, ge=0, le=1, description="1 if sorting in descending order")):
+                  search: str = Query(default="", description="A line, all words of which must start words "
+                                                              "of the full or short name of the university"),
+                  sort: str = Query(default="short_name", description="Field name to sort by, "
+                                                                      "or rank to sort search results by relevance"),
+                  reverse: int = Query(default=0, ge=0, le=1, description="1 if sorting in descending order"),
+                  after: str = Query(default="", description="Cursor: the page after it (see pagination)"),
+                  before: str = Query(default="", description="Cursor: the page before it"),
+                  db_session: AsyncSession = Depends(get_db_session)):
     """
     Returns a page with a table of universities.
-    Secondary sort key is always short_name (if primary sort key is different).
+    Secondary sort key is always short_name (if primary sort key is different), then id.
+    The name search uses the full-text index (see fulltext): ё and е are equal, words match by prefix.
+    The page is addressed by a cursor (after, before) or by its number; page is only shown with a cursor.
     """
-    offset = (page - 1) * page_size
-    order = getattr(dbt.University, sort) if not reverse else getattr(dbt.University, sort).desc()
-    regions_list = await dbt.Region.get_list()
-    async with asyncDBSession() as db_session:
-        stmt_count = select(func.count()).select_from(dbt.University).where(and_(
-            dbt.University.deleted == 0,
-            or_(not region, dbt.University.region_name == region),
-            or_(not search, and_(True, *(dbt.University.name_search.like(f"%{word}%") for word in search.lower().split()))),
-        ))
-        all_univs_count = await db_session.scalar(stmt_count)
-        stmt = select(dbt.University).where(and_(
-            dbt.University.deleted == 0,
-            or_(not region, dbt.University.region_name == region),
-            or_(not search, and_(True, *(dbt.University.name_search.like(f"%{word}%") for word in search.lower().split()))),
-        )).order_by(order, dbt.University.short_name).offset(offset).limit(page_size)
-        on_page_univs_result = await db_session.execute(stmt)
-        univs_json = json.dumps([dm.base2model(univ, dm.UniversityViewBriefly).model_dump()
-                                 for univ in on_page_univs_result.scalars()])
-        template = lookup.get_template(f"{config.FRONT_CATALOG_NAME}/index.html")
-        session_model = await verify_session(session_data=session_data)
-        html_content = template.render(regions=regions_list,
-                                       regionFilter=region,
-                                       univs_json=univs_json,
-                                       sortColumn=sort,
-                                       reverse=reverse,
-                                       currentPage=page,
-                                       itemsPerPage=page_size,
-                                       maxPage=max(1, ceil(all_univs_count / page_size)),
-                                       nameSearchFilter=search,
-                                       auth_username=get_username_from_session_model(session_model),
-                                       can_edit=session_model and session_model.user.access_level >= dm.EDITOR_ACCESS)
-        return HTMLResponse(content=html_content)
+    matches = fulltext.search_matches(search)
+    if sort == "rank":
+        sort_column = matches.c.rank if matches is not None else dbt.University.short_name
+    else:
+        sort_column = getattr(dbt.University, sort)
+    keys = pagination.sort_keys(sort_column, dbt.University.short_name, dbt.University.id)
+    regions_list = await dbt.Region.get_list(db_session=db_session)
+    conditions = and_(
+        dbt.University.deleted == 0,
+        or_(not region, dbt.University.region_name == region),
+    )
+    stmt_count = select(func.count()).select_from(dbt.University).where(conditions)
+    stmt = select(*view_columns(dbt.University, dm.UniversityViewBriefly)).where(conditions)
+    if matches is not None:
+        stmt_count = fulltext.join_matches(stmt_count, matches)
+        stmt = fulltext.join_matches(stmt, matches)
+    all_univs_count = await pagination.count_rows(
+        db_session, stmt_count, ("universities", region, fulltext.match_query(search)))
+    on_page_univs, next_cursor, previous_cursor = await fetch_list_page(
+        db_session, stmt, keys, reverse, f"{sort}:{reverse}", page, page_size, after, before)
+    univs_json = json.dumps(on_page_univs)
+    template = lookup.get_template(f"{config.FRONT_CATALOG_NAME}/index.html")
+    html_content = template.render(regions=regions_list,
+                                   regionFilter=region,
+                                   univs_json=univs_json,
+                                   sortColumn=sort,
+                                   reverse=reverse,
+                                   currentPage=page,
+                                   itemsPerPage=page_size,
+                                   maxPage=max(1, ceil(all_univs_count / page_size)),
+                                   nextCursor=next_cursor or "",
+                                   previousCursor=previous_cursor or "",
+                                   nameSearchFilter=search,
+                                   auth_username=get_username_from_session_model(session_model),
+                                   can_edit=session_model and session_model.user.access_level >= dm.EDITOR_ACCESS)
+    return HTMLResponse(content=html_content)
 
 
 @app.get("/universities/edit/{id}", response_class=HTMLResponse)
 async def get_edit_university(id: str,
                         branch_from: str = Query(default="", description="Id of the head university"),
-                        session_data: Optional[str] = Cookie(None)):
+                        session_model: auth.SessionData | None = Depends(get_session_model),
+                        db_session: AsyncSession = Depends(get_db_session)):
     """
     Returns the page for adding a new university to the database (editor with empty fields).
     Examples:
@@ -269,7 +311,7 @@ async def get_edit_university(id: str,
         mode = "new"
         univ = None
         if branch_from:
-            head_edu_org = await dbt.University.get_by_id(branch_from)
+            head_edu_org = await dbt.University.get_by_id(branch_from, db_session=db_session)
             if not head_edu_org:
                 raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Головной вуз с данным id не найден")
             if head_edu_org.is_branch:
@@ -279,11 +321,11 @@ async def get_edit_university(id: str,
         mode = "edit"
         if branch_from:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST)
-        univ = await dbt.University.get_by_id(id)
+        univ = await dbt.University.get_by_id(id, db_session=db_session)
         if not univ:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
     template = lookup.get_template(f"{config.FRONT_CATALOG_NAME}/university_new.html")
-    session_model = await verify_session(session_data=session_data, min_access_level=dm.EDITOR_ACCESS)
+    check_access(session_model, dm.EDITOR_ACCESS)
     html_content = template.render(univ=dm.base2model(univ, dm.University).model_dump() if univ else "null",
                                    branch_from=branch_from,
                                    head_edu_org_name=head_edu_org_name,
@@ -294,39 +336,39 @@ async def get_edit_university(id: str,
 
 @app.get("/universities/{id}", response_class=HTMLResponse)
 async def get_univ_data(id: str,
-                  session_data: Optional[str] = Cookie(None)):
+                  session_model: auth.SessionData | None = Depends(get_session_model),
+                  db_session: AsyncSession = Depends(get_db_session)):
     """Returns a page with data about a university by its id in the database"""
-    async with asyncDBSession() as db_session:
-        stmt = select(dbt.University).where(and_(dbt.University.id == id,
-            dbt.University.deleted == 0)).options(selectinload(dbt.University.head_edu_org),
-            selectinload(dbt.University.branches))
-        result = await db_session.execute(stmt)
-        univ = result.scalars().first()
-        if not univ:
-            raise HTTPException(status_code=404, detail="University not found")
-        template = lookup.get_template(f"{config.FRONT_CATALOG_NAME}/university.html")
-        session_model = await verify_session(session_data=session_data)
-        html_content = template.render(univ=univ,
-                                      auth_username=get_username_from_session_model(session_model),
-                                      can_edit=session_model and session_model.user.access_level >= dm.EDITOR_ACCESS)
-        return HTMLResponse(content=html_content)
+    stmt = select(dbt.University).where(and_(dbt.University.id == id,
+        dbt.University.deleted == 0)).options(selectinload(dbt.University.head_edu_org),
+        selectinload(dbt.University.branches))
+    result = await db_session.execute(stmt)
+    univ = result.scalars().first()
+    if not univ:
+        raise HTTPException(status_code=404, detail="University not found")
+    template = lookup.get_template(f"{config.FRONT_CATALOG_NAME}/university.html")
+    html_content = template.render(univ=univ,
+                                  auth_username=get_username_from_session_model(session_model),
+                                  can_edit=session_model and session_model.user.access_level >= dm.EDITOR_ACCESS)
+    return HTMLResponse(content=html_content)
 
 
 @app.post("/{mode}/university", response_class=JSONResponse)
 async def post_edit_university(mode: Literal["new", "edit"],
                          data: dm.University = Body(),
-                         session_data: Optional[str] = Cookie(None)):
+                         session_model: auth.SessionData | None = Depends(get_session_model),
+                         db_session: AsyncSession = Depends(get_db_session)):
     """
     Updates or adds a university to the database.
     If the creation of a new record is successful, it returns its id.
     """
-    await verify_session(session_data=session_data, min_access_level=dm.EDITOR_ACCESS)
+    check_access(session_model, dm.EDITOR_ACCESS)
     try:
         if mode == "new":
-            univ = await dbt.University.add(data=data, custom=True)
+            univ = await dbt.University.add(data=data, custom=True, db_session=db_session)
             return JSONResponse({"detail": "Successfully", "id": univ.id})
         elif mode == "edit":
-            await dbt.University.update(data=data)
+            await dbt.University.update(data=data, db_session=db_session)
             return JSONResponse({"detail": "Successfully"})
     except expt.RecordNotFoundError:
         raise HTTPException(status_code=404, detail="Вуз не найден")
@@ -341,14 +383,15 @@ async def post_edit_university(mode: Literal["new", "edit"],
 
 @app.delete("/delete/university/{id}", response_class=JSONResponse)
 async def delete_university(id: str,
-                      session_data: Optional[str] = Cookie(None)):
+                      session_model: auth.SessionData | None = Depends(get_session_model),
+                      db_session: AsyncSession = Depends(get_db_session)):
     """
     Removes the university with the given id from the database,
     and also removes related educational programs and branches.
     """
-    await verify_session(session_data=session_data, min_access_level=dm.EDITOR_ACCESS)
+    check_access(session_model, dm.EDITOR_ACCESS)
     try:
-        await dbt.University.delete(id, from_parser=False)
+        await dbt.University.delete(id, from_parser=False, db_session=db_session)
         return JSONResponse(content={"detail": "Successfully"}, status_code=status.HTTP_200_OK)
     except expt.RecordNotFoundError:
         return JSONResponse(content={"detail": "Вуз не найден"}, status_code=status.HTTP_204_NO_CONTENT)
@@ -358,9 +401,9 @@ async def delete_university(id: str,
 
 
 @app.get("/profile", response_class=HTMLResponse)
-async def get_user_profile(session_data: Optional[str] = Cookie(None)):
+async def get_user_profile(session_model: auth.SessionData | None = Depends(get_session_model)):
     """Returns the user profile page"""
-    session_model = await verify_session(session_data=session_data, min_access_level=dm.READER_ACCESS)
+    check_access(session_model, dm.READER_ACCESS)
     user = session_model.user
     template = lookup.get_template(f"{config.FRONT_CATALOG_NAME}/profile.html")
     html_content = template.render(user=user,
@@ -381,14 +424,15 @@ def generate_session_token_response(session_id, session_token):
     return response
 
 
-async def create_new_session(user_id: str):
+async def create_new_session(user_id: str, db_session: AsyncSession = None):
     """
     Creates a record in the database about a new user session.
     Returns a response with session data in cookies.
     """
     session_token = auth.generate_session_token()
     try:
-        session_id = await dbt.Session.add(token_hash=auth.hash_password(session_token), user_id=user_id)
+        session_id = await dbt.Session.add(token_hash=auth.hash_password(session_token), user_id=user_id,
+                                           db_session=db_session)
     except Exception as e:
         print("ERROR:", e)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -398,18 +442,20 @@ async def create_new_session(user_id: str):
 
 @app.post("/users/create", response_class=JSONResponse)
 async def create_user(user_data: dm.UserInfoData = Body(),
-                session_data: Optional[str] = Cookie(None)):
+                session_model: auth.SessionData | None = Depends(get_session_model),
+                db_session: AsyncSession = Depends(get_db_session)):
     """
     On behalf of the administrator, creates a record about a new user in the database.
     Returns a JSON with a link that the user will need to complete registration.
     """
-    await verify_session(session_data=session_data, min_access_level=dm.ADMIN_ACCESS)
+    check_access(session_model, dm.ADMIN_ACCESS)
     reset_token = auth.generate_reset_token()
     try:
         user = await dbt.User.add(
             **user_data.model_dump(),
             password_hash=auth.hash_password(reset_token),
             incomplete_registration=1,
+            db_session=db_session,
         )
         user_id = user.id
     except expt.UniqueConstraintFailedError:
@@ -418,13 +464,13 @@ async def create_user(user_data: dm.UserInfoData = Body(),
                    f"/users/finish-reg?user_id={user_id}&token={reset_token}"}
 
 
-async def verify_reset_token(user_id: str, token: str):
+async def verify_reset_token(user_id: str, token: str, db_session: AsyncSession = None):
     """
     Verifies a token used to set a password.
     Raises an HTTP exception on failure.
     """
     try:
-        await auth.verify_reset_token(user_id=user_id, token=token)
+        await auth.verify_reset_token(user_id=user_id, token=token, db_session=db_session)
     except auth.WrongDataError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Неверная ссылка")
     except auth.ExpirationTimeError:
@@ -432,9 +478,10 @@ async def verify_reset_token(user_id: str, token: str):
 
 
 @app.get("/users/finish-reg", response_class=HTMLResponse)
-async def get_finish_registration(user_id: str, token: str):
+async def get_finish_registration(user_id: str, token: str,
+                                  db_session: AsyncSession = Depends(get_db_session)):
     """Returns the page to complete user registration"""
-    await verify_reset_token(user_id=user_id, token=token)
+    await verify_reset_token(user_id=user_id, token=token, db_session=db_session)
     template = lookup.get_template(f"{config.FRONT_CATALOG_NAME}/finish_reg.html")
     html_content = template.render(user_id=user_id,
                                    token=token)
@@ -444,15 +491,18 @@ async def get_finish_registration(user_id: str, token: str):
 @app.post("/users/finish-reg", response_class=JSONResponse)
 async def post_finish_reg(user_id: str = Query(),
                     token: str = Query(),
-                    data: dm.CreatePasswordData = Body()):
+                    data: dm.CreatePasswordData = Body(),
+                    db_session: AsyncSession = Depends(get_db_session)):
     """Sets the user password and performs authorization"""
-    await verify_reset_token(user_id=user_id, token=token)
-    await dbt.User.update_password_hash(id=user_id, password_hash=auth.hash_password(data.new_password))
-    return await create_new_session(user_id=user_id)
+    await verify_reset_token(user_id=user_id, token=token, db_session=db_session)
+    await dbt.User.update_password_hash(id=user_id, password_hash=auth.hash_password(data.new_password),
+                                        db_session=db_session)
+    return await create_new_session(user_id=user_id, db_session=db_session)
 
 
 @app.post("/register", response_class=JSONResponse)
-async def register_new_user(data: dm.UserRegData = Body()):
+async def register_new_user(data: dm.UserRegData = Body(),
+                            db_session: AsyncSession = Depends(get_db_session)):
     """Registers a new user and authorizes him"""
     password = data.new_password
     password_hash = auth.hash_password(password)
@@ -460,63 +510,69 @@ async def register_new_user(data: dm.UserRegData = Body()):
         user = await dbt.User.add(
             **data.model_dump(exclude={"new_password", "repeated_password"}),
             password_hash=password_hash,
+            db_session=db_session,
         )
     except expt.UniqueConstraintFailedError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Имя пользователя уже занято")
-    return await create_new_session(user_id=user.id)
+    return await create_new_session(user_id=user.id, db_session=db_session)
 
 
 @app.delete("/users/delete/{username}", response_class=JSONResponse)
-async def delete_user(username: str, session_data: Optional[str] = Cookie(None)):
+async def delete_user(username: str, session_model: auth.SessionData | None = Depends(get_session_model),
+                      db_session: AsyncSession = Depends(get_db_session)):
     """Deletes a user record upon request from the administrator"""
-    session_model = await verify_session(session_data=session_data, min_access_level=dm.ADMIN_ACCESS)
+    check_access(session_model, dm.ADMIN_ACCESS)
     if session_model.user.username == username:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Операция не выполнена: вы можете удалить "
                                                                           "свой профиль в личном кабинете.")
-    await dbt.User.delete_user(id_or_username=username, by_id=False)
+    await dbt.User.delete_user(id_or_username=username, by_id=False, db_session=db_session)
     return JSONResponse({"status_ok": True})
 
 
 @app.delete("/delete-user", response_class=JSONResponse)
-async def delete_user_self(session_data: Optional[str] = Cookie(None)):
+async def delete_user_self(session_model: auth.SessionData | None = Depends(get_session_model),
+                           db_session: AsyncSession = Depends(get_db_session)):
     """Deletes a user record upon request from the user"""
-    session_model = await verify_session(session_data=session_data, min_access_level=dm.READER_ACCESS)
-    await dbt.User.delete_user(id_or_username=session_model.user.username, by_id=False)
+    check_access(session_model, dm.READER_ACCESS)
+    await dbt.User.delete_user(id_or_username=session_model.user.username, by_id=False, db_session=db_session)
 
 
 @app.post("/login", response_class=JSONResponse)
-async def login(data: dm.LoginData = Body()):
+async def login(data: dm.LoginData = Body(),
+                db_session: AsyncSession = Depends(get_db_session)):
     """Authorizes the user by username and password"""
     username, password = data.username, data.password
-    user = await dbt.User.get_by_username(username=username)
+    user = await dbt.User.get_by_username(username=username, db_session=db_session)
     if not user or not auth.verify_password(user.password_hash, password):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Неверное имя пользователя или пароль")
-    return await create_new_session(user_id=user.id)
+    return await create_new_session(user_id=user.id, db_session=db_session)
 
 
 @app.post("/logout", response_class=JSONResponse)
-async def logout(session_data: Optional[str] = Cookie(None)):
+async def logout(session_model: auth.SessionData | None = Depends(get_session_model),
+                 db_session: AsyncSession = Depends(get_db_session)):
     """Ends the current session"""
-    session_model = await verify_session(session_data=session_data)
     if not session_model:
         return
-    await dbt.Session.end(session_model.user.id, include_id=session_model.session_id)
+    await dbt.Session.end(session_model.user.id, include_id=session_model.session_id, db_session=db_session)
 
 
 @app.post("/logout/all", response_class=JSONResponse)
-async def logout_all(session_data: Optional[str] = Cookie(None)):
+async def logout_all(session_model: auth.SessionData | None = Depends(get_session_model),
+                     db_session: AsyncSession = Depends(get_db_session)):
     """Ends all sessions except the current one"""
-    session_model = await verify_session(session_data=session_data, min_access_level=dm.READER_ACCESS)
-    await dbt.Session.end(session_model.user.id, exclude_id=session_model.session_id)
+    check_access(session_model, dm.READER_ACCESS)
+    await dbt.Session.end(session_model.user.id, exclude_id=session_model.session_id, db_session=db_session)
 
 
 @app.post("/change_personal_data", response_class=JSONResponse)
 async def change_personal_data(data: dm.UserOwnData,
-                         session_data: Optional[str] = Cookie(None)):
+                         session_model: auth.SessionData | None = Depends(get_session_model),
+                         db_session: AsyncSession = Depends(get_db_session)):
     """Changes the user's personal data at the user's request"""
-    session_model = await verify_session(session_data=session_data, min_access_level=dm.READER_ACCESS)
+    check_access(session_model, dm.READER_ACCESS)
     try:
-        await dbt.User.update_personal_data(id=session_model.user.id, personal_data=data)
+        await dbt.User.update_personal_data(id=session_model.user.id, personal_data=data, db_session=db_session)
         return JSONResponse({"detail": "Профиль обновлен"})
     except expt.UniqueConstraintFailedError:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Имя пользователя уже занято")
@@ -528,16 +584,19 @@ async def change_personal_data(data: dm.UserOwnData,
 
 @app.post("/change_password", response_class=JSONResponse)
 async def change_password(data: dm.ChangePasswordData,
-                    session_data: Optional[str] = Cookie(None)):
+                    session_model: auth.SessionData | None = Depends(get_session_model),
+                    db_session: AsyncSession = Depends(get_db_session)):
     """Changes user password, ends all sessions except the current one"""
-    session_model = await verify_session(session_data=session_data, min_access_level=dm.READER_ACCESS)
-    user = await dbt.User.get_by_id(session_model.user.id)
+    check_access(session_model, dm.READER_ACCESS)
+    user = await dbt.User.get_by_id(session_model.user.id, db_session=db_session)
     if not auth.verify_password(user.password_hash, data.password):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Неверный пароль")
     try:
         await dbt.User.update_password_hash(id=session_model.user.id,
-                                            password_hash=auth.hash_password(data.new_password))
-        await dbt.Session.end(user_id=session_model.user.id, exclude_id=session_model.session_id)
+                                            password_hash=auth.hash_password(data.new_password),
+                                            db_session=db_session)
+        await dbt.Session.end(user_id=session_model.user.id, exclude_id=session_model.session_id,
+                              db_session=db_session)
         return JSONResponse({"status_ok": True,
                              "detail": "Пароль успешно изменен. Завершены все сессии, кроме текущей"})
     except Exception as e:
@@ -548,31 +607,33 @@ async def change_password(data: dm.ChangePasswordData,
 
 @app.post("/set_rights", response_class=JSONResponse)
 async def set_rights(data: dm.ChangeAccessData = Body(),
-               session_data: Optional[str] = Cookie(None)):
+               session_model: auth.SessionData | None = Depends(get_session_model),
+               db_session: AsyncSession = Depends(get_db_session)):
     """Assigns user rights upon request from administrator"""
-    await verify_session(session_data=session_data, min_access_level=dm.ADMIN_ACCESS)
+    check_access(session_model, dm.ADMIN_ACCESS)
     try:
-        await dbt.User.update_access_level(username=data.username, access_level=data.new_access_level)
+        await dbt.User.update_access_level(username=data.username, access_level=data.new_access_level,
+                                           db_session=db_session)
     except expt.RecordNotFoundError:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail="Такого пользователя не существует")
 
 
 @app.get("/admin-panel", response_class=HTMLResponse)
-async def get_admin_panel(session_data: Optional[str] = Cookie(None),
+async def get_admin_panel(session_model: auth.SessionData | None = Depends(get_session_model),
                    page: int = Query(default=1, ge=1),
-                   page_size: int = Query(default=config.DEFAULT_PAGE_SIZE, ge=1)):
+                   page_size: int = Query(default=config.DEFAULT_PAGE_SIZE, ge=1),
+                   db_session: AsyncSession = Depends(get_db_session)):
     """Returns a page with a table of data about registered users"""
-    await verify_session(session_data=session_data, min_access_level=dm.ADMIN_ACCESS)
+    check_access(session_model, dm.ADMIN_ACCESS)
     offset = (page - 1) * page_size
-    async with asyncDBSession() as db_session:
-        all_users_count = await db_session.scalar(select(func.count()).select_from(dbt.User))
-        max_page = max(1, ceil(all_users_count / page_size))
-        if page > max_page:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
-        stmt = select(dbt.User).offset(offset).limit(page_size)
-        result = await db_session.execute(stmt)
-        users = result.scalars()
+    all_users_count = await db_session.scalar(select(func.count()).select_from(dbt.User))
+    max_page = max(1, ceil(all_users_count / page_size))
+    if page > max_page:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+    stmt = select(dbt.User).offset(offset).limit(page_size)
+    result = await db_session.execute(stmt)
+    users = result.scalars()
     template = lookup.get_template(f"{config.FRONT_CATALOG_NAME}/users_redactor.html")
     html_content = template.render(users=users,
                                    currentPage=page,
@@ -586,19 +647,18 @@ async def get_admin_panel(session_data: Optional[str] = Cookie(None),
 
 
 @app.get("/server-panel", response_class=HTMLResponse)
-async def get_server_panel(session_data: Optional[str] = Cookie(None)):
+async def get_server_panel(session_model: auth.SessionData | None = Depends(get_session_model)):
     """Returns a page for control updating DB"""
-    await verify_session(session_data=session_data, min_access_level=dm.ADMIN_ACCESS)
+    check_access(session_model, dm.ADMIN_ACCESS)
     template = lookup.get_template(f"{config.FRONT_CATALOG_NAME}/server_panel.html")
-    html_content = template.render()
+    html_content = template.render(stages_json=json.dumps(metrics.STAGES))
     return HTMLResponse(content=html_content)
 
 
 @app.get("/auth.js", response_class=FileResponse)
-async def get_auth_js_resource(session_data: Optional[str] = Cookie(None)):
+async def get_auth_js_resource(session_model: auth.SessionData | None = Depends(get_session_model)):
     """Returns a file required"""
     template = lookup.get_template(f"{config.FRONT_CATALOG_NAME}/auth.js")
-    session_model = await verify_session(session_data=session_data)
     content = template.render(auth_username=get_username_from_session_model(session_model))
     return HTMLResponse(content=content)
 
@@ -629,26 +689,80 @@ async def get_resource(filename: str, resources_white_list: list[str] = Depends(
 
 # Эндпоинты для управления загрузкой
 @app.post("/opendata/update")
-async def update_data(scheduler = Depends(lambda: app.state.scheduler),
-                      session_data: Optional[str] = Cookie(None)):
-    """Ручной запуск обновления данных (только для админа)"""
-    await verify_session(session_data=session_data, min_access_level=dm.ADMIN_ACCESS)
+async def update_data(jobs: RefreshJobManager = Depends(lambda: app.state.jobs),
+                      session_model: auth.SessionData | None = Depends(get_session_model)):
+    """Ручной запуск обновления данных; если обновление уже идет, возвращает его (только для админа)"""
+    check_access(session_model, dm.ADMIN_ACCESS)
     try:
-        scheduler.stop()
-        scheduler.start()
-        return {"status": "success"}
+        job, joined = await jobs.submit(trigger="manual", force=True)
+        return {"status": "success", "job": job, "joined": joined}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/opendata/jobs", response_class=JSONResponse)
+async def get_refresh_jobs(jobs: RefreshJobManager = Depends(lambda: app.state.jobs),
+                           scheduler = Depends(lambda: app.state.scheduler),
+                           session_model: auth.SessionData | None = Depends(get_session_model)):
+    """Текущее обновление данных с ходом выполнения, история обновлений и состояние расписания (только для админа)"""
+    check_access(session_model, dm.ADMIN_ACCESS)
+    return {"current": await jobs.current_job(),
+            "history": jobs.history(),
+            "schedule": await scheduler.get_status()}
+
+
+@app.post("/opendata/jobs/cancel", response_class=JSONResponse)
+async def cancel_refresh_job(jobs: RefreshJobManager = Depends(lambda: app.state.jobs),
+                             session_model: auth.SessionData | None = Depends(get_session_model)):
+    """Отмена текущего обновления данных (только для админа)"""
+    check_access(session_model, dm.ADMIN_ACCESS)
+    if await jobs.cancel():
+        return {"info": "Обновление будет остановлено после текущей пачки данных"}
+    return {"info": "Обновление данных не выполняется"}
+
+
+@app.get("/opendata/events")
+async def stream_refresh_events(jobs: RefreshJobManager = Depends(lambda: app.state.jobs),
+                                events: EventBroadcaster = Depends(lambda: app.state.events),
+                                scheduler = Depends(lambda: app.state.scheduler),
+                                session_model: auth.SessionData | None = Depends(get_session_model),
+                                db_session: AsyncSession = Depends(get_db_session)):
+    """
+    Поток server-sent events о ходе обновления данных и изменениях расписания (только для админа).
+    Первое событие (snapshot) - текущее обновление, история обновлений и состояние расписания.
+    """
+    check_access(session_model, dm.ADMIN_ACCESS)
+    # Сессия запроса закрылась бы только вместе с потоком: соединение с БД возвращается в пул сразу
+    await db_session.close()
+    schedule_status = events.schedule_status or await scheduler.get_status()
+
+    async def stream():
+        with events.subscribe() as queue:
+            yield "retry: 5000\n" + events.format("snapshot", {"current": await jobs.current_job(),
+                                                                "history": jobs.history(),
+                                                                "schedule": schedule_status})
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), config.EVENTS_HEARTBEAT_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                if message is None:
+                    return
+                yield message
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 @app.post("/opendata/schedule/start", response_class=JSONResponse)
 async def start_scheduled_download(body = Body(),
                                    scheduler = Depends(lambda: app.state.scheduler),
-                                   session_data: Optional[str] = Cookie(None)):
+                                   session_model: auth.SessionData | None = Depends(get_session_model)):
     """Запуск периодической загрузки (только для админа)"""
-    await verify_session(session_data=session_data, min_access_level=dm.ADMIN_ACCESS)
+    check_access(session_model, dm.ADMIN_ACCESS)
     try:
-        scheduler.start(interval_seconds=body["interval_seconds"])
+        await scheduler.start(interval_seconds=body["interval_seconds"])
         return {"info": "Периодическое обновление запущено"}
     except Exception as e:
         return {"info": "Не удалось запустить периодическое обновление"}
@@ -656,27 +770,39 @@ async def start_scheduled_download(body = Body(),
 
 @app.post("/opendata/schedule/stop", response_class=JSONResponse)
 async def stop_scheduled_download(scheduler = Depends(lambda: app.state.scheduler),
-                                  session_data: Optional[str] = Cookie(None)):
+                                  session_model: auth.SessionData | None = Depends(get_session_model)):
     """Остановка периодической загрузки (только для админа)"""
-    await verify_session(session_data=session_data, min_access_level=dm.ADMIN_ACCESS)
+    check_access(session_model, dm.ADMIN_ACCESS)
     print("Try stop")
-    scheduler.stop()
+    await scheduler.stop()
     return {"info": "Периодическое обновление остановлено"}
 
 
 @app.post("/opendata/schedule/check", response_class=JSONResponse)
 async def stop_scheduled_download(scheduler = Depends(lambda: app.state.scheduler),
-                                  session_data: Optional[str] = Cookie(None)):
+                                  session_model: auth.SessionData | None = Depends(get_session_model)):
     """Проверка периодической загрузки (только для админа)"""
-    await verify_session(session_data=session_data, min_access_level=dm.ADMIN_ACCESS)
-    if scheduler.is_run():
-        return {"status": 1}
-    return {"status": 0}
+    check_access(session_model, dm.ADMIN_ACCESS)
+    schedule_status = await scheduler.get_status()
+    return {"status": int(schedule_status["enabled"]), **schedule_status}
+
+
+class Server(uvicorn.Server):
+    """Closes server-sent event streams on shutdown, otherwise uvicorn would wait for them to end forever"""
+
+    async def shutdown(self, sockets=None):
+        app.state.events.close()
+        await super().shutdown(sockets)
 
 
 async def main():
     await dbt.create_tables()
-    app.state.scheduler = schedule.Scheduler()
+    app.state.worker = IngestionWorker()
+    app.state.jobs = RefreshJobManager(app.state.worker)
+    app.state.scheduler = schedule.Scheduler(app.state.jobs)
+    app.state.events = EventBroadcaster(app.state.jobs, app.state.scheduler)
+    app.state.jobs.run_watcher()
+    app.state.scheduler.run()
     conf = uvicorn.Config(
         app=app,
         host=config.HOST,
@@ -684,8 +810,13 @@ async def main():
         log_level="info",
         reload=False,
     )
-    server = uvicorn.Server(conf)
-    await server.serve()
+    server = Server(conf)
+    try:
+        await server.serve()
+    finally:
+        await app.state.scheduler.shutdown()
+        app.state.jobs.shutdown()
+        await app.state.worker.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,135 @@
+import json
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from pydantic import BaseModel
+from exceptions import RefreshCancelledError
+
+
+HISTORY_FILE = Path("ingestion_history.json")
+HISTORY_LIMIT = 100  # Число последних запусков, которые хранятся в истории
+
+STAGES = ("download", "extract", "parse", "insert", "update", "delete", "swap", "tip_tables")
+
+
+class StageMetrics(BaseModel):
+    """Время и счетчики одного этапа обновления данных"""
+    name: str
+    seconds: float = 0
+    bytes: int = 0
+    records: int = 0
+    retries: int = 0
+    errors: int = 0
+
+
+class IngestionRun(BaseModel):
+    """Один запуск обновления данных из реестра"""
+    id: str
+    trigger: str
+    started_at: str
+    finished_at: str | None = None
+    status: str = "running"
+    error: str | None = None
+    stages: dict[str, StageMetrics] = {}
+    changes: dict | None = None
+    records: int = 0  # Число записей выгрузки, записанных в БД
+    progress: float | None = None  # Доля разобранной выгрузки в процентах, если известен ее размер
+
+    def get_stage(self, name: str) -> StageMetrics:
+        if name not in self.stages:
+            self.stages[name] = StageMetrics(name=name)
+        return self.stages[name]
+
+
+_current_run: IngestionRun | None = None
+_cancel_requested = False
+
+
+def current_run() -> IngestionRun | None:
+    return _current_run
+
+
+def start_run(trigger: str, run_id: str | None = None) -> IngestionRun:
+    """Начинает учет нового запуска обновления; trigger - кто его запустил (periodic, manual)"""
+    global _current_run, _cancel_requested
+    _cancel_requested = False
+    _current_run = IngestionRun(id=run_id or str(uuid.uuid4()), trigger=trigger,
+                                started_at=datetime.now().isoformat(timespec="seconds"))
+    return _current_run
+
+
+def request_cancel() -> None:
+    """Просит текущий запуск остановиться при следующей проверке check_cancelled"""
+    global _cancel_requested
+    _cancel_requested = True
+
+
+def check_cancelled() -> None:
+    """Вызывается между пачками и кусками данных: прерывает запуск, если его попросили отменить"""
+    if _cancel_requested and _current_run is not None:
+        raise RefreshCancelledError()
+
+
+def set_progress(done_bytes: int, total_bytes: int | None) -> None:
+    """Обновляет долю разобранной выгрузки текущего запуска"""
+    if _current_run is not None and total_bytes:
+        _current_run.progress = round(min(100.0, 100 * done_bytes / total_bytes), 1)
+
+
+def add_records(count: int) -> None:
+    if _current_run is not None:
+        _current_run.records += count
+
+
+def finish_run(status: str, error: str | None = None, changes: dict | None = None) -> IngestionRun | None:
+    """Завершает текущий запуск и сохраняет его в историю"""
+    global _current_run
+    run = _current_run
+    if not run:
+        return None
+    run.status = status
+    run.error = error
+    run.changes = changes
+    run.finished_at = datetime.now().isoformat(timespec="seconds")
+    _current_run = None
+    history = load_history()
+    history.append(run.model_dump())
+    try:
+        with open(HISTORY_FILE, "w") as f:
+            json.dump(history[-HISTORY_LIMIT:], f, ensure_ascii=False)
+    except Exception as e:
+        print(f"Ошибка при сохранении истории обновлений: {e}")
+    return run
+
+
+def load_history() -> list[dict]:
+    """Возвращает сохраненные запуски, от старых к новым"""
+    if not HISTORY_FILE.exists():
+        return []
+    try:
+        with open(HISTORY_FILE, "r") as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"Ошибка при загрузке истории обновлений: {e}")
+        return []
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Замеряет время этапа текущего запуска. Этап можно открывать несколько раз, время суммируется.
+    Возвращает StageMetrics для счетчиков; если запуск не начат, счетчики никуда не сохраняются.
+    Исключение внутри этапа увеличивает счетчик ошибок.
+    """
+    run = _current_run
+    stage_metrics = run.get_stage(name) if run else StageMetrics(name=name)
+    start = time.perf_counter()
+    try:
+        yield stage_metrics
+    except Exception:
+        stage_metrics.errors += 1
+        raise
+    finally:
+        stage_metrics.seconds = round(stage_metrics.seconds + time.perf_counter() - start, 3)
@@ -0,0 +1,128 @@
+"""
+Versioned schema migrations of the SQLite database.
+The schema version is stored in PRAGMA user_version: migration number N (1-based position in MIGRATIONS)
+has been applied if user_version >= N. The version is raised after each successful migration,
+so a failed one is retried on the next start; migrations are written to be safe to run again.
+A migration receives a synchronous connection and the declared metadata; it must not rely on
+the declared models beyond what it names explicitly, because they keep changing after it is written.
+"""
+import sqlalchemy
+from sqlalchemy import text
+import fulltext
+
+
+def _add_columns(sync_conn, metadata: sqlalchemy.MetaData, columns: dict[str, list[str]]) -> None:
+    """Adds the declared columns {table: [column, ...]} that are missing in the database"""
+    inspector = sqlalchemy.inspect(sync_conn)
+    for table_name, column_names in columns.items():
+        existing_columns = {column["name"] for column in inspector.get_columns(table_name)}
+        for column_name in column_names:
+            if column_name not in existing_columns:
+                column = metadata.tables[table_name].columns[column_name]
+                column_type = column.type.compile(dialect=sync_conn.dialect)
+                sync_conn.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}"))
+
+
+def _create_indexes(sync_conn, metadata: sqlalchemy.MetaData, names: list[str]) -> None:
+    """Creates the declared indexes with the given names, if they do not exist yet"""
+    indexes = {index.name: index for table in metadata.tables.values() for index in table.indexes}
+    for name in names:
+        indexes[name].create(sync_conn, checkfirst=True)
+
+
+def add_registry_hash(sync_conn, metadata: sqlalchemy.MetaData) -> None:
+    """Registry record fingerprints, used to skip unchanged records on update"""
+    _add_columns(sync_conn, metadata, {"universities": ["registry_hash"],
+                                       "educational_programs": ["registry_hash"]})
+
+
+def add_list_indexes(sync_conn, metadata: sqlalchemy.MetaData) -> None:
+    """Indexes for the filters and sort orders of the /universities and /eduprograms pages"""
+    _create_indexes(sync_conn, metadata, [
+        "ix_universities_deleted_short_name",
+        "ix_universities_deleted_full_name",
+        "ix_universities_deleted_region_name",
+        "ix_universities_deleted_kind_name",
+        "ix_universities_deleted_is_branch",
+        "ix_universities_head_edu_org_id",
+        "ix_educational_programs_deleted_programm_code",
+        "ix_educational_programs_deleted_ugs_code",
+        "ix_educational_programs_deleted_edu_level_name",
+        "ix_educational_programs_university_id",
+    ])
+
+
+def add_university_search(sync_conn, metadata: sqlalchemy.MetaData) -> None:
+    """Full-text index of university names, replacing the name_search column and its LIKE search"""
+    sync_conn.execute(text("DROP INDEX IF EXISTS ix_universities_deleted_short_name"))
+    if "name_search" in {column["name"] for column in sqlalchemy.inspect(sync_conn).get_columns("universities")}:
+        sync_conn.execute(text("ALTER TABLE universities DROP COLUMN name_search"))
+    _create_indexes(sync_conn, metadata, ["ix_universities_deleted_short_name"])
+    fulltext.create_index(sync_conn)
+
+
+def add_keyset_indexes(sync_conn, metadata: sqlalchemy.MetaData) -> None:
+    """
+    Keyset pagination of the list pages: id is added to the list indexes as the tiebreaker,
+    and NULL in the sort columns of older rows is replaced by the values data_models give empty fields,
+    so that the sort key can be compared as a row value.
+    """
+    sort_columns = {
+        "universities": {"full_name": "''", "short_name": "''", "kind_name": "''", "region_name": "''",
+                         "is_branch": "0"},
+        "educational_programs": {"type_name": "''", "edu_level_name": "''", "ugs_code": "''", "ugs_name": "''",
+                                 "programm_code": "''", "programm_name": "''", "qualification": "''",
+                                 "edu_normative_period": "''", "is_accredited": "0", "is_canceled": "0",
+                                 "is_suspended": "0"},
+    }
+    for table_name, columns in sort_columns.items():
+        for column_name, empty_value in columns.items():
+            sync_conn.execute(text(f"UPDATE {table_name} SET {column_name} = {empty_value} "
+                                   f"WHERE {column_name} IS NULL"))
+    index_names = [
+        "ix_universities_deleted_short_name",
+        "ix_universities_deleted_full_name",
+        "ix_universities_deleted_region_name",
+        "ix_universities_deleted_kind_name",
+        "ix_universities_deleted_is_branch",
+        "ix_educational_programs_deleted_programm_code",
+        "ix_educational_programs_deleted_ugs_code",
+        "ix_educational_programs_deleted_edu_level_name",
+        "ix_educational_programs_university_id",
+    ]
+    for name in index_names:
+        sync_conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+    _create_indexes(sync_conn, metadata, index_names)
+
+
+MIGRATIONS = [
+    add_registry_hash,
+    add_list_indexes,
+    add_university_search,
+    add_keyset_indexes,
+]
+
+
+def get_version(sync_conn) -> int:
+    return sync_conn.exec_driver_sql("PRAGMA user_version").scalar()
+
+
+def _set_version(sync_conn, version: int) -> None:
+    sync_conn.exec_driver_sql(f"PRAGMA user_version = {int(version)}")
+
+
+def migrate(sync_conn, metadata: sqlalchemy.MetaData) -> None:
+    """
+    Creates missing tables and applies pending migrations.
+    A new database file is created from the declared metadata at once and marked as up to date.
+    """
+    version = get_version(sync_conn)
+    is_new = not sqlalchemy.inspect(sync_conn).get_table_names()
+    metadata.create_all(sync_conn)
+    if is_new:
+        _set_version(sync_conn, len(MIGRATIONS))
+        return
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        print(f"Миграция БД {number}: {migration.__name__}")
+        migration(sync_conn, metadata)
+        _set_version(sync_conn, number)
@@ -0,0 +1,143 @@
+"""
+Pagination of the list pages (/universities, /eduprograms).
+A page is either addressed by its number (OFFSET) or by a cursor: the sort key values of the row next to it.
+A cursor page is read with an index range scan that starts right at the cursor, so a deep page costs
+the same as the first one. Cursors are opaque to the client and stay valid across requests and data updates:
+they point between rows, not at a position.
+Sort columns are never NULL (data_models turn empty values into "" and 0, see migrations.add_keyset_indexes),
+so rows are compared as row values, which SQLite answers from the list indexes (see db_tables).
+The total number of rows, needed for the page count, is cached by the list filters (CountCache),
+so a list request usually runs one statement: the page itself.
+"""
+import base64
+from collections import OrderedDict
+import json
+import time
+from sqlalchemy import tuple_
+import config
+
+
+class InvalidCursorError(Exception):
+    """The cursor is malformed or was made for another sort order"""
+
+
+class CountCache:
+    """
+    Row counts of list statements by their filters {key: (expiration time, count)}, least recently used first.
+    The cache is dropped whenever the data changes (db_tables.invalidate_data_caches);
+    writes of other server instances are not seen, so entries also expire after config.LIST_COUNT_CACHE_TTL.
+    """
+    _counts = OrderedDict()
+    _generation = 0
+
+    @classmethod
+    def get(cls, key: tuple) -> int | None:
+        try:
+            expiration_time, count = cls._counts[key]
+        except KeyError:
+            return None
+        if time.monotonic() >= expiration_time:
+            del cls._counts[key]
+            return None
+        cls._counts.move_to_end(key)
+        return count
+
+    @classmethod
+    def set(cls, key: tuple, count: int, generation: int) -> None:
+        """Stores the count unless the cache was invalidated after generation was read"""
+        if generation != cls._generation:
+            return
+        cls._counts[key] = (time.monotonic() + config.LIST_COUNT_CACHE_TTL, count)
+        cls._counts.move_to_end(key)
+        while len(cls._counts) > config.LIST_COUNT_CACHE_SIZE:
+            cls._counts.popitem(last=False)
+
+    @classmethod
+    def generation(cls) -> int:
+        return cls._generation
+
+    @classmethod
+    def invalidate(cls) -> None:
+        cls._counts.clear()
+        cls._generation += 1
+
+
+async def count_rows(db_session, stmt_count, key: tuple) -> int:
+    """
+    Returns the result of the count statement stmt_count, cached by key.
+    :param key: list name and all filter values stmt_count depends on.
+    """
+    count = CountCache.get(key)
+    if count is None:
+        generation = CountCache.generation()
+        count = await db_session.scalar(stmt_count)
+        CountCache.set(key, count, generation)
+    return count
+
+
+def sort_keys(column, secondary_column, id_column) -> list:
+    """Returns the sort key of a list page: the sort column, the secondary key and the id as the tiebreaker"""
+    keys = []
+    for key in (column, secondary_column, id_column):
+        if not any(key is existing for existing in keys):
+            keys.append(key)
+    return keys
+
+
+def order_by(keys: list, reverse: bool) -> list:
+    """Returns ORDER BY terms; all keys go in the same direction, so SQLite reads the index forwards or backwards"""
+    return [key.desc() for key in keys] if reverse else list(keys)
+
+
+def encode_cursor(scope: str, values) -> str:
+    data = json.dumps([scope, list(values)], ensure_ascii=False, separators=(",", ":"))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, scope: str, count: int) -> list:
+    """Returns the sort key values of a cursor made by encode_cursor with the same scope"""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        cursor_scope, values = data
+    except (ValueError, TypeError):
+        raise InvalidCursorError("Malformed cursor")
+    if (cursor_scope != scope or not isinstance(values, list) or len(values) != count
+            or not all(isinstance(value, (str, int, float)) for value in values)):
+        raise InvalidCursorError("The cursor does not match the sort order")
+    return values
+
+
+async def fetch_page(db_session, stmt, keys: list, reverse: bool, scope: str, page: int, page_size: int,
+                     after: str = "", before: str = "") -> tuple[list[dict], str | None, str | None]:
+    """
+    Returns the rows of a page of stmt as dicts {column name: value}
+    and the cursors of the next and the previous page (None if there is none).
+    The page is the one after the cursor after, before the cursor before, or the page number page.
+    :param stmt: select of plain columns; it must not have its own ORDER BY, OFFSET or LIMIT.
+    :param keys: sort key (sort_keys).
+    :param scope: sort order name; a cursor is accepted only by the sort order it was made for.
+    """
+    backward = bool(before) and not after
+    cursor = after or before
+    descending = reverse != backward
+    names = list(stmt.selected_columns.keys())
+    width = len(names)
+    stmt = stmt.add_columns(*keys).order_by(*order_by(keys, descending)).limit(page_size + 1)
+    if cursor:
+        values = decode_cursor(cursor, scope, len(keys))
+        row_key = tuple_(*keys)
+        stmt = stmt.where(row_key < tuple_(*values) if descending else row_key > tuple_(*values))
+    else:
+        stmt = stmt.offset((page - 1) * page_size)
+    rows = (await db_session.execute(stmt)).all()
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if backward:
+        rows.reverse()
+    if not rows:
+        return [], None, None
+    # Backwards, the rows after the page are the ones from the cursor on
+    next_cursor = encode_cursor(scope, rows[-1][width:]) if has_more or backward else None
+    has_previous = (backward and has_more) or (not backward and (bool(cursor) or page > 1))
+    previous_cursor = encode_cursor(scope, rows[0][width:]) if has_previous else None
+    return [dict(zip(names, row[:width])) for row in rows], next_cursor, previous_cursor
@@ -1,30 +1,59 @@
 import asyncio
+import multiprocessing
+import re
+import zipfile
 import xml.etree.ElementTree as et
-from sqlalchemy import select
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 import config
 import db_tables as dbt
 import data_models as dm
+import snapshot
+import metrics
 import datetime
-from database import asyncDBSession
+import os
 
 
-async def update_DB(data_filename=config.DATAFILENAME):
+async def update_DB(data_filename: str | None = None):
+    """
+    Обновляет БД по выгрузке реестра: записывает новые и изменившиеся записи, удаляет исчезнувшие,
+    после чего обновляет списки для полей фильтрации.
+    data_filename: XML-файл или zip-архив с ним; по умолчанию - выгрузка из config.find_data_file().
+    При config.REFRESH_MODE == "shadow" новые данные собираются в теневых таблицах,
+    которые затем одной транзакцией подменяют рабочие.
+    Возвращает сводку изменений: число добавленных, измененных, неизменных и удаленных вузов и ОП.
+    """
+    data_filename = data_filename or config.find_data_file()
+    if data_filename is None:
+        raise FileNotFoundError(f"Выгрузка реестра не найдена в {config.DATA_DIR}")
     print("BD UPDATING")
-    actual_univs_id, actual_eduprogs_id = await xml_parse(filename=data_filename)
-    async with asyncDBSession() as db_session:
-        cur_univs_result = await db_session.execute(select(dbt.University))
-        cur_univs = cur_univs_result.scalars()
-        cur_eduprogs_result = await db_session.execute(select(dbt.EduProg))
-        cur_eduprogs = cur_eduprogs_result.scalars()
-    cur_univs_id = set(univ.id for univ in cur_univs)
-    cur_eduprogs_id = set(prog.id for prog in cur_eduprogs)
-    univs_to_delete_id = cur_univs_id - actual_univs_id
-    eduprogs_to_delete_id = cur_eduprogs_id - actual_eduprogs_id
-    print(f"Вузов к удалению: {len(univs_to_delete_id)}. ОП к удалению: {len(eduprogs_to_delete_id)}.")
-    for univ_id in univs_to_delete_id:
-        await dbt.University.delete(id=univ_id, from_parser=True)
-    for eduprog_id in eduprogs_to_delete_id:
-        await dbt.EduProg.delete(id=eduprog_id, from_parser=True)
+    if config.REFRESH_MODE == "shadow":
+        await dbt.create_shadow_tables()
+        univ_changes, eduprog_changes = await xml_parse(filename=data_filename, shadow=True)
+        metrics.check_cancelled()
+        with metrics.stage("swap") as stage_metrics:
+            univ_changes.removed, eduprog_changes.removed = await dbt.swap_shadow_tables()
+            stage_metrics.records += univ_changes.removed + eduprog_changes.removed
+    else:
+        univ_changes, eduprog_changes = await xml_parse(filename=data_filename)
+        metrics.check_cancelled()
+        with metrics.stage("delete") as stage_metrics:
+            univ_changes.removed, eduprog_changes.removed = await dbt.delete_missing_registry_records(
+                actual_univs_id=univ_changes.actual_ids,
+                actual_eduprogs_id=eduprog_changes.actual_ids,
+            )
+            stage_metrics.records += univ_changes.removed + eduprog_changes.removed
+    with metrics.stage("tip_tables"):
+        await dbt.refresh_tip_tables()
+    summary = {"universities": univ_changes.summary(), "educational_programs": eduprog_changes.summary()}
+    print("Изменения вузов:", summary["universities"])
+    print("Изменения ОП:", summary["educational_programs"])
+    return summary
+
+
+READ_BLOCK_SIZE = 1 << 20
+XML_ENCODING_PATTERN = re.compile(rb"""\s*<\?xml[^>]*?encoding=["']([A-Za-z0-9._-]+)["']""")
 
 
 def is_accredited_validator(value) -> int:
@@ -32,131 +61,379 @@ def is_accredited_validator(value) -> int:
     return int(not value)
 
 
-async def xml_parse(filename: str):
-    def sync_xml_parse():
-        univ_models = []
-        eduprog_models = []
-        today = str(datetime.date.today())
-        suppl_statuses = set()
-        cert_statuses = set()
-        tree = et.parse(filename)
-        root = tree.getroot()
-        certificates = root.findall("Certificates/Certificate")
-        for cert in certificates:
-            cert_status_name = cert.find("StatusName").text
-            cert_end_date = cert.find("EndDate").text
-            cert_statuses.add(cert_status_name)
-            if cert_status_name != "Действующее" or cert_end_date and cert_end_date < today:
+def is_univ_data(univ_model: dm.University) -> bool:
+    """Проверяет, относится ли организация к высшему образованию"""
+    return not ("общеобр" in univ_model.full_name.lower()
+                or "колледж" in univ_model.full_name.lower()
+                or not ("высшего" in univ_model.full_name.lower() or "высшего" in univ_model.type_name.lower()))
+
+
+# Поля модели вуза и соответствующие им теги элемента ActualEducationOrganization
+EDU_ORG_TAGS = {
+    "id": "Id",
+    "full_name": "FullName",
+    "short_name": "ShortName",
+    "head_edu_org_id": "HeadEduOrgId",
+    "is_branch": "IsBranch",
+    "post_address": "PostAddress",
+    "phone": "Phone",
+    "fax": "Fax",
+    "email": "Email",
+    "web_site": "WebSite",
+    "ogrn": "OGRN",
+    "inn": "INN",
+    "kpp": "KPP",
+    "head_post": "HeadPost",
+    "head_name": "HeadName",
+    "form_name": "FormName",
+    "kind_name": "KindName",
+    "type_name": "TypeName",
+    "region_name": "RegionName",
+    "federal_district_name": "FederalDistrictName",
+}
+
+
+class UniversityIndex:
+    """
+    Индекс организаций по id на время одного разбора выгрузки.
+    Одна и та же организация встречается в свидетельстве и в каждом его приложении:
+    модель вуза строится один раз, а в БД передается, только если встречена впервые или с другими полями
+    (в этом случае побеждает последняя версия).
+    """
+
+    def __init__(self):
+        self._models = {}
+        self._emitted = {}
+
+    def get_model(self, values: tuple) -> dm.University:
+        """Возвращает модель вуза по значениям полей, создавая ее только для новых значений"""
+        id = values[0]
+        cached = self._models.get(id)
+        if cached and cached[0] == values:
+            return cached[1]
+        univ_model = dm.University(**dict(zip(EDU_ORG_TAGS, values)))
+        self._models[id] = (values, univ_model)
+        return univ_model
+
+    def should_emit(self, id: str, values: tuple) -> bool:
+        """True, если организацию с такими значениями полей еще не передавали в БД"""
+        if self._emitted.get(id) == values:
+            return False
+        self._emitted[id] = values
+        return True
+
+
+def edu_org_values(eduorg: et.Element) -> tuple:
+    """Значения полей элемента ActualEducationOrganization в порядке EDU_ORG_TAGS"""
+    return tuple(eduorg.find(tag).text for tag in EDU_ORG_TAGS.values())
+
+
+def parse_eduprog(eduprog: et.Element, university_id: str) -> dm.EduProg:
+    """Строит модель образовательной программы по элементу EducationalProgram"""
+    return dm.EduProg(
+        id=eduprog.find("Id").text,
+        type_name=eduprog.find("TypeName").text,
+        edu_level_name=eduprog.find("EduLevelName").text,
+        programm_name=eduprog.find("ProgrammName").text,
+        programm_code=eduprog.find("ProgrammCode").text,
+        ugs_name=eduprog.find("UGSName").text,
+        ugs_code=eduprog.find("UGSCode").text,
+        edu_normative_period=eduprog.find("EduNormativePeriod").text,
+        qualification=eduprog.find("Qualification").text,
+        is_accredited=is_accredited_validator(eduprog.find("IsAccredited").text),
+        is_canceled=eduprog.find("IsCanceled").text,
+        is_suspended=eduprog.find("IsSuspended").text,
+        university_id=university_id,
+    )
+
+
+def parse_certificate(cert: et.Element, today: str, cert_statuses: set, suppl_statuses: set,
+                      univ_index: UniversityIndex):
+    """
+    Возвращает модели вузов и образовательных программ одного свидетельства об аккредитации.
+    Недействующие свидетельства и приложения пропускаются.
+    Вузы, уже переданные в БД с теми же данными, повторно не возвращаются (см. UniversityIndex).
+    """
+    univ_models = []
+    eduprog_models = []
+    cert_status_name = cert.find("StatusName").text
+    cert_end_date = cert.find("EndDate").text
+    cert_statuses.add(cert_status_name)
+    if cert_status_name != "Действующее" or cert_end_date and cert_end_date < today:
+        return univ_models, eduprog_models
+    values = edu_org_values(cert.find("ActualEducationOrganization"))
+    univ_model = univ_index.get_model(values)
+    if is_univ_data(univ_model) and univ_index.should_emit(values[0], values):
+        univ_models.append(univ_model)
+    for suppl in cert.iterfind("Supplements/Supplement"):
+        suppl_status_name = suppl.find("StatusName").text
+        suppl_statuses.add(suppl_status_name)
+        if suppl_status_name != "Действующее":
+            continue
+        suppl_values = edu_org_values(suppl.find("ActualEducationOrganization"))
+        suppl_univ_model = univ_index.get_model(suppl_values)
+        if not is_univ_data(univ_model):
+            continue
+        if univ_index.should_emit(suppl_values[0], suppl_values):
+            univ_models.append(suppl_univ_model)
+        for eduprog in suppl.iterfind("EducationalPrograms/EducationalProgram"):
+            eduprog_models.append(parse_eduprog(eduprog, university_id=suppl_univ_model.id))
+    return univ_models, eduprog_models
+
+
+def _registry_member(archive: zipfile.ZipFile) -> zipfile.ZipInfo:
+    """Возвращает XML-файл выгрузки в архиве (самый большой, если их несколько)"""
+    members = [info for info in archive.infolist() if info.filename.lower().endswith(".xml")]
+    if not members:
+        raise FileNotFoundError(f"В архиве {archive.filename} нет XML-файла")
+    return max(members, key=lambda info: info.file_size)
+
+
+class ProgressReader:
+    """
+    Обертка над файловым объектом выгрузки: считает прочитанные байты и передает долю прочитанного в metrics.
+    total - размер данных; если не задан, берется атрибут total_size источника (zipstream.StreamPipe).
+    """
+
+    def __init__(self, raw, total: int | None = None):
+        self._raw = raw
+        self._total = total
+        self.position = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._raw.read(size)
+        self.position += len(data)
+        metrics.set_progress(self.position, self._total or getattr(self._raw, "total_size", None))
+        return data
+
+
+@contextmanager
+def open_registry_xml(source):
+    """
+    Открывает выгрузку на чтение в бинарном режиме.
+    source: XML-файл, zip-архив с выгрузкой (XML читается из архива с распаковкой на лету, без записи на диск)
+    или уже открытый файловый объект.
+    """
+    if not isinstance(source, str):
+        yield source
+    elif zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            member = _registry_member(archive)
+            with archive.open(member) as stream:
+                yield ProgressReader(stream, member.file_size)
+    else:
+        with open(source, "rb") as stream:
+            yield ProgressReader(stream, os.path.getsize(source))
+
+
+def iter_certificates(source):
+    """
+    Потоково читает выгрузку реестра и возвращает элементы Certificate по одному.
+    Обработанные элементы удаляются из дерева, поэтому расход памяти не зависит от размера файла.
+    source: имя XML-файла или zip-архива, или файловый объект
+    """
+    certificates = None
+    with open_registry_xml(source) as stream:
+        for event, elem in et.iterparse(stream, events=("start", "end")):
+            if event == "start":
+                if elem.tag == "Certificates" and certificates is None:
+                    certificates = elem
                 continue
-            eduorg = cert.find("ActualEducationOrganization")
-            univ_model = dm.University(
-                id=eduorg.find("Id").text,
-                full_name=eduorg.find("FullName").text,
-                short_name=eduorg.find("ShortName").text,
-                head_edu_org_id=eduorg.find("HeadEduOrgId").text,
-                is_branch=eduorg.find("IsBranch").text,
-                post_address=eduorg.find("PostAddress").text,
-                phone=eduorg.find("Phone").text,
-                fax=eduorg.find("Fax").text,
-                email=eduorg.find("Email").text,
-                web_site=eduorg.find("WebSite").text,
-                ogrn=eduorg.find("OGRN").text,
-                inn=eduorg.find("INN").text,
-                kpp=eduorg.find("KPP").text,
-                head_post=eduorg.find("HeadPost").text,
-                head_name=eduorg.find("HeadName").text,
-                form_name=eduorg.find("FormName").text,
-                kind_name=eduorg.find("KindName").text,
-                type_name=eduorg.find("TypeName").text,
-                region_name=eduorg.find("RegionName").text,
-                federal_district_name=eduorg.find("FederalDistrictName").text,
-            )
-            if ("общеобр" in univ_model.full_name.lower()
-                    or "колледж" in univ_model.full_name.lower()
-                    or not ("высшего" in univ_model.full_name.lower() or "высшего" in univ_model.type_name.lower())):
-                pass
+            if (elem.tag == "Certificate" and certificates is not None and len(certificates)
+                    and certificates[0] is elem):
+                yield elem
+                elem.clear()
+                certificates.remove(elem)
+
+
+def parse_certificates_chunk(chunk: list[bytes], encoding: str, today: str):
+    """
+    Разбирает пачку фрагментов <Certificate>...</Certificate>.
+    Выполняется в процессе-обработчике при параллельном разборе.
+    Проверенные модели возвращаются кортежами значений полей: так их дешевле передать между процессами.
+    """
+    suppl_statuses = set()
+    cert_statuses = set()
+    univ_index = UniversityIndex()
+    univ_models = []
+    eduprog_models = []
+    for cert_data in chunk:
+        cert = et.fromstring(cert_data, parser=et.XMLParser(encoding=encoding))
+        cert_univ_models, cert_eduprog_models = parse_certificate(cert, today, cert_statuses, suppl_statuses,
+                                                                  univ_index)
+        univ_models.extend(tuple(model.__dict__.values()) for model in cert_univ_models)
+        eduprog_models.extend(tuple(model.__dict__.values()) for model in cert_eduprog_models)
+    return univ_models, eduprog_models, cert_statuses, suppl_statuses
+
+
+def _find_certificate_start(buffer: bytes, pos: int) -> int:
+    while True:
+        start = buffer.find(b"<Certificate", pos)
+        if start == -1 or start + len(b"<Certificate") >= len(buffer):
+            return -1
+        if buffer[start + len(b"<Certificate")] in b"> \t\r\n/":
+            return start
+        pos = start + 1
+
+
+def iter_certificate_chunks(source, chunk_size: int = config.PARSE_CHUNK_SIZE):
+    """
+    Делит выгрузку на фрагменты <Certificate>...</Certificate>, не разбирая XML,
+    и возвращает пары (кодировка файла, список из chunk_size фрагментов).
+    source: имя XML-файла или zip-архива, или файловый объект, открытый в бинарном режиме
+    """
+    with open_registry_xml(source) as file:
+        encoding = None
+        buffer = b""
+        chunk = []
+        while block := file.read(READ_BLOCK_SIZE):
+            buffer += block
+            if encoding is None:
+                match = XML_ENCODING_PATTERN.match(buffer)
+                encoding = match.group(1).decode() if match else "utf-8"
+            pos = 0
+            while (start := _find_certificate_start(buffer, pos)) != -1:
+                end = buffer.find(b"</Certificate>", start)
+                if end == -1:
+                    break
+                pos = end + len(b"</Certificate>")
+                chunk.append(buffer[start:pos])
+                if len(chunk) >= chunk_size:
+                    yield encoding, chunk
+                    chunk = []
+            if start == -1:
+                buffer = buffer[max(pos, len(buffer) - len(b"<Certificate")):]
             else:
-                univ_models.append(univ_model)
-            supplements = cert.findall("Supplements/Supplement")
-            for suppl in supplements:
-                suppl_status_name = suppl.find("StatusName").text
-                suppl_statuses.add(suppl_status_name)
-                if suppl_status_name != "Действующее":
-                    continue
-                suppl_edu_org = suppl.find("ActualEducationOrganization")
-                suppl_univ_model = dm.University(
-                    id=suppl_edu_org.find("Id").text,
-                    full_name=suppl_edu_org.find("FullName").text,
-                    short_name=suppl_edu_org.find("ShortName").text,
-                    head_edu_org_id=suppl_edu_org.find("HeadEduOrgId").text,
-                    is_branch=suppl_edu_org.find("IsBranch").text,
-                    post_address=suppl_edu_org.find("PostAddress").text,
-                    phone=suppl_edu_org.find("Phone").text,
-                    fax=suppl_edu_org.find("Fax").text,
-                    email=suppl_edu_org.find("Email").text,
-                    web_site=suppl_edu_org.find("WebSite").text,
-                    ogrn=suppl_edu_org.find("OGRN").text,
-                    inn=suppl_edu_org.find("INN").text,
-                    kpp=suppl_edu_org.find("KPP").text,
-                    head_post=suppl_edu_org.find("HeadPost").text,
-                    head_name=suppl_edu_org.find("HeadName").text,
-                    form_name=suppl_edu_org.find("FormName").text,
-                    kind_name=suppl_edu_org.find("KindName").text,
-                    type_name=suppl_edu_org.find("TypeName").text,
-                    region_name=suppl_edu_org.find("RegionName").text,
-                    federal_district_name=suppl_edu_org.find("FederalDistrictName").text,
-                )
-                if ("общеобр" in univ_model.full_name.lower()
-                        or "колледж" in univ_model.full_name.lower()
-                        or not (
-                                "высшего" in univ_model.full_name.lower() or "высшего" in univ_model.type_name.lower())):
-                    continue
-                univ_models.append(suppl_univ_model)
-                eduprogs = suppl.findall("EducationalPrograms/EducationalProgram")
-                for eduprog in eduprogs:
-                    prog_model = dm.EduProg(
-                        id=eduprog.find("Id").text,
-                        type_name=eduprog.find("TypeName").text,
-                        edu_level_name=eduprog.find("EduLevelName").text,
-                        programm_name=eduprog.find("ProgrammName").text,
-                        programm_code=eduprog.find("ProgrammCode").text,
-                        ugs_name=eduprog.find("UGSName").text,
-                        ugs_code=eduprog.find("UGSCode").text,
-                        edu_normative_period=eduprog.find("EduNormativePeriod").text,
-                        qualification=eduprog.find("Qualification").text,
-                        is_accredited=is_accredited_validator(eduprog.find("IsAccredited").text),
-                        is_canceled=eduprog.find("IsCanceled").text,
-                        is_suspended=eduprog.find("IsSuspended").text,
-                        university_id=suppl_univ_model.id,
-                    )
-                    eduprog_models.append(prog_model)
-        print("Статусы сертификатов:", cert_statuses)
-        print("Статусы приложений:", suppl_statuses)
-        return univ_models, eduprog_models
+                buffer = buffer[start:]
+        if chunk:
+            yield encoding, chunk
+
+
+def iter_parsed_certificates(source, today: str, cert_statuses: set, suppl_statuses: set, workers: int):
+    """
+    Возвращает модели (список вузов, список ОП) по мере разбора выгрузки.
+    При workers > 1 фрагменты свидетельств разбираются пулом процессов, порядок результатов сохраняется.
+    """
+    univ_index = UniversityIndex()
+    if workers <= 1:
+        for cert in iter_certificates(source):
+            yield parse_certificate(cert, today, cert_statuses, suppl_statuses, univ_index)
+        return
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        pending = deque()
+        for encoding, chunk in iter_certificate_chunks(source):
+            pending.append(executor.submit(parse_certificates_chunk, chunk, encoding, today))
+            # Ограничивает число ожидающих пачек, чтобы не держать в памяти весь файл
+            while len(pending) >= 2 * workers:
+                yield _merge_chunk_result(pending.popleft().result(), cert_statuses, suppl_statuses, univ_index)
+        while pending:
+            yield _merge_chunk_result(pending.popleft().result(), cert_statuses, suppl_statuses, univ_index)
+
+
+def _merge_chunk_result(result, cert_statuses: set, suppl_statuses: set, univ_index: UniversityIndex):
+    """Объединяет результат процесса-обработчика с общим индексом вузов"""
+    univ_rows, eduprog_rows, chunk_cert_statuses, chunk_suppl_statuses = result
+    cert_statuses |= chunk_cert_statuses
+    suppl_statuses |= chunk_suppl_statuses
+    univ_rows = [row for row in univ_rows if univ_index.should_emit(row[0], row)]
+    return _construct_models(dm.University, univ_rows), _construct_models(dm.EduProg, eduprog_rows)
+
+
+def _construct_models(model_class, rows: list[tuple]) -> list:
+    """Собирает уже проверенные в процессе-обработчике модели без повторной валидации"""
+    fields = list(model_class.model_fields)
+    return [model_class.model_construct(**dict(zip(fields, row))) for row in rows]
+
+
+def iter_parsed_batches(source, batch_size: int = config.PARSE_BATCH_SIZE, workers: int = config.PARSE_WORKERS,
+                        today: str = None):
+    """
+    Возвращает пачки (список вузов, список ОП) по мере разбора выгрузки.
+    Пачка отдается, как только число записей в ней достигает batch_size.
+    Вузы внутри пачки не повторяются: при совпадении id остается последняя версия.
+    today: дата, на которую отбрасываются истекшие свидетельства (по умолчанию - сегодня)
+    """
+    today = today or str(datetime.date.today())
+    suppl_statuses = set()
+    cert_statuses = set()
+    univ_models = {}
+    eduprog_models = []
+    for cert_univ_models, cert_eduprog_models in iter_parsed_certificates(source, today, cert_statuses,
+                                                                          suppl_statuses, workers):
+        univ_models.update((univ_model.id, univ_model) for univ_model in cert_univ_models)
+        eduprog_models.extend(cert_eduprog_models)
+        if len(univ_models) + len(eduprog_models) >= batch_size:
+            yield list(univ_models.values()), eduprog_models
+            univ_models, eduprog_models = {}, []
+    if univ_models or eduprog_models:
+        yield list(univ_models.values()), eduprog_models
+    print("Статусы сертификатов:", cert_statuses)
+    print("Статусы приложений:", suppl_statuses)
+
+
+def open_registry_batches(filename: str):
+    """
+    Возвращает пачки записей выгрузки. Если файл с тем же содержимым уже разбирался сегодня,
+    пачки читаются из снимка, иначе XML разбирается заново и по ходу разбора записывается новый снимок.
+    Снимок прошлого дня не используется: с тех пор могли истечь сроки части свидетельств.
+    """
+    if not config.SNAPSHOT_ENABLED or not isinstance(filename, str):
+        return iter_parsed_batches(filename)
+    today = str(datetime.date.today())
+    digest = snapshot.file_digest(filename)
+    path = snapshot.find_snapshot(digest, today)
+    if path:
+        print(f"Выгрузка не изменилась, записи загружаются из снимка {path}")
+        return snapshot.iter_snapshot_batches(path)
+    return snapshot.record_snapshot(iter_parsed_batches(filename, today=today), digest, today)
+
+
+async def _produce_batches(batches, queue: asyncio.Queue) -> None:
+    """Разбирает пачки в отдельном потоке и кладет их в очередь; в конце кладет None, при ошибке - исключение"""
+    try:
+        while True:
+            with metrics.stage("parse") as stage_metrics:
+                batch = await asyncio.to_thread(next, batches, None)
+                if batch is not None:
+                    stage_metrics.records += len(batch[0]) + len(batch[1])
+            await queue.put(batch)
+            if batch is None:
+                return
+    except Exception as e:
+        await queue.put(e)
+
 
-    univ_models, eduprog_models = await asyncio.to_thread(sync_xml_parse)
-    actual_univs_id = set()
-    actual_eduprogs_id = set()
-    print(len(univ_models), len(eduprog_models))
-    for univ_model in univ_models:
-        try:
-            await dbt.University.add(data=univ_model, custom=False)
-            actual_univs_id.add(univ_model.id)
-        except dbt.NotUnivError:
-            pass
-        except dbt.UniqueConstraintFailedError:
-            await dbt.University.update(data=univ_model)
-            actual_univs_id.add(univ_model.id)
-    for prog_model in eduprog_models:
-        try:
-            await dbt.EduProg.add(data=prog_model, custom=False)
-            actual_eduprogs_id.add(prog_model.id)
-        except dbt.NotUnivError:
-            pass
-        except dbt.UniqueConstraintFailedError:
-            await dbt.EduProg.update(data=prog_model)
-            actual_eduprogs_id.add(prog_model.id)
-    return actual_univs_id, actual_eduprogs_id
+async def xml_parse(filename, shadow: bool = False):
+    """
+    Разбирает выгрузку реестра в отдельном потоке и передает записи в БД пачками,
+    не дожидаясь окончания разбора всего файла: пока пачка пишется в БД, разбираются следующие.
+    Очередь разобранных пачек ограничена config.PIPELINE_QUEUE_SIZE, поэтому разбор не убегает вперед записи.
+    Число процессов для разбора задается config.PARSE_WORKERS.
+    Между пачками проверяется, не отменен ли запуск (metrics.check_cancelled).
+    filename: XML-файл, zip-архив или файловый объект с XML
+    """
+    univ_changes = dm.RegistryChanges()
+    eduprog_changes = dm.RegistryChanges()
+    univs_count = eduprogs_count = 0
+    with metrics.stage("parse"):
+        batches = await asyncio.to_thread(open_registry_batches, filename)
+    queue = asyncio.Queue(maxsize=config.PIPELINE_QUEUE_SIZE)
+    producer = asyncio.create_task(_produce_batches(batches, queue))
+    try:
+        while (batch := await queue.get()) is not None:
+            if isinstance(batch, Exception):
+                raise batch
+            metrics.check_cancelled()
+            univ_models, eduprog_models = batch
+            univs_count += len(univ_models)
+            eduprogs_count += len(eduprog_models)
+            await dbt.upsert_registry_batch(univ_models, eduprog_models, univ_changes, eduprog_changes,
+                                            shadow=shadow)
+            metrics.add_records(len(univ_models) + len(eduprog_models))
+    finally:
+        producer.cancel()
+    print(univs_count, eduprogs_count)
+    return univ_changes, eduprog_changes
 
 
 if __name__ == "__main__":
@@ -1,51 +1,116 @@
 import asyncio
 from datetime import datetime
-import downloader
-import parser
-import json
 import os
-from pathlib import Path
+import socket
+import time
+import uuid
+import config
+import db_tables as dbt
+from jobs import RefreshJobManager
 
 
 class Scheduler:
-    def __init__(self, interval_seconds: int = 12 * 60 * 60):
+    """
+    Периодическое обновление данных из реестра.
+    Если запущено несколько экземпляров сервера, обновление выполняет только ведущий - тот, кто держит аренду
+    в таблице scheduler_lease и продлевает ее. Если ведущий перестал ее продлевать (процесс завершился),
+    после истечения аренды ведущим становится другой экземпляр.
+    Настройки расписания и время последнего обновления хранятся в той же таблице и общие для всех экземпляров.
+    status_callbacks - корутины, которые вызываются с новым состоянием расписания (get_status), когда оно меняется.
+    """
+
+    def __init__(self, jobs: RefreshJobManager):
         print("Scheduler создан")
+        self.jobs = jobs
+        self.jobs.worker.finished_callbacks.append(self._on_refresh_finished)
         self.task = None
-        self.interval = interval_seconds
-        self.is_running = False
-        self.state_file = Path("scheduler_state.json")
-        self.last_update = None
-        self._load_state()
-
-    def _load_state(self):
-        """Загружает время последнего обновления из файла"""
-        if self.state_file.exists():
-            try:
-                with open(self.state_file, 'r') as f:
-                    data = json.load(f)
-                    if 'last_update' in data:
-                        self.last_update = datetime.fromisoformat(data['last_update'])
-            except Exception as e:
-                print(f"Ошибка при загрузке состояния: {e}")
+        self.election_task = None
+        self.interval = None
+        self.is_leader = False
+        self.instance_id = str(uuid.uuid4())
+        self.instance_name = f"{socket.gethostname()}:{os.getpid()}"
+        self._lease_expiration_time = 0
+        self._seen_last_update = None
+        self._status = None
+        self.status_callbacks = []
+
+    def run(self) -> None:
+        """Запускает участие экземпляра в выборе ведущего"""
+        if self.election_task is None:
+            self.election_task = asyncio.create_task(self._elect())
+
+    async def shutdown(self) -> None:
+        """Останавливает периодическое обновление в этом экземпляре и освобождает аренду"""
+        if self.election_task is not None:
+            self.election_task.cancel()
+            self.election_task = None
+        self._stop_task()
+        if self.is_leader:
+            self.is_leader = False
+            await dbt.SchedulerLease.release(self.instance_id)
 
-    def _save_state(self):
-        """Сохраняет время последнего обновления в файл"""
+    async def _elect(self) -> None:
+        while True:
+            await self._sync()
+            await asyncio.sleep(config.SCHEDULER_LEASE_RENEW_INTERVAL)
+
+    async def _sync(self) -> dbt.SchedulerLease | None:
+        """Берет или продлевает аренду и приводит периодическое обновление в соответствие с настройками"""
         try:
-            with open(self.state_file, 'w') as f:
-                json.dump({
-                    'last_update': datetime.now().isoformat()
-                }, f)
+            acquired = await dbt.SchedulerLease.try_acquire(self.instance_id, self.instance_name,
+                                                            config.SCHEDULER_LEASE_TTL)
+            lease = await dbt.SchedulerLease.get()
         except Exception as e:
-            print(f"Ошибка при сохранении состояния: {e}")
+            # БД может быть занята записью выгрузки: до истечения аренды экземпляр остается ведущим
+            print(f"Не удалось продлить аренду планировщика: {e}")
+            if self.is_leader and time.time() >= self._lease_expiration_time:
+                self.is_leader = False
+                self._stop_task()
+            return None
+        if acquired and not self.is_leader:
+            print(f"Экземпляр {self.instance_name} стал ведущим для периодического обновления")
+        self.is_leader = acquired
+        if acquired:
+            self._lease_expiration_time = lease.expiration_time
+        if lease.last_update != self._seen_last_update:
+            # Данные обновил другой экземпляр или процесс: кешированные списки и число записей устарели
+            self._seen_last_update = lease.last_update
+            dbt.invalidate_data_caches()
+        if self.is_leader and lease.enabled:
+            if self.task is None or self.task.done() or lease.interval_seconds != self.interval:
+                self._stop_task()
+                print("Запуск периодического обновления")
+                self.interval = lease.interval_seconds
+                self.task = asyncio.create_task(self.run_periodically())
+        else:
+            self._stop_task()
+        await self._notify_status(self._lease_status(lease))
+        return lease
+
+    async def _notify_status(self, status: dict) -> None:
+        if status == self._status:
+            return
+        self._status = status
+        for callback in self.status_callbacks:
+            try:
+                await callback(status)
+            except Exception as e:
+                print(f"Ошибка при обработке состояния расписания: {e}")
+
+    async def _on_refresh_finished(self, run: dict) -> None:
+        if run["status"] in ("success", "unchanged"):
+            await dbt.SchedulerLease.set_last_update(run["finished_at"])
 
     async def run_periodically(self):
         """Запускает скачивание каждые N часов"""
-        while self.is_running:
+        while True:
             current_time = datetime.now()
+            lease = await dbt.SchedulerLease.get()
+            last_update = datetime.fromisoformat(lease.last_update) if lease.last_update else None
 
             # Если есть информация о последнем обновлении и время еще не пришло
-            if self.last_update and (current_time - self.last_update).total_seconds() < self.interval:
-                next_update = self.last_update.timestamp() + self.interval
+            if last_update and (current_time - last_update).total_seconds() < self.interval:
+                next_update = last_update.timestamp() + self.interval
                 wait_time = next_update - current_time.timestamp()
                 print(f"[{current_time}] Следующее обновление через {wait_time / 60:.1f} минут")
                 await asyncio.sleep(wait_time)
@@ -53,11 +118,20 @@ class Scheduler:
 
             print(f"[{current_time}] Запуск скачивания и обновления...")
             try:
-                await downloader.download_and_extract()
-                await parser.update_DB()
-                self.last_update = datetime.now()
-                self._save_state()
-                await asyncio.sleep(self.interval)
+                run = await self.jobs.run(trigger="periodic")
+                if run["status"] == "error":
+                    print(f"Ошибка при обновлении данных: {run['error']}")
+                    await asyncio.sleep(60)
+                    continue
+                if run["status"] == "cancelled":
+                    # Запуск остановил администратор: следующий - через полный интервал, а не сразу
+                    print(f"Обновление данных отменено, следующее через {self.interval / 60:.1f} минут")
+                    await asyncio.sleep(self.interval)
+                    continue
+                if run["status"] == "unchanged":
+                    print(f"Выгрузка не изменилась, обновление БД пропущено: {self._format_stages(run)}")
+                else:
+                    print(f"Обновление завершено ({run['status']}): {self._format_stages(run)}")
             except asyncio.CancelledError:
                 print("Задача обновления данных отменена")
                 return
@@ -65,23 +139,39 @@ class Scheduler:
                 print(f"Ошибка при обновлении данных: {e}")
                 await asyncio.sleep(60)
 
-    def start(self, interval_seconds: int):
-        if self.is_running:
-            if interval_seconds == self.interval:
-                return
-            self.stop()
-        print("Запуск периодического обновления")
-        self.interval = interval_seconds
-        self.is_running = True
-        self.task = asyncio.create_task(self.run_periodically())
-
-    def stop(self):
-        """Останавливает планировщик"""
-        if not self.is_running:
-            return
-        self.is_running = False
-        self.task.cancel()
-        print("Периодическое обновление остановлено")
+    @staticmethod
+    def _format_stages(run: dict) -> str:
+        return ", ".join(f"{stage['name']} {stage['seconds']:.1f} с" for stage in run["stages"].values())
+
+    def _stop_task(self) -> None:
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+            print("Периодическое обновление остановлено")
+        self.task = None
+
+    async def start(self, interval_seconds: int):
+        """Включает периодическое обновление для всех экземпляров; выполнять его будет ведущий"""
+        await dbt.SchedulerLease.set_schedule(enabled=True, interval_seconds=interval_seconds)
+        await self._sync()
+
+    async def stop(self):
+        """Выключает периодическое обновление для всех экземпляров"""
+        await dbt.SchedulerLease.set_schedule(enabled=False)
+        await self._sync()
+
+    async def is_run(self) -> bool:
+        lease = await dbt.SchedulerLease.get()
+        return bool(lease.enabled)
+
+    async def get_status(self) -> dict:
+        """Возвращает состояние периодического обновления, одинаковое для всех экземпляров"""
+        return self._lease_status(await dbt.SchedulerLease.get())
 
-    def is_run(self):
-        return self.is_running
+    def _lease_status(self, lease: dbt.SchedulerLease) -> dict:
+        return {
+            "enabled": bool(lease.enabled),
+            "interval_seconds": lease.interval_seconds,
+            "last_update": lease.last_update,
+            "leader": lease.owner_name if lease.expiration_time >= time.time() else None,
+            "is_leader": self.is_leader,
+        }
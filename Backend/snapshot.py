@@ -0,0 +1,107 @@
+import hashlib
+import marshal
+import mmap
+import os
+import struct
+import config
+import data_models as dm
+
+
+# Формат снимка: заголовок и пачки записей, каждая запись файла - длина (8 байт) и данные marshal.
+# Пачка хранится по столбцам: (столбцы вузов, столбцы ОП), столбец - список значений одного поля.
+SNAPSHOT_FORMAT = 1
+SNAPSHOT_SUFFIX = ".snapshot"
+FRAME_HEADER = struct.Struct("<Q")
+
+
+def file_digest(filename: str) -> str:
+    """Возвращает sha256 содержимого файла"""
+    with open(filename, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def snapshot_path(digest: str, today: str) -> str:
+    # Разбор отбрасывает свидетельства, срок которых истек к дате разбора, поэтому снимок действует только в свою дату
+    return os.path.join(config.SNAPSHOT_DIR, f"{digest}_{today}{SNAPSHOT_SUFFIX}")
+
+
+def _header() -> dict:
+    return {
+        "format": SNAPSHOT_FORMAT,
+        "university_fields": list(dm.University.model_fields),
+        "eduprog_fields": list(dm.EduProg.model_fields),
+    }
+
+
+def _write_frame(f, value) -> None:
+    data = marshal.dumps(value)
+    f.write(FRAME_HEADER.pack(len(data)))
+    f.write(data)
+
+
+def _to_columns(models: list, fields: list[str]) -> list[list]:
+    return [[getattr(model, field) for model in models] for field in fields]
+
+
+def _from_columns(model_class, columns: list[list], fields: list[str]) -> list:
+    return [model_class.model_construct(**dict(zip(fields, row))) for row in zip(*columns)]
+
+
+def find_snapshot(digest: str, today: str) -> str | None:
+    """
+    Возвращает путь к снимку для файла с данным хешем, разобранного в дату today,
+    если снимок есть и записан в текущем формате
+    """
+    path = snapshot_path(digest, today)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "rb") as f:
+            (length,) = FRAME_HEADER.unpack(f.read(FRAME_HEADER.size))
+            if marshal.loads(f.read(length)) == _header():
+                return path
+    except (OSError, EOFError, ValueError, struct.error) as e:
+        print(f"Снимок {path} поврежден: {e}")
+    return None
+
+
+def iter_snapshot_batches(path: str):
+    """Возвращает пачки (список вузов, список ОП) из снимка, отображая файл в память"""
+    header = _header()
+    university_fields, eduprog_fields = header["university_fields"], header["eduprog_fields"]
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        pos = FRAME_HEADER.size + FRAME_HEADER.unpack_from(mm, 0)[0]
+        while pos < len(mm):
+            (length,) = FRAME_HEADER.unpack_from(mm, pos)
+            pos += FRAME_HEADER.size
+            univ_columns, eduprog_columns = marshal.loads(mm[pos:pos + length])
+            pos += length
+            yield (_from_columns(dm.University, univ_columns, university_fields),
+                   _from_columns(dm.EduProg, eduprog_columns, eduprog_fields))
+
+
+def record_snapshot(batches, digest: str, today: str):
+    """
+    Пропускает через себя пачки разбора и параллельно записывает их в снимок.
+    Снимок появляется под своим именем, только если разбор дошел до конца; старые снимки удаляются.
+    """
+    os.makedirs(config.SNAPSHOT_DIR, exist_ok=True)
+    path = snapshot_path(digest, today)
+    tmp_path = path + ".tmp"
+    header = _header()
+    completed = False
+    try:
+        with open(tmp_path, "wb") as f:
+            _write_frame(f, header)
+            for univ_models, eduprog_models in batches:
+                _write_frame(f, (_to_columns(univ_models, header["university_fields"]),
+                                 _to_columns(eduprog_models, header["eduprog_fields"])))
+                yield univ_models, eduprog_models
+        os.replace(tmp_path, path)
+        completed = True
+    finally:
+        if not completed and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    for filename in os.listdir(config.SNAPSHOT_DIR):
+        if filename.endswith(SNAPSHOT_SUFFIX) and filename != os.path.basename(path):
+            os.remove(os.path.join(config.SNAPSHOT_DIR, filename))
@@ -0,0 +1,249 @@
+import asyncio
+import struct
+import threading
+import zlib
+from collections import deque
+
+
+# Локальный заголовок файла в zip-архиве: сигнатура, версия, флаги, метод сжатия, время, дата,
+# CRC-32, сжатый и исходный размер, длина имени, длина дополнительного поля
+LOCAL_HEADER = struct.Struct("<4sHHHHHIIIHH")
+LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+DATA_DESCRIPTOR_SIGNATURE = b"PK\x07\x08"
+ZIP64_EXTRA_ID = 0x0001
+FLAG_ENCRYPTED = 0x1
+FLAG_DATA_DESCRIPTOR = 0x8
+METHOD_STORED = 0
+METHOD_DEFLATED = 8
+RAW_READ_SIZE = 256 * 1024
+
+
+class PipeClosedError(Exception):
+    """Другая сторона канала перестала его читать или писать"""
+
+
+class StreamPipe:
+    """
+    Ограниченный канал байтов между асинхронным источником (скачивание) и потоком, который их читает (разбор).
+    Запись ждет, пока в канале больше limit байт, поэтому скачивание не убегает вперед разбора.
+    Читающая сторона использует его как файл, открытый в бинарном режиме.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.written = 0
+        self.total_size = None  # Размер всего архива, если его сообщил сервер
+        self._chunks = deque()
+        self._size = 0
+        self._eof = False
+        self._error = None
+        self._reader_closed = False
+        self._condition = threading.Condition()
+        self._data_event = asyncio.Event()
+
+    def _put(self, data: bytes) -> None:
+        with self._condition:
+            self._condition.wait_for(lambda: self._size < self.limit or self._reader_closed)
+            if self._reader_closed:
+                raise PipeClosedError("Разбор выгрузки остановлен")
+            self._chunks.append(data)
+            self._size += len(data)
+            self._condition.notify_all()
+
+    async def write(self, data: bytes) -> None:
+        """Передает кусок данных читающей стороне, ожидая, пока в канале освободится место"""
+        if not data:
+            return
+        self.written += len(data)
+        self._data_event.set()
+        await asyncio.to_thread(self._put, data)
+
+    async def wait_for_data(self) -> None:
+        await self._data_event.wait()
+
+    def has_data(self) -> bool:
+        return self._data_event.is_set()
+
+    def finish(self, error: BaseException | None = None) -> None:
+        """Сообщает о конце данных; error - исключение, которое получит читающая сторона"""
+        with self._condition:
+            self._eof = True
+            self._error = error
+            self._condition.notify_all()
+
+    def read(self, size: int = -1) -> bytes:
+        """Возвращает до size байт (все оставшиеся при size < 0), пустую строку - в конце данных"""
+        with self._condition:
+            self._condition.wait_for(lambda: self._chunks or self._eof or self._reader_closed)
+            if self._reader_closed:
+                raise PipeClosedError("Канал закрыт")
+            if self._error is not None:
+                raise self._error
+            parts = []
+            while self._chunks and (size < 0 or size > 0):
+                chunk = self._chunks.popleft()
+                if 0 <= size < len(chunk):
+                    self._chunks.appendleft(chunk[size:])
+                    chunk = chunk[:size]
+                parts.append(chunk)
+                self._size -= len(chunk)
+                if size > 0:
+                    size -= len(chunk)
+            self._condition.notify_all()
+            return b"".join(parts)
+
+    def close(self) -> None:
+        """Закрывает канал со стороны чтения: ожидающая запись завершится ошибкой PipeClosedError"""
+        with self._condition:
+            self._reader_closed = True
+            self._chunks.clear()
+            self._size = 0
+            self._condition.notify_all()
+
+
+class ZipStreamReader:
+    """
+    Читает XML-файл из zip-архива по мере поступления байтов архива, без произвольного доступа к файлу:
+    по локальным заголовкам, а не по центральному каталогу в конце архива.
+    Остальные файлы архива пропускаются. CRC-32 файла проверяется в конце; после файла выгрузки
+    дочитывается остаток архива, поэтому конец данных наступает только после того, как источник его подтвердил.
+    """
+
+    def __init__(self, raw, member_suffix: str = ".xml"):
+        self._raw = raw
+        self._member_suffix = member_suffix
+        self._pending = b""
+        self._member = None
+        self._finished = False
+
+    def _read_raw(self, size: int) -> bytes:
+        if self._pending:
+            data, self._pending = self._pending[:size], self._pending[size:]
+            return data
+        return self._raw.read(size)
+
+    def _read_upto(self, size: int) -> bytes:
+        """Читает size байт, меньше - только в конце данных"""
+        parts = []
+        while size > 0:
+            data = self._read_raw(size)
+            if not data:
+                break
+            parts.append(data)
+            size -= len(data)
+        return b"".join(parts)
+
+    def _read_exact(self, size: int) -> bytes:
+        data = self._read_upto(size)
+        if len(data) < size:
+            raise EOFError("Архив оборвался посреди заголовка")
+        return data
+
+    def _open_next_member(self) -> bool:
+        """Читает локальный заголовок следующего файла; возвращает False, если файлы в архиве закончились"""
+        header = self._read_upto(LOCAL_HEADER.size)
+        if header[:4] != LOCAL_HEADER_SIGNATURE:
+            # Дальше идет центральный каталог
+            self._pending = header + self._pending
+            return False
+        if len(header) < LOCAL_HEADER.size:
+            raise EOFError("Архив оборвался посреди заголовка")
+        (_, _, flags, method, _, _, crc, compressed_size, _,
+         name_length, extra_length) = LOCAL_HEADER.unpack(header)
+        name = self._read_exact(name_length).decode("utf-8" if flags & 0x800 else "cp437")
+        extra = self._read_exact(extra_length)
+        if flags & FLAG_ENCRYPTED:
+            raise ValueError(f"Файл {name} в архиве зашифрован")
+        zip64 = False
+        pos = 0
+        while pos + 4 <= len(extra):
+            extra_id, extra_size = struct.unpack_from("<HH", extra, pos)
+            if extra_id == ZIP64_EXTRA_ID:
+                zip64 = True
+                if compressed_size == 0xFFFFFFFF and extra_size >= 16:
+                    compressed_size = struct.unpack_from("<Q", extra, pos + 12)[0]
+            pos += 4 + extra_size
+        if method == METHOD_DEFLATED:
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        elif method == METHOD_STORED and not flags & FLAG_DATA_DESCRIPTOR:
+            decompressor = None
+        else:
+            raise ValueError(f"Файл {name} в архиве сжат неподдерживаемым способом ({method})")
+        self._member = {
+            "name": name,
+            "flags": flags,
+            "crc": crc,
+            "zip64": zip64,
+            "remaining": compressed_size,
+            "decompressor": decompressor,
+            "actual_crc": 0,
+        }
+        return True
+
+    def _read_member(self, size: int) -> bytes:
+        """Возвращает очередные распакованные данные текущего файла, пустую строку - в конце файла"""
+        member = self._member
+        decompressor = member["decompressor"]
+        while True:
+            if decompressor is None:
+                if not member["remaining"]:
+                    data = b""
+                else:
+                    data = self._read_raw(min(size, member["remaining"], RAW_READ_SIZE))
+                    if not data:
+                        raise EOFError(f"Архив оборвался посреди файла {member['name']}")
+                    member["remaining"] -= len(data)
+            elif decompressor.eof:
+                data = b""
+            else:
+                if decompressor.unconsumed_tail:
+                    data = decompressor.decompress(decompressor.unconsumed_tail, size)
+                else:
+                    raw = self._read_raw(RAW_READ_SIZE)
+                    if not raw:
+                        raise EOFError(f"Архив оборвался посреди файла {member['name']}")
+                    data = decompressor.decompress(raw, size)
+                if decompressor.eof:
+                    self._pending = decompressor.unused_data + self._pending
+                if not data and not decompressor.eof:
+                    continue
+            if data:
+                member["actual_crc"] = zlib.crc32(data, member["actual_crc"])
+                return data
+            self._close_member()
+            return b""
+
+    def _close_member(self) -> None:
+        member = self._member
+        expected_crc = member["crc"]
+        if member["flags"] & FLAG_DATA_DESCRIPTOR:
+            value = self._read_exact(4)
+            if value == DATA_DESCRIPTOR_SIGNATURE:
+                value = self._read_exact(4)
+            expected_crc = struct.unpack("<I", value)[0]
+            self._read_exact(16 if member["zip64"] else 8)
+        if member["actual_crc"] != expected_crc:
+            raise zlib.error(f"Неверная CRC-32 файла {member['name']} в архиве")
+        self._member = None
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0:
+            return b"".join(iter(lambda: self.read(RAW_READ_SIZE), b""))
+        if size == 0:
+            return b""
+        while not self._finished:
+            if self._member is None:
+                if not self._open_next_member():
+                    raise FileNotFoundError(f"В архиве нет файла *{self._member_suffix}")
+                if not self._member["name"].lower().endswith(self._member_suffix):
+                    while self._read_member(RAW_READ_SIZE):
+                        pass
+                    continue
+            data = self._read_member(size)
+            if data:
+                return data
+            # Файл выгрузки закончился: дочитывает центральный каталог до конца данных источника
+            while self._read_raw(RAW_READ_SIZE):
+                pass
+            self._finished = True
+        return b""